@@ -0,0 +1,12 @@
+import os
+import sys
+
+if __name__ == "__main__":
+  if len(sys.argv) < 2:
+    print "Usage: %s path/to/benchmark [args...]" % sys.argv[0]
+    sys.exit(0)
+  import module_loader
+  if len(os.path.dirname(sys.argv[1])):
+    sys.path.insert(0, os.path.dirname(sys.argv[1]))
+  m = __import__(os.path.basename(sys.argv[1]))
+  m.main(sys.argv[2:])
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import time
+
+from util import fastcopy
+
+_DEFAULT_SIZE_MB = 256
+_REPEAT = 3
+
+
+def _write_test_file(path, size_mb):
+  block = os.urandom(1024 * 1024)
+  with open(path, 'wb') as f:
+    for i in xrange(size_mb):
+      f.write(block)
+
+
+def _best_of(copy, src, dest):
+  best = None
+  for i in xrange(_REPEAT):
+    if os.path.exists(dest):
+      os.remove(dest)
+    tstart = time.time()
+    copy(src, dest)
+    elapsed = time.time() - tstart
+    best = elapsed if best is None else min(best, elapsed)
+  return best
+
+
+# Usage: python benchmark.py benchmarks/bench_copy [size_mb]
+def main(argv):
+  size_mb = int(argv[0]) if argv else _DEFAULT_SIZE_MB
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    src = os.path.join(tmp_dir, 'data')
+    dest = os.path.join(tmp_dir, 'copy')
+    _write_test_file(src, size_mb)
+    # Warm up the page cache so that the disk speed is excluded
+    shutil.copy2(src, dest)
+    print 'Copy a %s MB file, best of %s runs' % (size_mb, _REPEAT)
+    copies = [('shutil.copy2', shutil.copy2)]
+    for method in fastcopy.available_methods():
+      def copy(src, dest, method=method):
+        fastcopy.configure([method])
+        fastcopy.copy2(src, dest)
+      copies.append((method, copy))
+    try:
+      for name, copy in copies:
+        best = _best_of(copy, src, dest)
+        print '%-16s %8.3f s %10.1f MB/s' % (
+            name, best, size_mb / max(best, 1e-9))
+    finally:
+      fastcopy.configure()
+  finally:
+    shutil.rmtree(tmp_dir)
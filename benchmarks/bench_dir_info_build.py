@@ -0,0 +1,79 @@
+import os
+import time
+
+import cStringIO
+
+from sync import file_info
+from util import i18n
+
+_DEFAULT_FILE_COUNT = 1000000
+_FILES_PER_DIR = 100
+_DIRS_PER_DIR = 10
+
+
+# The builder before the single pass one, for comparison
+def _legacy_sorted_file_info_list_to_dir_info(
+    base, sorted_file_info_list, start_index, key=None):
+  i = start_index
+  base_file_info_list = []
+  base_dir_info_dict = {}
+  while i < len(sorted_file_info_list):
+    fi = sorted_file_info_list[i]
+    if '..' in os.path.relpath(fi.path, base):
+      break
+    if fi.is_dir:
+      base_file_info_list.append(fi)
+      dir_info, i = _legacy_sorted_file_info_list_to_dir_info(
+          fi.path, sorted_file_info_list, i + 1)
+      base_dir_info_dict[fi.path] = dir_info
+    else:
+      base_file_info_list.append(fi)
+    i += 1
+  return (file_info.DirInfo(base, base_file_info_list, base_dir_info_dict,
+                            key=key),
+          i - 1)
+
+
+def _legacy_load_dir_info_from_csv(f, base_dir):
+  file_info_list = [file_info.load_from_csv_row(row)
+                    for row in i18n.UnicodeReader(f) if len(row) >= 6]
+  dir_info, unused = _legacy_sorted_file_info_list_to_dir_info(
+      base_dir, file_info_list, 0)
+  return dir_info
+
+
+# profile_dir.csv of file_count files in a tree of dirs
+def _generate_csv(file_count):
+  file_info_list = [file_info.FileInfo('.', True, 040755, None, 1.0)]
+  for i in xrange(file_count / _FILES_PER_DIR):
+    parts = []
+    d = i
+    while True:
+      parts.append('dir%d' % (d % _DIRS_PER_DIR))
+      d /= _DIRS_PER_DIR
+      if not d:
+        break
+    dir_path = os.path.join('.', *reversed(parts))
+    file_info_list.append(
+        file_info.FileInfo(dir_path, True, 040755, None, 1.0))
+    for j in xrange(_FILES_PER_DIR):
+      file_info_list.append(file_info.FileInfo(
+          os.path.join(dir_path, 'file%d.txt' % j), False, 0100644, j, 1.0,
+          '%040x' % j))
+  dir_info = file_info.load_dir_info_from_file_info_list('.', file_info_list)
+  output = cStringIO.StringIO()
+  dir_info.write_to_csv(output)
+  return output.getvalue()
+
+
+# Usage: python benchmark.py benchmarks/bench_dir_info_build [file_count]
+def main(argv):
+  file_count = int(argv[0]) if argv else _DEFAULT_FILE_COUNT
+  csv_data = _generate_csv(file_count)
+  print 'Build the dir info of %s rows' % csv_data.count('\n')
+  for name, load in [
+      ('legacy', _legacy_load_dir_info_from_csv),
+      ('single', file_info.load_dir_info_from_csv)]:
+    tstart = time.time()
+    load(cStringIO.StringIO(csv_data), '.')
+    print '%-10s %8.3f s' % (name, time.time() - tstart)
@@ -0,0 +1,62 @@
+import os
+import time
+
+from sync import file_info
+
+_DEFAULT_DEPTH = 30
+_FILES_PER_DIR = 100
+
+
+# DirInfo.get before the path index, for comparison
+def _legacy_get(dir_info, path):
+  # Hack since '.' shows up twice in DirInfo tree
+  if '.' in dir_info._dir_info_dict:
+    return _legacy_get(dir_info._dir_info_dict['.'], path)
+  relpath = os.path.relpath(path, dir_info.base_dir())
+  if '..' in relpath:
+    return None
+  relpath_split = relpath.split(os.sep)
+  if len(relpath_split) == 1:
+    return dir_info.child(path)
+  next_base = os.path.join(dir_info.base_dir(), relpath_split[0])
+  if next_base in dir_info._dir_info_dict:
+    return _legacy_get(dir_info._dir_info_dict[next_base], path)
+  return None
+
+
+# A chain of depth nested dirs with _FILES_PER_DIR files in each
+def _build_deep_dir_info(depth):
+  file_info_list = [file_info.FileInfo('.', True, 040755, None, 1.0)]
+  dir_path = '.'
+  for d in xrange(depth):
+    for i in xrange(_FILES_PER_DIR):
+      file_info_list.append(file_info.FileInfo(
+          os.path.join(dir_path, 'file%04d.txt' % i), False, 0100644, i, 1.0))
+    dir_path = os.path.join(dir_path, 'dir%04d' % d)
+    file_info_list.append(file_info.FileInfo(dir_path, True, 040755, None,
+                                             1.0))
+  return file_info.load_dir_info_from_file_info_list('.', file_info_list)
+
+
+def _time_lookups(get, dir_info, paths):
+  tstart = time.time()
+  for path in paths:
+    if get(dir_info, path) is None:
+      raise Exception('Missing %s' % path)
+  return time.time() - tstart
+
+
+# Usage: python benchmark.py benchmarks/bench_dir_info_lookup [depth]
+def main(argv):
+  depth = int(argv[0]) if argv else _DEFAULT_DEPTH
+  dir_info = _build_deep_dir_info(depth)
+  paths = [x.path for x in dir_info.flat_file_info_list() if x.path != '.']
+  print 'Look up %s paths in a tree of depth %s' % (len(paths), depth)
+  tstart = time.time()
+  dir_info.get(paths[0])
+  print '%-10s %8.3f s' % ('build', time.time() - tstart)
+  for name, get in [('legacy', _legacy_get),
+                    ('indexed', lambda di, path: di.get(path))]:
+    elapsed = _time_lookups(get, dir_info, paths)
+    print '%-10s %8.3f s %8.2f us/lookup' % (
+        name, elapsed, elapsed * 1000000 / len(paths))
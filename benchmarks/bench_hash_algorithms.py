@@ -0,0 +1,39 @@
+import os
+import shutil
+import tempfile
+import time
+
+from sync import file_info
+
+_DEFAULT_SIZE_MB = 256
+_REPEAT = 3
+
+
+def _write_test_file(path, size_mb):
+  block = os.urandom(1024 * 1024)
+  with open(path, 'wb') as f:
+    for i in xrange(size_mb):
+      f.write(block)
+
+
+# Usage: python benchmark.py benchmarks/bench_hash_algorithms [size_mb]
+def main(argv):
+  size_mb = int(argv[0]) if argv else _DEFAULT_SIZE_MB
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    path = os.path.join(tmp_dir, 'data')
+    _write_test_file(path, size_mb)
+    # Warm up the page cache so that the disk speed is excluded
+    file_info._calculate_hash(path)
+    print 'Hash a %s MB file, best of %s runs' % (size_mb, _REPEAT)
+    for algorithm in file_info.HASH_ALGORITHMS:
+      best = None
+      for i in xrange(_REPEAT):
+        tstart = time.time()
+        file_info._calculate_hash(path, algorithm=algorithm)
+        elapsed = time.time() - tstart
+        best = elapsed if best is None else min(best, elapsed)
+      print '%-10s %8.3f s %10.1f MB/s' % (
+          algorithm, best, size_mb / max(best, 1e-9))
+  finally:
+    shutil.rmtree(tmp_dir)
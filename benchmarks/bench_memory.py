@@ -0,0 +1,95 @@
+import itertools
+import multiprocessing
+import os
+import resource
+
+from sync import columnar_dir_info
+from sync import file_info
+from sync import path_trie
+from util import util
+
+_DEFAULT_FILE_COUNT = 200000
+_FILES_PER_DIR = 100
+
+
+# FileInfo before __slots__ and path_trie, for comparison
+class _LegacyFileInfo:
+
+  def __init__(
+      self, path, is_dir, mode, size, last_modified_time, file_hash=None,
+      tmp_file=None, compressed_file_info=None, original_file_info=None):
+    self.path = path
+    self.is_dir = is_dir
+    self.mode = mode
+    self.size = size
+    self.last_modified_time = last_modified_time
+    self.file_hash = file_hash
+    self.tmp_file = tmp_file
+    self.compressed_file_info = compressed_file_info
+    self.original_file_info = original_file_info
+
+  def path_for_sorting(self):
+    return util.path_for_sorting(self.path)
+
+  # The key of the entries of DirInfo
+  @property
+  def _name(self):
+    return path_trie.name_of(self.path)
+
+
+def _rss_bytes():
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1]) * resource.getpagesize()
+  except IOError:
+    # Max RSS in KB on Linux, which only works as the usage only grows here
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _generate_file_info(file_info_class, file_count):
+  for i in xrange(file_count):
+    if i % _FILES_PER_DIR == 0:
+      dir_path = os.path.join('.', 'dir%08d' % (i / _FILES_PER_DIR))
+      yield file_info_class(dir_path, True, 040755, -1, 1400000000.0 + i)
+    path = os.path.join(dir_path, 'file%08d.txt' % i)
+    compressed = file_info_class(
+        path + '.boxwrap.zip', False, 0100644, 1000 + i, 1400000000.0 + i,
+        '%040x' % (i * 7919))
+    yield file_info_class(
+        path, False, 0100644, 2000 + i, 1400000000.0 + i, '%040x' % i,
+        compressed_file_info=compressed)
+
+
+# Build the state of a sync, i.e. the file info with compressed file info of
+# file_count files, and report the memory used.
+def _measure(name, file_count, queue):
+  rss_before = _rss_bytes()
+  if name == 'legacy':
+    dir_info = file_info.load_dir_info_from_file_info_list(
+        '.', list(_generate_file_info(_LegacyFileInfo, file_count)))
+  elif name == 'slots':
+    dir_info = file_info.load_dir_info_from_file_info_list(
+        '.', list(_generate_file_info(file_info.FileInfo, file_count)))
+  else:
+    root = file_info.FileInfo('.', True, 040755, None, 1400000000.0)
+    dir_info = columnar_dir_info.columnar_dir_info_from_file_info_list(
+        '.', itertools.chain(
+            [root], _generate_file_info(file_info.FileInfo, file_count)))
+  queue.put(_rss_bytes() - rss_before)
+  del dir_info
+
+
+# Usage: python benchmark.py benchmarks/bench_memory [file_count]
+def main(argv):
+  file_count = int(argv[0]) if argv else _DEFAULT_FILE_COUNT
+  print 'Memory of the state with %s files' % file_count
+  for name in ['legacy', 'slots', 'columnar']:
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_measure,
+                                args=(name, file_count, queue))
+    p.start()
+    used = queue.get()
+    p.join()
+    print '%-8s %10.1f MB %8.1f bytes/file %10.1f MB per 2M files' % (
+        name, used / 1048576.0, used / float(file_count),
+        used / float(file_count) * 2000000 / 1048576.0)
@@ -0,0 +1,56 @@
+import os
+import tempfile
+import time
+
+import cStringIO
+
+import bench_dir_info_build
+from sync import file_info
+from util import i18n
+
+_DEFAULT_FILE_COUNT = 1000000
+
+
+# The writer and reader before the streaming ones, for comparison
+def _legacy_write_to_csv(dir_info, f):
+  for entry in dir_info.flat_file_info_list():
+    entry.calculate_hash()
+    f.write(entry.to_csv())
+    f.write('\n')
+
+
+def _legacy_load_dir_info_from_csv(f, base_dir):
+  return file_info.load_dir_info_from_file_info_list(
+      base_dir, (file_info.load_from_csv_row(row)
+                 for row in i18n.UnicodeReader(f) if len(row) >= 6))
+
+
+def _streaming_write_to_csv(dir_info, f):
+  dir_info.write_to_csv(f)
+
+
+# Usage: python benchmark.py benchmarks/bench_state_csv [file_count]
+def main(argv):
+  file_count = int(argv[0]) if argv else _DEFAULT_FILE_COUNT
+  dir_info = file_info.load_dir_info_from_csv(cStringIO.StringIO(
+      bench_dir_info_build._generate_csv(file_count)), '.')
+  fd, path = tempfile.mkstemp(suffix='.csv')
+  os.close(fd)
+  try:
+    print 'Write and load the state of %s rows' % len(
+        list(dir_info.flat_file_info_list()))
+    for name, write, load in [
+        ('legacy', _legacy_write_to_csv, _legacy_load_dir_info_from_csv),
+        ('streaming', _streaming_write_to_csv,
+         file_info.load_dir_info_from_csv)]:
+      tstart = time.time()
+      with open(path, 'wb') as f:
+        write(dir_info, f)
+      twrite = time.time() - tstart
+      tstart = time.time()
+      with open(path, 'rb') as f:
+        load(f, '.')
+      tload = time.time() - tstart
+      print '%-10s write %8.3f s  load %8.3f s' % (name, twrite, tload)
+  finally:
+    os.remove(path)
@@ -0,0 +1,50 @@
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import cStringIO
+
+import bench_dir_info_build
+from sync import file_info
+from sync import state_store
+
+_DEFAULT_FILE_COUNT = 1000000
+_LOOKUPS = 1000
+
+
+# Usage: python benchmark.py benchmarks/bench_state_load [file_count]
+def main(argv):
+  file_count = int(argv[0]) if argv else _DEFAULT_FILE_COUNT
+  dir_info = file_info.load_dir_info_from_csv(cStringIO.StringIO(
+      bench_dir_info_build._generate_csv(file_count)), '.')
+  paths = [x.path for x in dir_info.flat_file_info_list()]
+  lookup_paths = random.Random(0).sample(paths, min(_LOOKUPS, len(paths)))
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    print 'Load the state of %s rows and look up %s paths' % (
+        len(paths), len(lookup_paths))
+    for name, store in [
+        ('csv', state_store.CsvStateStore(os.path.join(tmp_dir, 'state.csv'))),
+        ('binary', state_store.BinaryStateStore(
+            os.path.join(tmp_dir, 'state.bin'))),
+        # As boxwrap builds the store of profile_dir
+        ('journal', state_store.JournaledStateStore(
+            state_store.BinaryStateStore(
+                os.path.join(tmp_dir, 'journaled.bin')),
+            os.path.join(tmp_dir, 'journal.csv')))]:
+      tstart = time.time()
+      store.save(dir_info)
+      tsave = time.time() - tstart
+      tstart = time.time()
+      loaded = store.load('.', columnar=True)
+      tload = time.time() - tstart
+      tstart = time.time()
+      for path in lookup_paths:
+        loaded.get(path)
+      tlookup = time.time() - tstart
+      print '%-8s save %8.3f s  load %8.3f s  lookups %8.3f s' % (
+          name, tsave, tload, tlookup)
+  finally:
+    shutil.rmtree(tmp_dir)
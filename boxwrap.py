@@ -7,9 +7,13 @@ import hashlib
 import os
 import shutil
 import sys
+import time
 
 import main
 from sync import file_info
+from sync import hash_cache
+from sync import state_store
+from sync import watch
 
 
 # Maximum rounds of sync from a single round. We may need two or more rounds
@@ -19,10 +23,19 @@ _MAX_ROUND_SYNC=5
 
 _PROFILE_INFO_FILE='profile.ini'
 _PROFILE_DIR_INFO_FILE='profile_dir.csv'
+_PROFILE_DIR_INFO_DB_FILE='profile_dir.sqlite'
+_PROFILE_DIR_INFO_BINARY_FILE='profile_dir.bin'
+_PROFILE_DIR_INFO_JOURNAL_FILE='profile_dir.journal'
+_PROFILE_WORKING_HASH_CACHE_FILE='profile_working_hash.csv'
+_PROFILE_WRAP_HASH_CACHE_FILE='profile_wrap_hash.csv'
 _PROFILE_TMP_DIR='tmp'
 
 _PROFILE_INFO_SECTION='BoxWrap'
 
+# Seconds between two full scans in watch mode, in case any change is missed
+# by the watchers.
+_DEFAULT_FULL_SCAN_INTERVAL=3600
+
 _ENCRYPTION_CHOICES=collections.OrderedDict([
     ('zipcrypto', compression.ENCRYPTION_ZIP_CRYPTO),
     ('aes128', compression.ENCRYPTION_AES_128),
@@ -67,6 +80,65 @@ def _parse_args():
       default='zipcrypto',
       choices=_ENCRYPTION_CHOICES.keys(),
       help='Encryption method to be speficied to 7-zip. Zipcrypto has most compatability but less secure.[default=zipcrypto]')
+  parser.add_argument(
+      '--hash_chunk_size', dest='hash_chunk_size', type=int,
+      default=file_info.DEFAULT_HASH_CHUNK_SIZE,
+      help='Size in bytes of the chunks read to hash a file.[default=%s]' % file_info.DEFAULT_HASH_CHUNK_SIZE)
+  parser.add_argument(
+      '--hash_mmap_threshold', dest='hash_mmap_threshold', type=int,
+      default=file_info.DEFAULT_HASH_MMAP_THRESHOLD,
+      help='Files of at least this size in bytes are hashed via mmap, 0 to disable mmap.[default=%s]' % file_info.DEFAULT_HASH_MMAP_THRESHOLD)
+  parser.add_argument(
+      '--hash_algorithm', dest='hash_algorithm',
+      default=file_info.DEFAULT_HASH_ALGORITHM,
+      choices=file_info.HASH_ALGORITHMS,
+      help='Algorithm to hash file content for change detection. Crc32 and adler32 are fast but not cryptographic.[default=%s]' % file_info.DEFAULT_HASH_ALGORITHM)
+  parser.add_argument(
+      '-j', dest='hash_workers', type=int, default=1,
+      help='Number of workers to hash files in parallel.[default=1]')
+  parser.add_argument(
+      '--hash_backend', dest='hash_backend',
+      default=file_info.HASH_BACKEND_THREAD,
+      choices=[file_info.HASH_BACKEND_THREAD, file_info.HASH_BACKEND_PROCESS],
+      help='Run the hash workers in threads for disk bound hashing, or in processes for CPU bound hashing.[default=%s]' % file_info.HASH_BACKEND_THREAD)
+  parser.add_argument(
+      '--verify', dest='verify', action='store_true',
+      help='Rehash every file instead of trusting the hash cache in profile.')
+  parser.add_argument(
+      '--fingerprint', dest='fingerprint', action='store_true',
+      help='Keep the hash of a file whose stat changes but not its size or the samples of its head, middle and tail, e.g. when only its mtime is touched.')
+  parser.add_argument(
+      '--fingerprint_verify_days', dest='fingerprint_verify_days',
+      type=float, default=hash_cache.DEFAULT_FINGERPRINT_VERIFY_DAYS,
+      help='With --fingerprint, days after which a file whose stat changes is rehashed in full regardless of its samples.[default=%s]' % hash_cache.DEFAULT_FINGERPRINT_VERIFY_DAYS)
+  parser.add_argument(
+      '--snapshot_free', dest='snapshot_free', action='store_true',
+      help='Compress the changed files straight from working_dir instead of from copies in profile, and only copy those modified during the compression.')
+  parser.add_argument(
+      '--no_move_detection', dest='detect_moves', action='store_false',
+      help='Compress the files moved or renamed in working_dir again as new files, instead of renaming their archives in wrap_dir.')
+  parser.add_argument(
+      '--state_format', dest='state_format',
+      default=state_store.STATE_FORMAT_CSV,
+      choices=state_store.STATE_FORMATS,
+      help='Format to store the directories information in profile. Sqlite only writes the changed files after each sync, binary is loaded in constant time by mmap, and an existing state is migrated to it.[default=%s]' % state_store.STATE_FORMAT_CSV)
+  parser.add_argument(
+      '--columnar_state', dest='columnar_state', action='store_true',
+      help='Load the directories information in profile into compact columns, which saves memory for millions of files.')
+  parser.add_argument(
+      '--watch', dest='watch', action='store_true',
+      help='Keep running and sync the changes in working_dir and wrap_dir as they happen, using inotify on Linux or polling elsewhere.')
+  parser.add_argument(
+      '--debounce', dest='debounce', type=float, default=watch.DEFAULT_DEBOUNCE,
+      help='In watch mode, seconds without changes to wait for before sync.[default=%s]' % watch.DEFAULT_DEBOUNCE)
+  parser.add_argument(
+      '--poll_interval', dest='poll_interval', type=float,
+      default=watch.DEFAULT_POLL_INTERVAL,
+      help='In watch mode without inotify, seconds between two polls for changes.[default=%s]' % watch.DEFAULT_POLL_INTERVAL)
+  parser.add_argument(
+      '--full_scan_interval', dest='full_scan_interval', type=float,
+      default=_DEFAULT_FULL_SCAN_INTERVAL,
+      help='In watch mode, seconds between two full scans of both directories.[default=%s]' % _DEFAULT_FULL_SCAN_INTERVAL)
   return parser.parse_args()
 
 
@@ -109,6 +181,10 @@ def _validate_args_and_update_profile(args):
   force_new_password = args.force_new_password
   encryption_method = args.encryption_method
   compression_level = args.compression_level
+  hash_chunk_size = args.hash_chunk_size
+  hash_mmap_threshold = args.hash_mmap_threshold
+  hash_algorithm = args.hash_algorithm
+  state_format = args.state_format
 
   wrap_dir = args.wrap_dir
   if os.path.isfile(profile_dir):
@@ -179,6 +255,38 @@ def _validate_args_and_update_profile(args):
         rewrite_profile_info = True
     else:
       rewrite_profile_info = True
+    if profile_info.has_option(_PROFILE_INFO_SECTION, 'hash_chunk_size'):
+      hash_chunk_size = profile_info.getint(_PROFILE_INFO_SECTION,
+                                            'hash_chunk_size')
+    else:
+      rewrite_profile_info = True
+    if profile_info.has_option(_PROFILE_INFO_SECTION, 'hash_mmap_threshold'):
+      hash_mmap_threshold = profile_info.getint(_PROFILE_INFO_SECTION,
+                                                'hash_mmap_threshold')
+    else:
+      rewrite_profile_info = True
+    if profile_info.has_option(_PROFILE_INFO_SECTION, 'hash_algorithm'):
+      hash_algorithm2 = profile_info.get(_PROFILE_INFO_SECTION,
+                                         'hash_algorithm')
+      if hash_algorithm2 in file_info.HASH_ALGORITHMS:
+        hash_algorithm = hash_algorithm2
+      else:
+        rewrite_profile_info = True
+    else:
+      rewrite_profile_info = True
+    if profile_info.has_option(_PROFILE_INFO_SECTION, 'state_format'):
+      state_format2 = profile_info.get(_PROFILE_INFO_SECTION, 'state_format')
+      if state_format2 in state_store.STATE_FORMATS:
+        state_format = state_format2
+      else:
+        rewrite_profile_info = True
+    else:
+      rewrite_profile_info = True
+
+  if hash_chunk_size <= 0:
+    print >>sys.stderr, 'Error:'
+    print >>sys.stderr, 'hash_chunk_size should be positive'
+    sys.exit()
 
   working_dir = os.path.abspath(working_dir)
   wrap_dir = os.path.abspath(wrap_dir)
@@ -223,6 +331,14 @@ def _validate_args_and_update_profile(args):
         _PROFILE_INFO_SECTION, 'encryption_method', encryption_method)
     new_profile_info.set(
         _PROFILE_INFO_SECTION, 'compression_level', compression_level)
+    new_profile_info.set(
+        _PROFILE_INFO_SECTION, 'hash_chunk_size', hash_chunk_size)
+    new_profile_info.set(
+        _PROFILE_INFO_SECTION, 'hash_mmap_threshold', hash_mmap_threshold)
+    new_profile_info.set(
+        _PROFILE_INFO_SECTION, 'hash_algorithm', hash_algorithm)
+    new_profile_info.set(
+        _PROFILE_INFO_SECTION, 'state_format', state_format)
     with open(os.path.join(profile_dir, _PROFILE_INFO_FILE), 'wb') as f:
         new_profile_info.write(f)
 
@@ -238,7 +354,23 @@ def _validate_args_and_update_profile(args):
       'wrap_dir': wrap_dir,
       'password': password,
       'encryption_method': encryption_method,
-      'compression_level': compression_level}
+      'compression_level': compression_level,
+      'hash_chunk_size': hash_chunk_size,
+      'hash_mmap_threshold': hash_mmap_threshold,
+      'hash_algorithm': hash_algorithm,
+      'state_format': state_format,
+      'hash_workers': args.hash_workers,
+      'hash_backend': args.hash_backend,
+      'verify': args.verify,
+      'fingerprint': args.fingerprint,
+      'fingerprint_verify_days': args.fingerprint_verify_days,
+      'snapshot_free': args.snapshot_free,
+      'detect_moves': args.detect_moves,
+      'columnar_state': args.columnar_state,
+      'watch': args.watch,
+      'debounce': args.debounce,
+      'poll_interval': args.poll_interval,
+      'full_scan_interval': args.full_scan_interval}
 
 
 def _calculate_password_hash(password, profile):
@@ -253,6 +385,55 @@ def _clean_up_tmp_dir(profile_dir):
       [os.path.join(profile_tmp_dir,f) for f in os.listdir(profile_tmp_dir)])
 
 
+def _load_hash_cache(hash_cache_file, args):
+  kwargs = {
+      'force_verify': args['verify'],
+      'fingerprint': args['fingerprint'],
+      'fingerprint_verify_days': args['fingerprint_verify_days']}
+  if os.path.isfile(hash_cache_file):
+    with open(hash_cache_file, 'rb') as f:
+      return hash_cache.load_hash_cache_from_csv(f, **kwargs)
+  return hash_cache.HashCache(**kwargs)
+
+
+# Only prune after a full scan, as the files skipped by a scan restricted to
+# dirty paths are not looked up.
+def _write_hash_cache(hash_cache_file, cache, prune=True):
+  if prune:
+    cache.prune()
+  with open(hash_cache_file, 'wb') as f:
+    cache.write_to_csv(f)
+
+
+# Open the store of the dir info in profile, in state_format, with the
+# journal of the changes since it is saved. The state in another format, if
+# any, is migrated once.
+def _open_dir_info_store(profile_dir, state_format):
+  csv_file = os.path.join(profile_dir, _PROFILE_DIR_INFO_FILE)
+  db_file = os.path.join(profile_dir, _PROFILE_DIR_INFO_DB_FILE)
+  binary_file = os.path.join(profile_dir, _PROFILE_DIR_INFO_BINARY_FILE)
+  journal_file = os.path.join(profile_dir, _PROFILE_DIR_INFO_JOURNAL_FILE)
+  for path in [csv_file, db_file, binary_file, journal_file]:
+    if os.path.isdir(path):
+      shutil.rmtree(path)
+  stores = {
+      state_store.STATE_FORMAT_CSV: state_store.CsvStateStore(csv_file),
+      state_store.STATE_FORMAT_SQLITE: state_store.SqliteStateStore(db_file),
+      state_store.STATE_FORMAT_BINARY:
+          state_store.BinaryStateStore(binary_file)}
+  store = stores.pop(state_format)
+  for other_store in stores.values():
+    if (not store.exists() and other_store.exists()
+        and os.path.isfile(journal_file)):
+      # The journal belongs to the state in the other format
+      state_store.JournaledStateStore(other_store, journal_file).load('.')
+    if state_store.migrate_state(other_store, store, '.'):
+      print >>sys.stderr, 'Migrated directories information from %s to %s' % (
+          other_store.path, store.path)
+    other_store.close()
+  return state_store.JournaledStateStore(store, journal_file)
+
+
 def _human_readable_size(size):
   if size >= 1024 * 1024 * 1024:
     return '%.2fGB' % (size / (1024 * 1024 * 1024.0))
@@ -264,60 +445,156 @@ def _human_readable_size(size):
     return '%s' % size
 
 
+# Sync in rounds until no changes. In watch mode, only the paths given by the
+# watchers are scanned, and the changes made by each round are picked up by
+# the watchers for the next round. Return has_changes, working_di, wrap_di
+# and the dir info last saved to profile.
+def _sync_rounds(boxwrap, dir_info, dir_info_store, watchers=None,
+                 working_dirty_paths=None, wrap_dirty_paths=None):
+  for i in range(_MAX_ROUND_SYNC):
+    print >>sys.stderr, 'Performing sync and merge round #%s' % (i + 1)
+    has_changes, working_di, wrap_di = boxwrap.sync(
+        dir_info, verbose=True, working_dirty_paths=working_dirty_paths,
+        cloud_dirty_paths=wrap_dirty_paths,
+        on_applied=dir_info_store.on_applied,
+        old_scan_time_ns=dir_info_store.saved_time_ns())
+    if not has_changes:
+      break
+    dir_info_store.save(working_di)
+    dir_info = working_di
+    if watchers:
+      for w in watchers:
+        w.read_events(force=True)
+      working_dirty_paths, unused = watchers[0].pop_changes()
+      wrap_dirty_paths, unused = watchers[1].pop_changes()
+  return has_changes, working_di, wrap_di, dir_info
+
+
+def _print_summary(has_changes, working_di, wrap_di):
+  working_size = 0
+  for fi in working_di.flat_file_info_list():
+    if not fi.is_dir:
+      working_size += fi.size
+  wrap_size = 0
+  for fi in wrap_di.flat_file_info_list():
+    if not fi.is_dir:
+      wrap_size += fi.compressed_file_info.size
+
+  print 'Working dir size: %s' % _human_readable_size(working_size)
+  print 'Wrap dir size: %s' % _human_readable_size(wrap_size)
+  if working_size > 0:
+    print 'Save space: %.2g%%' % (
+        (working_size - wrap_size) * 100.0 / working_size)
+
+  if has_changes:
+    print 'Sync is incomplete, you may run again to complete sync.'
+  else:
+    print 'No changes are found. Sync is completed.'
+
+
+# Sync whenever the watchers of working_dir and wrap_dir report changes, until
+# interrupted. A full scan is done first, then periodically, and whenever the
+# watchers may have lost changes.
+def _watch(boxwrap, dir_info, dir_info_store, args,
+           working_hash_cache, working_hash_cache_file, wrap_hash_cache,
+           wrap_hash_cache_file):
+  watchers = [
+      watch.create_watcher(args['working_dir'],
+                           poll_interval=args['poll_interval']),
+      watch.create_watcher(args['wrap_dir'],
+                           poll_interval=args['poll_interval'])]
+  try:
+    working_dirty_paths = None
+    wrap_dirty_paths = None
+    while True:
+      full_scan = working_dirty_paths is None or wrap_dirty_paths is None
+      if full_scan:
+        working_dirty_paths = None
+        wrap_dirty_paths = None
+        last_full_scan = time.time()
+      has_changes, working_di, wrap_di, dir_info = _sync_rounds(
+          boxwrap, dir_info, dir_info_store, watchers=watchers,
+          working_dirty_paths=working_dirty_paths,
+          wrap_dirty_paths=wrap_dirty_paths)
+      _write_hash_cache(working_hash_cache_file, working_hash_cache,
+                        prune=full_scan)
+      _write_hash_cache(wrap_hash_cache_file, wrap_hash_cache,
+                        prune=full_scan)
+      _clean_up_tmp_dir(args['profile_dir'])
+      _print_summary(has_changes, working_di, wrap_di)
+      print 'Watching for changes. Press Ctrl+C to stop.'
+
+      working_dirty_paths = set()
+      wrap_dirty_paths = set()
+      while (not working_dirty_paths and not wrap_dirty_paths
+             and working_dirty_paths is not None
+             and wrap_dirty_paths is not None):
+        timeout = args['full_scan_interval'] - (time.time() - last_full_scan)
+        if (timeout <= 0 or
+            not watch.wait_for_changes(watchers, debounce=args['debounce'],
+                                       timeout=timeout)):
+          # Time for a full scan
+          working_dirty_paths = None
+          break
+        working_dirty_paths, unused = watchers[0].pop_changes()
+        wrap_dirty_paths, unused = watchers[1].pop_changes()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    for w in watchers:
+      w.close()
+
+
 def _boxwrap():
   args = _validate_args_and_update_profile(_parse_args())
   password = args['password']
-  profile_dir_info_file = os.path.join(
-      args['profile_dir'], _PROFILE_DIR_INFO_FILE)
+  file_info.configure_hashing(chunk_size=args['hash_chunk_size'],
+                              mmap_threshold=args['hash_mmap_threshold'],
+                              algorithm=args['hash_algorithm'])
   _clean_up_tmp_dir(args['profile_dir'])
-  if os.path.isdir(profile_dir_info_file):
-    shutil.rmtree(profile_dir_info_file)
-  if os.path.isfile(profile_dir_info_file):
-    dir_info = file_info.load_dir_info_from_csv(
-        open(profile_dir_info_file), '.')
-  else:
+  dir_info_store = _open_dir_info_store(args['profile_dir'],
+                                        args['state_format'])
+  dir_info = None
+  if dir_info_store.exists():
+    dir_info = dir_info_store.load('.', columnar=args['columnar_state'])
+  if dir_info is None:
     dir_info = file_info.empty_dir_info('.')
+  working_hash_cache_file = os.path.join(
+      args['profile_dir'], _PROFILE_WORKING_HASH_CACHE_FILE)
+  wrap_hash_cache_file = os.path.join(
+      args['profile_dir'], _PROFILE_WRAP_HASH_CACHE_FILE)
+  working_hash_cache = _load_hash_cache(working_hash_cache_file, args)
+  wrap_hash_cache = _load_hash_cache(wrap_hash_cache_file, args)
   try:
     boxwrap = main.BoxWrap(
         args['working_dir'], args['wrap_dir'],
         os.path.join(args['profile_dir'], _PROFILE_TMP_DIR),
-        profile_dir_info_file,
+        dir_info_store.path,
         password=password,
         encryption_method=_ENCRYPTION_CHOICES[args['encryption_method']],
-        compression_level=_COMPRESSION_CHOICES[args['compression_level']])
-    for i in range(_MAX_ROUND_SYNC):
-      print >>sys.stderr, 'Performing sync and merge round #%s' % (i + 1)
-      has_changes, working_di, wrap_di = boxwrap.sync(dir_info, verbose=True)
-      if not has_changes:
-        break
-      with open(profile_dir_info_file, 'wb') as f:
-        working_di.write_to_csv(f)
-      dir_info = working_di
-
-    working_size = 0
-    for fi in working_di.flat_file_info_list():
-      if not fi.is_dir:
-        working_size += fi.size
-    wrap_size = 0
-    for fi in wrap_di.flat_file_info_list():
-      if not fi.is_dir:
-        wrap_size += fi.compressed_file_info.size
-
-    print 'Working dir size: %s' % _human_readable_size(working_size)
-    print 'Wrap dir size: %s' % _human_readable_size(wrap_size)
-    if working_size > 0:
-      print 'Save space: %.2g%%' % (
-          (working_size - wrap_size) * 100.0 / working_size)
-
-    if has_changes:
-      print 'Sync is incomplete, you may run again to complete sync.'
+        compression_level=_COMPRESSION_CHOICES[args['compression_level']],
+        working_hash_cache=working_hash_cache,
+        cloud_hash_cache=wrap_hash_cache,
+        hash_workers=args['hash_workers'],
+        hash_backend=args['hash_backend'],
+        snapshot_free=args['snapshot_free'],
+        detect_moves=args['detect_moves'])
+    if args['watch']:
+      _watch(boxwrap, dir_info, dir_info_store, args,
+             working_hash_cache, working_hash_cache_file, wrap_hash_cache,
+             wrap_hash_cache_file)
     else:
-      print 'No changes are found. Sync is completed.'
+      has_changes, working_di, wrap_di, dir_info = _sync_rounds(
+          boxwrap, dir_info, dir_info_store)
+      _write_hash_cache(working_hash_cache_file, working_hash_cache)
+      _write_hash_cache(wrap_hash_cache_file, wrap_hash_cache)
+      _print_summary(has_changes, working_di, wrap_di)
   except compression.CompressionException as e:
     print >>sys.stderr, (
         '%s. The archive %s is not able to be decompressed.' %
         e.get_message(), e.path)
   finally:
+    dir_info_store.close()
     _clean_up_tmp_dir(args['profile_dir'])
 
 
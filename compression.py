@@ -4,6 +4,9 @@ import platform
 import shutil
 import subprocess
 import sys
+import tempfile
+import time
+import zipfile
 
 PROGRAM_COMMON = 'boxwrap'
 COMPRESSED_FILENAME_SUFFIX = '.%s.zip' % PROGRAM_COMMON
@@ -248,6 +251,69 @@ def decompress_file(src_file, dest_file, tmp_dir,
     else:
       raise CompressionException(e.returncode)
 
+_STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+# Decompress src_file to dest_file as decompress_file, and update hash_obj
+# with the content as it is written, so that the output is not read again to
+# be hashed. The file is streamed through the stdout of 7za, and its mtime is
+# set from the archive as 7za sets it when extracted.
+# @return   output filename, if success; None and exceptions otherwise.
+def decompress_file_with_hash(src_file, dest_file, tmp_dir, hash_obj,
+                              password=None):
+  try:
+    archive = zipfile.ZipFile(src_file)
+    entries = archive.infolist()
+    archive.close()
+  except (zipfile.BadZipfile, EnvironmentError):
+    raise CompressionInvalidArchive(0, src_file)
+  if len(entries) != 1:
+    # Not written by compress_file, extract it as usual
+    decompress_file(src_file, dest_file, tmp_dir, password=password)
+    with open(dest_file, 'rb') as f:
+      while True:
+        chunk = f.read(_STREAM_CHUNK_SIZE)
+        if not chunk:
+          break
+        hash_obj.update(chunk)
+    return dest_file
+
+  params = [os.path.join(ZIP_PATH, ZIP_BIN), 'e', '-so',
+            '-p%s' % (password or INVALID_PASSWORD), src_file]
+  # stderr goes to a file rather than a pipe, which 7za could fill and
+  # block on while stdout is drained
+  with tempfile.TemporaryFile(dir=tmp_dir) as stderr_file:
+    process = subprocess.Popen(params, shell=False,
+                               stderr=stderr_file,
+                               stdout=subprocess.PIPE)
+    with open(dest_file, 'wb') as f:
+      while True:
+        chunk = process.stdout.read(_STREAM_CHUNK_SIZE)
+        if not chunk:
+          break
+        hash_obj.update(chunk)
+        f.write(chunk)
+    process.wait()
+    stderr_file.seek(0)
+    output = stderr_file.read()
+  if process.returncode != 0:
+    os.remove(dest_file)
+    if 'Can not open file as archive' in output:
+      raise CompressionInvalidArchive(process.returncode, src_file,
+                                      output=output)
+    elif 'Wrong password?' in output:
+      raise CompressionWrongPassword(process.returncode, src_file,
+                                     output=output)
+    elif RETURN_CODE_EXCEPTION_MAP.has_key(process.returncode):
+      raise RETURN_CODE_EXCEPTION_MAP[process.returncode](
+          process.returncode, src_file, output=output)
+    else:
+      raise CompressionException(process.returncode, src_file, output=output)
+  # The DOS time of zip in local time
+  mtime = time.mktime(entries[0].date_time + (0, 0, -1))
+  os.utime(dest_file, (mtime, mtime))
+  return dest_file
+
 def decompress_recursively(path, src_base_path, dest_base_path, tmp_dir,
                            password=None):
   src_total_path = os.path.join(src_base_path, path)
@@ -8,16 +8,26 @@ import time
 import compression
 from sync import change_entry
 from sync import file_info
+from sync import hash_cache
 from sync import merge
+from sync import snapshot
 from util import util
 
+# A file modified this recently before its compression starts may be written
+# during the compression without a change of its mtime, as the mtime of some
+# file systems has a coarse granularity.
+_RACY_MTIME_NS = 2000000000
+
 
 class BoxWrap:
 
   def __init__(self, working_dir, cloud_dir, tmp_dir, file_info_csv_file,
                reinit=False, password=None,
                compression_level=compression.COMPRESSION_LEVEL_NORMAL,
-               encryption_method=compression.ENCRYPTION_ZIP_CRYPTO):
+               encryption_method=compression.ENCRYPTION_ZIP_CRYPTO,
+               working_hash_cache=None, cloud_hash_cache=None,
+               hash_workers=1, hash_backend=file_info.HASH_BACKEND_THREAD,
+               snapshot_free=False, detect_moves=True):
     self.working_dir = working_dir
     self.cloud_dir = cloud_dir
     self.tmp_dir = tmp_dir
@@ -25,6 +35,21 @@ class BoxWrap:
     self.password = password
     self.encryption_method = encryption_method
     self.compression_level = compression_level
+    # Hash caches of working_dir and cloud_dir, None to always rehash
+    self.working_hash_cache = working_hash_cache
+    self.cloud_hash_cache = cloud_hash_cache
+    self.hash_workers = hash_workers
+    self.hash_backend = hash_backend
+    # Compress the changed files straight from working_dir rather than from
+    # snapshots in tmp_dir, and only snapshot the files changed meanwhile.
+    self.snapshot_free = snapshot_free
+    # Number of files compressed in place, and of those fallen back to
+    # snapshots, in the last sync
+    self.compressed_in_place = 0
+    self.snapshot_fallbacks = 0
+    # Pair the files and dirs moved in working_dir with their old ones, and
+    # rename their archives in wrap_dir rather than compress them again.
+    self.detect_moves = detect_moves
     self.compression_key = lambda x: util.path_for_sorting(
         compression.get_original_filename(x.path))
 
@@ -49,9 +74,25 @@ class BoxWrap:
         return False
     return True
 
-  def sync(self, old_dir_info, debug=False, verbose=False):
+  # If working_dirty_paths or cloud_dirty_paths is given, e.g. by a watcher,
+  # only the dirs on the way to these paths are scanned in the corresponding
+  # dir, and the rest is assumed unchanged since old_dir_info.
+  #
+  # If old_scan_time_ns is given, e.g. the mtime of the state file, the
+  # listings of the dirs of working_dir unchanged since old_dir_info are
+  # reused. See file_info.load_dir_info.
+  #
+  # If on_applied is given, it is called with the path and the new state of
+  # the path, or None if deleted, as soon as a merged change of the path is
+  # applied to both dirs, e.g. to keep the progress of an interrupted sync.
+  def sync(self, old_dir_info, debug=False, verbose=False,
+           working_dirty_paths=None, cloud_dirty_paths=None, on_applied=None,
+           old_scan_time_ns=None):
     tstart = time.time()
     cwd = os.getcwd()
+    snapshot.reset()
+    self.compressed_in_place = 0
+    self.snapshot_fallbacks = 0
     working_old_di = old_dir_info
     cloud_old_di = self._extract_compressed_dir_info(old_dir_info)
     if debug:
@@ -63,13 +104,17 @@ class BoxWrap:
       print 'Phase %s: Examine changes on working_dir at %s' % (
           phase, self.working_dir)
     os.chdir(self.working_dir)
-    working_cur_di = file_info.load_dir_info('.', calculate_hash=True)
-    working_dc = change_entry.get_dir_changes(working_cur_di, working_old_di,
-                                              root_dir=self.working_dir,
-                                              tmp_dir=self.tmp_dir,
-                                              verbose=verbose)
+    working_cur_di = file_info.load_dir_info(
+        '.', calculate_hash=True, hash_cache=self.working_hash_cache,
+        hash_workers=self.hash_workers, hash_backend=self.hash_backend,
+        old_dir_info=working_old_di, dirty_paths=working_dirty_paths,
+        defer_hash=not self.snapshot_free, old_scan_time_ns=old_scan_time_ns)
+    working_dc = change_entry.get_dir_changes(
+        working_cur_di, working_old_di, root_dir=self.working_dir,
+        tmp_dir=None if self.snapshot_free else self.tmp_dir,
+        verbose=verbose, detect_moves=self.detect_moves)
+    self._put_deferred_hashes(self.working_hash_cache, working_dc)
     is_working_no_change = self._is_no_change(working_dc)
-    working_dc = self._generate_compressed_dir_changes(working_dc)
     if debug:
       print '============== Latency after examing working_dir: %s s' % (
          time.time() - tstart)
@@ -80,13 +125,22 @@ class BoxWrap:
       print 'Phase %s: Examine changes on wrap_dir at %s' % (
           phase, self.cloud_dir)
     os.chdir(self.cloud_dir)
+    # The dirs of cloud_old_di have the mtimes of working_dir, as the state
+    # keeps no others, so the listings of wrap_dir are always read again.
     cloud_cur_di = file_info.load_dir_info(
-        '.', calculate_hash=True, key=self.compression_key)
+        '.', calculate_hash=True, key=self.compression_key,
+        hash_cache=self.cloud_hash_cache, hash_workers=self.hash_workers,
+        hash_backend=self.hash_backend, old_dir_info=cloud_old_di,
+        dirty_paths=cloud_dirty_paths, defer_hash=True)
     cloud_dc = change_entry.get_dir_changes(cloud_cur_di, cloud_old_di,
                                             root_dir=self.cloud_dir,
                                             tmp_dir=self.tmp_dir,
                                             verbose=verbose)
+    self._put_deferred_hashes(self.cloud_hash_cache, cloud_dc)
     is_cloud_no_change = self._is_no_change(cloud_dc)
+    # Compressed once the moves are checked against the changes of wrap_dir
+    self._unpair_changed_moves(working_dc, cloud_dc, verbose=verbose)
+    working_dc = self._generate_compressed_dir_changes(working_dc)
     cloud_dc_result = self._generate_original_dir_changes(cloud_dc)
     cloud_dc = cloud_dc_result[0]
     invalid_archives_dc_working = cloud_dc_result[1]
@@ -125,17 +179,21 @@ class BoxWrap:
       self._print_changes('********** working_dc_conflict', working_dc_conflict)
       self._print_changes('********** cloud_dc_conflict', cloud_dc_conflict)
 
+    working_di = change_entry.apply_dir_changes_to_dir_info('.', working_dc_old)
+
     if has_changes and verbose:
       phase += 1
       print 'Phase %s: Apply merged changes on working_dir at %s' % (
           phase, self.working_dir)
-    change_entry.apply_dir_changes_to_dir(self.working_dir, working_dc_new,
-                                          verbose=verbose)
+    # The changes of working_dc_new are from wrap_dir, so they are applied to
+    # both dirs once applied to working_dir, and vice versa.
+    change_entry.apply_dir_changes_to_dir(
+        self.working_dir, working_dc_new, verbose=verbose,
+        on_applied=self._state_reporter(on_applied, working_di))
     change_entry.apply_dir_changes_to_dir(
         self.working_dir, working_dc_conflict,
         force_conflict=change_entry.CONFLICT_NEW,
         verbose=verbose)
-    working_di = change_entry.apply_dir_changes_to_dir_info('.', working_dc_old)
     if debug:
       print '============== Latency after applying merged changes on working_dir: %s' % (time.time() - tstart)
 
@@ -143,8 +201,9 @@ class BoxWrap:
       phase += 1
       print 'Phase %s: Apply merged changes on wrap_dir at %s' % (
           phase, self.cloud_dir)
-    change_entry.apply_dir_changes_to_dir(self.cloud_dir, cloud_dc_new,
-                                          verbose=verbose)
+    change_entry.apply_dir_changes_to_dir(
+        self.cloud_dir, cloud_dc_new, verbose=verbose,
+        on_applied=self._state_reporter(on_applied, working_di))
     change_entry.apply_dir_changes_to_dir(
         self.cloud_dir, cloud_dc_conflict,
         force_conflict=change_entry.CONFLICT_NEW,
@@ -153,12 +212,84 @@ class BoxWrap:
     if debug:
       print '============== Latency after applying merged changes on wrap_dir: %s' % (time.time() - tstart)
 
+    if has_changes and verbose:
+      print ('Snapshots of changed files: %s reflinks, %s hardlinks (%s '
+             'detached), %s copies') % (
+          snapshot.counts[snapshot.STRATEGY_REFLINK],
+          snapshot.counts[snapshot.STRATEGY_HARDLINK], snapshot.detached[0],
+          snapshot.counts[snapshot.STRATEGY_COPY])
+      if self.snapshot_free:
+        print ('Compressed in place: %s files, %s changed meanwhile and '
+               'snapshotted') % (self.compressed_in_place,
+                                 self.snapshot_fallbacks)
+
     os.chdir(cwd)
     return [has_changes, working_di, cloud_di]
 
+  # Put the hashes of the files deferred by the scan, which are calculated
+  # as they are copied into tmp files or paired into moves, into hash_cache.
+  def _put_deferred_hashes(self, hash_cache, dir_changes):
+    if hash_cache is None:
+      return
+    for c in dir_changes.flat_changes():
+      if c.cur_info and not c.cur_info.is_dir and c.cur_info.file_hash:
+        hash_cache.put_deferred(c.cur_info.path, c.cur_info.file_hash)
+
+  # Undo the moves in working_dc whose archive or dir in wrap_dir has
+  # changed, or whose path in wrap_dir is taken, since the last sync. Their
+  # files are snapshotted then, to be compressed as new files.
+  def _unpair_changed_moves(self, working_dc, cloud_dc, verbose=False):
+    cloud_statuses = None
+    for c in working_dc.flat_changes():
+      fi = change_entry.moved_file_info(c)
+      if fi is None:
+        continue
+      if cloud_statuses is None:
+        cloud_statuses = dict((x.path, x.content_status)
+                              for x in cloud_dc.flat_changes())
+      if (cloud_statuses.get(fi.moved_from.path) ==
+          change_entry.CONTENT_STATUS_NO_CHANGE and
+          fi.path not in cloud_statuses):
+        continue
+      if verbose:
+        print '%s: moved from %s, but changed in wrap_dir' % (
+            c.path, fi.moved_from.path)
+      change_entry.unpair_move(c)
+      if not self.snapshot_free and change_entry.is_copied_to_tmp_dir(c):
+        c.cur_info = change_entry.copy_to_tmp_dir(
+            self.working_dir, c.cur_info, self.tmp_dir)
+
+  # Return the on_applied callback of apply_dir_changes_to_dir which reports
+  # the state of the applied changes in state_di, or None if on_applied is
+  # None. The paths in wrap_dir are mapped back to the original ones.
+  def _state_reporter(self, on_applied, state_di):
+    if not on_applied:
+      return None
+    def report(change):
+      path = compression.get_original_filename(change.path)
+      fi = state_di.get(path)
+      if (fi is not None or
+          change.content_status == change_entry.CONTENT_STATUS_DELETED):
+        on_applied(path, fi)
+    return report
+
+  # Attach compressed_file_info to the changes with tmp files in place. With
+  # snapshot_free, the changed files are compressed from working_dir, and
+  # only those changed meanwhile are snapshotted into tmp files instead.
   def _generate_compressed_dir_changes(self, dir_changes):
-    dir_changes = copy.deepcopy(dir_changes)
     for c in dir_changes.flat_changes():
+      if self.snapshot_free and change_entry.is_copied_to_tmp_dir(c):
+        compressed_tmp_filename = change_entry.generate_tmp_file(self.tmp_dir)
+        compressed_tmp_file = os.path.join(self.tmp_dir,
+                                           compressed_tmp_filename)
+        if self._compress_in_place(c.cur_info, compressed_tmp_file):
+          self.compressed_in_place += 1
+          self._attach_compressed_file_info(c, compressed_tmp_filename)
+          continue
+        self.snapshot_fallbacks += 1
+        if os.path.exists(compressed_tmp_file):
+          os.remove(compressed_tmp_file)
+        c.cur_info = self._snapshot_working_file(c.cur_info)
       if c.cur_info and c.cur_info.tmp_file:
         compressed_tmp_filename = change_entry.generate_tmp_file(self.tmp_dir)
         compressed_tmp_file = os.path.join(self.tmp_dir,
@@ -172,18 +303,75 @@ class BoxWrap:
                                   password=self.password,
                                   encryption_method=self.encryption_method,
                                   compression_level=self.compression_level)
+        # A hardlink snapshot changes with the working file, so compress it
+        # again from a detached copy if it has changed while compressed.
+        if not snapshot.is_intact(tmp_file_with_realname):
+          snapshot.detach(tmp_file_with_realname)
+          os.remove(compressed_tmp_file)
+          compression.compress_file(tmp_file_with_realname,
+                                    compressed_tmp_file,
+                                    password=self.password,
+                                    encryption_method=self.encryption_method,
+                                    compression_level=self.compression_level)
         # Rename the tmp filename back.
         os.rename(tmp_file_with_realname, c.cur_info.tmp_file)
-        tmp_fi = file_info.load_file_info(compressed_tmp_file)
-        compressed_file_info = file_info.FileInfo(
-            # TODO: check conflict of compressed filename?
-            compression.get_compressed_filename(c.cur_info.path),
-            c.cur_info.is_dir, c.cur_info.mode, tmp_fi.size,
-            c.cur_info.last_modified_time)
-        c.cur_info.compressed_file_info = file_info.copy_with_tmp_file(
-            compressed_file_info, compressed_tmp_filename, self.tmp_dir)
+        self._attach_compressed_file_info(c, compressed_tmp_filename)
     return dir_changes
 
+  def _attach_compressed_file_info(self, c, compressed_tmp_filename):
+    tmp_fi = file_info.load_file_info(
+        os.path.join(self.tmp_dir, compressed_tmp_filename))
+    compressed_file_info = file_info.FileInfo(
+        # TODO: check conflict of compressed filename?
+        compression.get_compressed_filename(c.cur_info.path),
+        c.cur_info.is_dir, c.cur_info.mode, tmp_fi.size,
+        c.cur_info.last_modified_time, mtime_ns=c.cur_info.mtime_ns)
+    c.cur_info = copy.copy(c.cur_info)
+    c.cur_info.compressed_file_info = file_info.copy_with_tmp_file(
+        compressed_file_info, compressed_tmp_filename, self.tmp_dir)
+
+  # Compress the working file of cur_info to compressed_tmp_file. Return
+  # whether the file stays as scanned throughout, i.e. its stat is the same
+  # before and after, and it is re-hashed if modified so recently that a
+  # write during the compression may not have changed its mtime.
+  def _compress_in_place(self, cur_info, compressed_tmp_file):
+    full_path = os.path.join(self.working_dir, cur_info.path)
+    try:
+      stat = os.stat(full_path)
+    except OSError:
+      return False
+    if (stat.st_size != cur_info.size or
+        util.stat_mtime_ns(stat) != cur_info.mtime_ns):
+      return False
+    tstart_ns = int(time.time() * 1000000000)
+    compression.compress_file(full_path, compressed_tmp_file,
+                              password=self.password,
+                              encryption_method=self.encryption_method,
+                              compression_level=self.compression_level)
+    try:
+      if (hash_cache.stat_signature(os.stat(full_path)) !=
+          hash_cache.stat_signature(stat)):
+        return False
+    except OSError:
+      return False
+    if util.stat_mtime_ns(stat) >= tstart_ns - _RACY_MTIME_NS:
+      cur_fi = file_info.load_file_info(full_path, calculate_hash=True)
+      return cur_fi is not None and cur_fi.file_hash == cur_info.file_hash
+    return True
+
+  # Return cur_info of a working file changed since scanned, as a snapshot
+  # of its current content in tmp_dir.
+  def _snapshot_working_file(self, cur_info):
+    tmp_filename = change_entry.generate_tmp_file(self.tmp_dir)
+    tmp_file = os.path.join(self.tmp_dir, tmp_filename)
+    file_hash = snapshot.take_and_hash(
+        os.path.join(self.working_dir, cur_info.path), tmp_file)
+    tmp_fi = file_info.load_file_info(tmp_file)
+    return file_info.copy_with_tmp_file(
+        file_info.FileInfo(cur_info.path, False, tmp_fi.mode, tmp_fi.size,
+                           None, mtime_ns=tmp_fi.mtime_ns),
+        tmp_filename, self.tmp_dir, file_hash=file_hash)
+
   # Return (dir_changes, invalid_archive_dc_working, invalid_archive_dc_cloud)
   def _generate_original_dir_changes(self, dir_changes,
                                      parent_dir_changes=None,
@@ -200,15 +388,16 @@ class BoxWrap:
     new_dir_changes = change_entry.DirChanges(
         dir_changes.base_dir(), dir_changes.dir_status(),
         parent_dir_changes=parent_dir_changes)
+    new_dir_changes.unchanged = dir_changes.unchanged
     for c in dir_changes.changes():
       path = compression.get_original_filename(c.path)
       old_info = None
       if c.old_info and c.old_info.original_file_info:
-        old_info = copy.deepcopy(c.old_info.original_file_info)
-        old_info.compressed_file_info = copy.deepcopy(c.old_info)
+        old_info = copy.copy(c.old_info.original_file_info)
+        old_info.compressed_file_info = copy.copy(c.old_info)
         old_info.compressed_file_info.original_file_info = None
       else:
-        old_info = copy.deepcopy(c.old_info)
+        old_info = c.old_info
 
       cur_info = None
       if c.cur_info:
@@ -228,9 +417,20 @@ class BoxWrap:
                 change_entry.CONTENT_STATUS_DELETED,
                 parent_dir_changes=invalid_archive_dc_cloud))
             continue
+          # Hash the original as it is decompressed
+          content_hash = file_info.ContentHash()
           try:
-            compression.decompress_file(c.cur_info.tmp_file, original_tmp_file,
-                                        self.tmp_dir, password=self.password)
+            compression.decompress_file_with_hash(
+                c.cur_info.tmp_file, original_tmp_file, self.tmp_dir,
+                content_hash, password=self.password)
+            # Decompress again from a detached copy if the hardlink snapshot
+            # has changed with the archive in wrap_dir meanwhile.
+            if not snapshot.is_intact(c.cur_info.tmp_file):
+              snapshot.detach(c.cur_info.tmp_file)
+              content_hash = file_info.ContentHash()
+              compression.decompress_file_with_hash(
+                  c.cur_info.tmp_file, original_tmp_file, self.tmp_dir,
+                  content_hash, password=self.password)
           except compression.CompressionInvalidArchive:
             invalid_archive_dc_working.add_change(change_entry.ChangeEntry(
                 # Not using path because it is not a valid archive
@@ -245,7 +445,7 @@ class BoxWrap:
             continue
 
           tmp_fi = file_info.load_file_info(original_tmp_file)
-          compressed_file_info = copy.deepcopy(c.cur_info)
+          compressed_file_info = copy.copy(c.cur_info)
           compressed_file_info.compressed_file_info = None
           compressed_file_info.original_file_info = None
           cur_info = file_info.FileInfo(
@@ -253,9 +453,11 @@ class BoxWrap:
               compression.get_original_filename(c.cur_info.path),
               c.cur_info.is_dir, c.cur_info.mode, tmp_fi.size,
               c.cur_info.last_modified_time,
-              compressed_file_info=compressed_file_info)
+              compressed_file_info=compressed_file_info,
+              mtime_ns=c.cur_info.mtime_ns)
           cur_info = file_info.copy_with_tmp_file(
-              cur_info, original_tmp_filename, self.tmp_dir)
+              cur_info, original_tmp_filename, self.tmp_dir,
+              file_hash=content_hash.file_hash())
         else:
           cur_info = old_info
 
@@ -298,21 +500,21 @@ class BoxWrap:
     for c in dir_changes.changes():
       old_info = None
       if c.old_info and c.old_info.compressed_file_info:
-        old_info = copy.deepcopy(c.old_info.compressed_file_info)
+        old_info = c.old_info.compressed_file_info
       else:
-        old_info = copy.deepcopy(c.old_info)
+        old_info = c.old_info
 
       cur_info = None
       if c.cur_info and c.cur_info.compressed_file_info:
-        cur_info = copy.deepcopy(c.cur_info.compressed_file_info)
+        cur_info = c.cur_info.compressed_file_info
       else:
-        cur_info = copy.deepcopy(c.cur_info)
+        cur_info = c.cur_info
 
       conflict_info = None
       if c.conflict_info and c.conflict_info.compressed_file_info:
-        conflict_info = copy.deepcopy(c.conflict_info.compressed_file_info)
+        conflict_info = c.conflict_info.compressed_file_info
       else:
-        conflict_info = copy.deepcopy(c.conflict_info)
+        conflict_info = c.conflict_info
 
       path = cur_info.path if cur_info else old_info.path
 
@@ -326,17 +528,23 @@ class BoxWrap:
 
     return new_dir_changes
 
+  # The dir digests are set over the compressed file info, the same as the
+  # scan of wrap_dir, on copies of the dirs.
   def _extract_compressed_dir_info(self, dir_info):
     file_info_list = []
     for fi in dir_info.flat_file_info_list():
-      fi2 = copy.deepcopy(fi)
-      if fi2.compressed_file_info:
-        fi3 = fi2.compressed_file_info
-        fi3.original_file_info = fi2
+      if fi.compressed_file_info:
+        fi2 = copy.copy(fi)
         fi2.compressed_file_info = None
+        fi3 = copy.copy(fi.compressed_file_info)
+        fi3.original_file_info = fi2
         file_info_list.append(fi3)
+      elif fi.is_dir:
+        file_info_list.append(copy.copy(fi))
       else:
-        file_info_list.append(fi2)
-    return file_info.load_dir_info_from_file_info_list(
+        file_info_list.append(fi)
+    cloud_dir_info = file_info.load_dir_info_from_file_info_list(
         '.', file_info_list, key=self.compression_key)
+    file_info.set_dir_digests(cloud_dir_info)
+    return cloud_dir_info
 
@@ -0,0 +1,179 @@
+import mmap
+import os
+import struct
+
+import cStringIO
+
+from sync import columnar_dir_info
+from sync import file_info
+from util import util
+
+# The state of a whole dir tree in a binary file, in the order of
+# flat_file_info_list: a header, a fixed-width record per entry and a heap of
+# the UTF-8 strings the records point into. The file is mmap'ed and nothing
+# is decoded on load, so opening it takes the same time for any tree size.
+# The records are read on access through ColumnarDirInfo, which finds paths
+# by binary search and the children of a dir by jumping over subtrees, so
+# only the parts of the tree visited are ever decoded.
+_MAGIC = 'BWST'
+_VERSION = 2
+
+# magic, version, record count, heap offset
+_HEADER = struct.Struct('<4sIIQ')
+
+# path, hash, flags, mode, size, mtime_ns, subtree end, then the compressed
+# path, mode, size, mtime_ns and hash. Strings are (offset, length) in the
+# heap, with a length of 0 for None. Sizes are -1 for None.
+_RECORD = struct.Struct('<IIIIBIqqIIIIqqII')
+
+_FLAG_IS_DIR = 1
+_FLAG_COMPRESSED = 2
+
+
+def _encode(s):
+  if isinstance(s, unicode):
+    return s.encode('utf-8')
+  return s
+
+
+class _Heap:
+
+  def __init__(self):
+    self._data = cStringIO.StringIO()
+    self._size = 0
+
+  # Return (offset, length) of s, (0, 0) for None or empty.
+  def add(self, s):
+    if not s:
+      return 0, 0
+    s = _encode(s)
+    offset = self._size
+    self._data.write(s)
+    self._size += len(s)
+    return offset, len(s)
+
+  def getvalue(self):
+    return self._data.getvalue()
+
+
+def _record(fi, subtree_end, heap):
+  c = fi.compressed_file_info
+  flags = (_FLAG_IS_DIR if fi.is_dir else 0) | (_FLAG_COMPRESSED if c else 0)
+  size = fi.size if fi.size is not None else -1
+  if c:
+    c_path = heap.add(c.path)
+    c_fields = (c.mode, c.size if c.size is not None else -1, c.mtime_ns)
+    c_hash = heap.add(c.file_hash)
+  else:
+    c_path = c_hash = (0, 0)
+    c_fields = (0, -1, 0)
+  return _RECORD.pack(
+      *(heap.add(fi.path) + heap.add(fi.file_hash) +
+        (flags, fi.mode, size, fi.mtime_ns, subtree_end) +
+        c_path + c_fields + c_hash))
+
+
+# Write the entries of file_info_list, in the order of flat_file_info_list,
+# to f.
+def write_binary_state(f, file_info_list):
+  file_info_list = list(file_info_list)
+  # subtree_end of each entry, as in columnar_dir_info
+  subtree_ends = range(1, len(file_info_list) + 1)
+  dir_stack = []
+  for i, fi in enumerate(file_info_list):
+    parent = os.path.dirname(fi.path)
+    while dir_stack and file_info_list[dir_stack[-1]].path != parent:
+      subtree_ends[dir_stack.pop()] = i
+    if fi.is_dir:
+      dir_stack.append(i)
+  for i in dir_stack:
+    subtree_ends[i] = len(file_info_list)
+
+  heap = _Heap()
+  records = cStringIO.StringIO()
+  for fi, subtree_end in zip(file_info_list, subtree_ends):
+    records.write(_record(fi, subtree_end, heap))
+  f.write(_HEADER.pack(_MAGIC, _VERSION, len(file_info_list),
+                       _HEADER.size + _RECORD.size * len(file_info_list)))
+  f.write(records.getvalue())
+  f.write(heap.getvalue())
+
+
+# The table of ColumnarDirInfo over the mmap'ed file.
+class _MmapTable:
+
+  def __init__(self, f):
+    self._f = f
+    self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, self._count, self._heap = _HEADER.unpack_from(self._map)
+    if magic != _MAGIC:
+      raise ValueError('Not a binary state file: %s' % f.name)
+    if version != _VERSION:
+      raise ValueError('Unsupported binary state version %s: %s' % (
+          version, f.name))
+
+  def __len__(self):
+    return self._count
+
+  def _record(self, i):
+    return _RECORD.unpack_from(self._map, _HEADER.size + _RECORD.size * i)
+
+  def _string(self, offset, length):
+    if not length:
+      return None
+    start = self._heap + offset
+    return self._map[start:start + length].decode('utf-8')
+
+  def path(self, i):
+    r = self._record(i)
+    return self._string(r[0], r[1])
+
+  def is_dir(self, i):
+    return bool(self._record(i)[4] & _FLAG_IS_DIR)
+
+  def subtree_end(self, i):
+    return self._record(i)[8]
+
+  def file_info(self, i):
+    (path_offset, path_length, hash_offset, hash_length, flags, mode, size,
+     mtime, unused, c_path_offset, c_path_length, c_mode, c_size, c_mtime,
+     c_hash_offset, c_hash_length) = self._record(i)
+    is_dir = bool(flags & _FLAG_IS_DIR)
+    compressed_file_info = None
+    if flags & _FLAG_COMPRESSED:
+      compressed_file_info = file_info.FileInfo(
+          self._string(c_path_offset, c_path_length), is_dir, c_mode,
+          c_size if c_size >= 0 else None, None,
+          self._string(c_hash_offset, c_hash_length), mtime_ns=c_mtime)
+    return file_info.FileInfo(
+        self._string(path_offset, path_length), is_dir, mode,
+        size if size >= 0 else None, None,
+        self._string(hash_offset, hash_length),
+        compressed_file_info=compressed_file_info, mtime_ns=mtime)
+
+  # Index of path in [start, end), or -1 if not found.
+  def find(self, path, start, end):
+    key = util.path_for_sorting(path)
+    lo = start
+    hi = end
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if util.path_for_sorting(self.path(mid)) < key:
+        lo = mid + 1
+      else:
+        hi = mid
+    if lo < end and self.path(lo) == path:
+      return lo
+    return -1
+
+  def close(self):
+    self._map.close()
+    self._f.close()
+
+
+# Open the binary state at path as a ColumnarDirInfo. The file is kept open
+# for as long as the dir info is used, and is to be replaced by rename rather
+# than rewritten in place.
+def load_binary_dir_info(path, base_dir):
+  table = _MmapTable(open(path, 'rb'))
+  return columnar_dir_info.ColumnarDirInfo(table, base_dir, 0, len(table))
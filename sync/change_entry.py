@@ -1,10 +1,14 @@
 import collections
+import copy
+import itertools
 import os
 import random
 import shutil
 
 import compression
 from sync import file_info
+from sync import path_trie
+from sync import snapshot
 from util import util
 
 CONTENT_STATUS_UNSPECIFIED = -1
@@ -16,7 +20,8 @@ CONTENT_STATUS_NEW = 4
 CONTENT_STATUS_DELETED = 5
 
 
-class ChangeEntry:
+# The path is kept in path_trie like FileInfo.path.
+class ChangeEntry(object):
 
   def __init__(self, path, cur_info, old_info, content_status,
                dir_changes=None, parent_dir_changes=None,
@@ -29,6 +34,20 @@ class ChangeEntry:
     self.parent_dir_changes = parent_dir_changes
     self.conflict_info = conflict_info
 
+  def _get_path(self):
+    # path_trie.join inlined, as it is on the hot path of sync
+    if self._dir_node is None:
+      return self._name
+    return self._dir_node.prefix + self._name
+
+  def _set_path(self, path):
+    self._dir_node, self._name = path_trie.split(path)
+
+  path = property(_get_path, _set_path)
+
+  def path_for_sorting(self):
+    return path_trie.path_for_sorting(self._dir_node, self._name)
+
   def parent_change_path(self):
     if self.content_status != CONTENT_STATUS_DELETED:
       return None
@@ -71,9 +90,12 @@ class DirChanges:
                parent_dir_changes=None):
     self._dir_status = dir_status
     self._changes = changes or []
-    self._changes_dict = dict([(x.path, x) for x in self._changes])
+    # By name, as all the changes are in the same dir
+    self._changes_dict = dict([(x._name, x) for x in self._changes])
     self._base_dir = base_dir
     self._parent_dir_changes = parent_dir_changes
+    # Whether the whole subtree is known to be NO_CHANGE by the dir digests
+    self.unchanged = False
 
   def base_dir(self):
     return self._base_dir
@@ -87,16 +109,19 @@ class DirChanges:
   def add_change(self, change):
     self._changes.append(change)
     self._update_dir_status_by_change(change)
-    self._changes_dict[change.path] = change
+    self._changes_dict[change._name] = change
 
   def changes(self):
     return self._changes
 
   def change(self, path):
-    return self._changes_dict[path]
+    change = self._changes_dict[path_trie.name_of(path)]
+    if change.path != path:
+      raise KeyError(path)
+    return change
 
   def dir_changes(self, path):
-    return self._changes_dict[path].dir_changes
+    return self.change(path).dir_changes
 
   def parent_dir_changes(self):
     return self._parent_dir_changes
@@ -131,14 +156,170 @@ class DirChanges:
          self._dir_status = CONTENT_STATUS_NO_CHANGE
 
 
-# return random file name
-def _copy_to_tmp_dir(root_dir, path, tmp_dir):
+# Return the tmp file info of e_new_info with a random file name, which is
+# hashed as it is copied if the scan has left it unhashed.
+def copy_to_tmp_dir(root_dir, e_new_info, tmp_dir):
   random_file_name = generate_tmp_file(tmp_dir)
   full_file_name = os.path.join(tmp_dir, random_file_name)
   # TODO: guard that if path has been deleted or changed to dir,
   # maybe just create a placeholder tmp_file
-  shutil.copy2(os.path.join(root_dir, path), full_file_name)
-  return random_file_name
+  file_hash = None
+  if e_new_info.file_hash:
+    snapshot.take(os.path.join(root_dir, e_new_info.path), full_file_name)
+  else:
+    file_hash = snapshot.take_and_hash(
+        os.path.join(root_dir, e_new_info.path), full_file_name)
+  return file_info.copy_with_tmp_file(e_new_info, random_file_name, tmp_dir,
+                                      file_hash=file_hash)
+
+
+# Whether get_dir_changes copies the file of the change to tmp_dir, i.e. a
+# changed file which is not moved.
+def is_copied_to_tmp_dir(c):
+  return (c.cur_info is not None and not c.cur_info.is_dir
+          and not c.cur_info.tmp_file and not is_moved(c)
+          and c.content_status in [CONTENT_STATUS_NEW,
+                                   CONTENT_STATUS_MODIFIED,
+                                   CONTENT_STATUS_TO_FILE])
+
+
+# The file info of the moved file or dir of the change, whose moved_from is
+# set, or None if it is not moved. It is the compressed file info of a file
+# of working_dir, as the archive is renamed in wrap_dir.
+def moved_file_info(c):
+  if c.content_status != CONTENT_STATUS_NEW:
+    return None
+  fi = c.cur_info
+  if fi.compressed_file_info is not None:
+    fi = fi.compressed_file_info
+  if fi.moved_from is None:
+    return None
+  return fi
+
+
+def is_moved(c):
+  return moved_file_info(c) is not None
+
+
+# Undo the move of the change, which is applied as a new file or dir then.
+def unpair_move(c):
+  c.cur_info = copy.copy(c.cur_info)
+  if c.cur_info.is_dir:
+    c.cur_info.moved_from = None
+  else:
+    c.cur_info.compressed_file_info = None
+
+
+# Pair the new files with the deleted files of the same size and hash in
+# dir_changes, whose archives are renamed in wrap_dir rather than compressed
+# again. Only cryptographic hashes are trusted for it, so that the files of
+# crc32 or adler32 hashes are deleted and compressed anew. The new files of a size no deleted file has are not hashed here.
+# Given a tmp_dir, the others are hashed as they are copied to tmp_dir, so
+# that those not moved are read once, and the copies of those moved are
+# removed.
+# Of the deleted files of the same content, the one of the same name is
+# preferred, e.g. of a dir moved. A new dir whose files are all moved from
+# the same relative paths of a deleted dir is paired with the dir too, and
+# renamed as a whole.
+def _pair_moves(dir_changes, root_dir, tmp_dir=None, verbose=False):
+  # (size, file_hash) -> deleted file changes with archives
+  deleted = collections.defaultdict(list)
+  deleted_dirs = {}
+  for c in dir_changes.flat_changes():
+    if c.content_status != CONTENT_STATUS_DELETED:
+      continue
+    if c.old_info.is_dir:
+      deleted_dirs[c.path] = c
+    elif (c.old_info.file_hash and c.old_info.compressed_file_info
+          and file_info.is_cryptographic_hash(c.old_info.file_hash)):
+      deleted[(c.old_info.size, c.old_info.file_hash)].append(c)
+  if not deleted:
+    return
+  deleted_sizes = set(x[0] for x in deleted)
+
+  # Path of the moved files -> path moved from
+  moves = {}
+  for c in dir_changes.flat_changes():
+    if (c.content_status != CONTENT_STATUS_NEW or c.cur_info.is_dir
+        or c.cur_info.size not in deleted_sizes):
+      continue
+    fi = c.cur_info
+    file_hash = fi.file_hash
+    if not file_hash:
+      try:
+        if tmp_dir:
+          fi = copy_to_tmp_dir(root_dir, fi, tmp_dir)
+        else:
+          fi = copy.copy(fi)
+          fi.file_hash = file_info.calculate_file_hash(
+              os.path.join(root_dir, fi.path))
+      except EnvironmentError:
+        continue
+      file_hash = fi.file_hash
+      c.cur_info = fi
+    if not file_info.is_cryptographic_hash(file_hash):
+      continue
+    candidates = deleted.get((fi.size, file_hash))
+    if not candidates:
+      continue
+    source = candidates[0]
+    for x in candidates:
+      if x._name == c._name:
+        source = x
+        break
+    candidates.remove(source)
+    if verbose:
+      print '%s: moved from %s' % (fi.path, source.path)
+    old_compressed_info = source.old_info.compressed_file_info
+    compressed_info = copy.copy(old_compressed_info)
+    compressed_info.path = compression.get_compressed_filename(fi.path)
+    # The archive of the last sync in tmp_dir may be gone
+    compressed_info.tmp_file = None
+    compressed_info.moved_from = old_compressed_info
+    c.cur_info = copy.copy(fi)
+    c.cur_info.compressed_file_info = compressed_info
+    if fi.tmp_file:
+      os.remove(fi.tmp_file)
+      c.cur_info.tmp_file = None
+    moves[c.path] = source.path
+
+  if moves:
+    for c in dir_changes.flat_changes():
+      if c.content_status == CONTENT_STATUS_NEW and c.cur_info.is_dir:
+        source = _moved_dir_source(c, moves, deleted_dirs)
+        if source is not None:
+          c.cur_info = copy.copy(c.cur_info)
+          c.cur_info.moved_from = source.old_info
+
+
+# The deleted dir change which the new dir of c is moved from as a whole, or
+# None. Both dirs have the same files and dirs in the same relative paths,
+# and the files are all moved between them.
+def _moved_dir_source(c, moves, deleted_dirs):
+  prefix = c.path + os.sep
+  rel_paths = set()
+  source_path = None
+  for sub_c in c.dir_changes.flat_changes():
+    rel_path = sub_c.path[len(prefix):]
+    rel_paths.add(rel_path)
+    if sub_c.cur_info.is_dir:
+      continue
+    moved_from = moves.get(sub_c.path)
+    if moved_from is None or not moved_from.endswith(os.sep + rel_path):
+      return None
+    if source_path is None:
+      source_path = moved_from[:-len(rel_path) - 1]
+    elif moved_from != os.path.join(source_path, rel_path):
+      return None
+  source = deleted_dirs.get(source_path)
+  if source is None:
+    return None
+  source_prefix = source_path + os.sep
+  source_rel_paths = set(x.path[len(source_prefix):]
+                         for x in source.dir_changes.flat_changes())
+  if source_rel_paths != rel_paths:
+    return None
+  return source
 
 
 def generate_tmp_file(tmp_dir):
@@ -150,8 +331,24 @@ def generate_tmp_file(tmp_dir):
 
 
 # root_dir is the root for new_dir_info
+#
+# With detect_moves, the new files are paired with the deleted ones of the
+# same content into moves by _pair_moves, and only the files not moved are
+# copied to tmp_dir.
 def get_dir_changes(new_dir_info, old_dir_info, parent_dir_changes=None,
-                    root_dir=None, tmp_dir=None, verbose=False):
+                    root_dir=None, tmp_dir=None, verbose=False,
+                    detect_moves=False):
+  if detect_moves:
+    dir_changes = get_dir_changes(new_dir_info, old_dir_info,
+                                  parent_dir_changes=parent_dir_changes,
+                                  root_dir=root_dir, verbose=verbose)
+    _pair_moves(dir_changes, root_dir, tmp_dir=tmp_dir, verbose=verbose)
+    if root_dir and tmp_dir:
+      for c in dir_changes.flat_changes():
+        if is_copied_to_tmp_dir(c):
+          c.cur_info = copy_to_tmp_dir(root_dir, c.cur_info, tmp_dir)
+    return dir_changes
+
   # TODO: add permission change status
   top_dir_delete_change_path = None
   base_dir = (new_dir_info.base_dir() if new_dir_info
@@ -163,10 +360,15 @@ def get_dir_changes(new_dir_info, old_dir_info, parent_dir_changes=None,
       iter(old_dir_info.file_info_list() if old_dir_info else []),
       key_func=lambda x: x.path_for_sorting()):
     dir_status = CONTENT_STATUS_NO_CHANGE
-    tmp_file = None
     dir_changes = None
     if e_new_info and e_old_info:
-      if e_new_info.is_dir and e_old_info.is_dir:
+      if (e_new_info.is_dir and e_old_info.is_dir
+          and _is_same_dir_digest(e_new_info, e_old_info)):
+        dir_changes = _unchanged_dir_changes(
+            new_dir_info.dir_info(e_new_info.path),
+            old_dir_info.dir_info(e_old_info.path), cur_dir_changes)
+        content_status = CONTENT_STATUS_NO_CHANGE
+      elif e_new_info.is_dir and e_old_info.is_dir:
         dir_changes = get_dir_changes(new_dir_info.dir_info(e_new_info.path),
                                       old_dir_info.dir_info(e_old_info.path),
                                       parent_dir_changes=cur_dir_changes,
@@ -197,28 +399,20 @@ def get_dir_changes(new_dir_info, old_dir_info, parent_dir_changes=None,
         content_status = CONTENT_STATUS_TO_FILE
         dir_status = dir_changes.dir_status()
         if root_dir and tmp_dir:
-          tmp_file = _copy_to_tmp_dir(root_dir, e_new_info.path, tmp_dir)
+          e_new_info = copy_to_tmp_dir(root_dir, e_new_info, tmp_dir)
       else:
         if e_new_info.is_modified(e_old_info):
           if verbose:
             print '%s: file modified' % e_new_info.path
           content_status = CONTENT_STATUS_MODIFIED
           if root_dir and tmp_dir:
-            tmp_file = _copy_to_tmp_dir(root_dir, e_new_info.path, tmp_dir)
+            e_new_info = copy_to_tmp_dir(root_dir, e_new_info, tmp_dir)
         else:
           content_status = CONTENT_STATUS_NO_CHANGE
 
       path = e_new_info.path
-      if (not e_new_info.compressed_file_info
-          and e_old_info.compressed_file_info
-          and content_status == CONTENT_STATUS_NO_CHANGE):
-        e_new_info.compressed_file_info = e_old_info.compressed_file_info
-      if (not e_new_info.original_file_info
-          and e_old_info.original_file_info
-          and content_status == CONTENT_STATUS_NO_CHANGE):
-        e_new_info.original_file_info = e_old_info.original_file_info
-      if tmp_file:
-        e_new_info = file_info.copy_with_tmp_file(e_new_info, tmp_file, tmp_dir)
+      if content_status == CONTENT_STATUS_NO_CHANGE:
+        _keep_old_file_infos(e_new_info, e_old_info)
       change = ChangeEntry(
           e_new_info.path, e_new_info, e_old_info, content_status,
           dir_changes=dir_changes, parent_dir_changes=cur_dir_changes)
@@ -237,10 +431,7 @@ def get_dir_changes(new_dir_info, old_dir_info, parent_dir_changes=None,
         if verbose:
           print '%s: new file' % e_new_info.path
         if root_dir and tmp_dir:
-          tmp_file = _copy_to_tmp_dir(root_dir, e_new_info.path, tmp_dir)
-          if tmp_file:
-            e_new_info = file_info.copy_with_tmp_file(e_new_info, tmp_file,
-                                                      tmp_dir)
+          e_new_info = copy_to_tmp_dir(root_dir, e_new_info, tmp_dir)
 
       change = ChangeEntry(
           e_new_info.path, e_new_info, None, CONTENT_STATUS_NEW,
@@ -270,6 +461,41 @@ def get_dir_changes(new_dir_info, old_dir_info, parent_dir_changes=None,
   return cur_dir_changes
 
 
+def _keep_old_file_infos(e_new_info, e_old_info):
+  if not e_new_info.compressed_file_info and e_old_info.compressed_file_info:
+    e_new_info.compressed_file_info = e_old_info.compressed_file_info
+  if not e_new_info.original_file_info and e_old_info.original_file_info:
+    e_new_info.original_file_info = e_old_info.original_file_info
+
+
+def _is_same_dir_digest(e_new_info, e_old_info):
+  return bool(e_new_info.file_hash
+              and e_new_info.file_hash == e_old_info.file_hash)
+
+
+# The changes of the dirs whose digests are the same, all NO_CHANGE, without
+# comparing the entries. The entries are in the same order in both as the
+# digests cover the order.
+def _unchanged_dir_changes(new_dir_info, old_dir_info, parent_dir_changes):
+  dir_changes = DirChanges(new_dir_info.base_dir(), CONTENT_STATUS_NO_CHANGE,
+                           parent_dir_changes=parent_dir_changes)
+  dir_changes.unchanged = True
+  for e_new_info, e_old_info in itertools.izip(
+      new_dir_info.file_info_list(), old_dir_info.file_info_list()):
+    sub_dir_changes = None
+    if e_new_info.is_dir:
+      sub_dir_changes = _unchanged_dir_changes(
+          new_dir_info.dir_info(e_new_info.path),
+          old_dir_info.dir_info(e_old_info.path), dir_changes)
+    _keep_old_file_infos(e_new_info, e_old_info)
+    dir_changes.add_change(ChangeEntry(
+        e_new_info.path, e_new_info, e_old_info, CONTENT_STATUS_NO_CHANGE,
+        dir_changes=sub_dir_changes, parent_dir_changes=dir_changes))
+  return dir_changes
+
+
+# The dirs of the returned dir info are copies with their digests set, as
+# the digests in the state are to be compared with the next scan.
 def apply_dir_changes_to_dir_info(base_dir, dir_changes):
   file_info_list = []
   for change in dir_changes.flat_changes():
@@ -279,8 +505,13 @@ def apply_dir_changes_to_dir_info(base_dir, dir_changes):
     elif change.content_status == CONTENT_STATUS_DELETED:
       continue
     fi = change.cur_info
-    file_info_list.append(change.cur_info)
-  return file_info.load_dir_info_from_file_info_list(base_dir, file_info_list)
+    if fi.is_dir:
+      fi = copy.copy(fi)
+    file_info_list.append(fi)
+  dir_info = file_info.load_dir_info_from_file_info_list(
+      base_dir, file_info_list)
+  file_info.set_dir_digests(dir_info)
+  return dir_info
 
 
 def _generate_conflict_copy_path(path, count):
@@ -342,8 +573,54 @@ def _get_dir_conflict_state(change, full_path):
     return CONFLICT_NO_CONFLICT
 
 
+# Rename the sources of the moved files and dirs in dir_changes to their
+# paths in dest_dir, before the changes are applied, so that the deletes of
+# the sources find them gone, and the moved files are found in place. A move
+# whose source has changed or whose path exists already is left out, and
+# fails as a new file without a tmp file then.
+def _apply_moves(dest_dir, dir_changes, verbose=False):
+  moved_dir = None
+  for c in dir_changes.flat_changes():
+    fi = moved_file_info(c)
+    if fi is None:
+      continue
+    full_path = os.path.realpath(os.path.join(dest_dir, fi.path))
+    # The changes under a dir follow it, and are moved with it
+    if moved_dir and full_path.startswith(moved_dir + os.sep):
+      continue
+    source_path = os.path.realpath(os.path.join(dest_dir, fi.moved_from.path))
+    if os.path.lexists(full_path) or not _is_move_source_intact(
+        fi.moved_from, source_path):
+      continue
+    parent_dir = os.path.dirname(full_path)
+    if not os.path.isdir(parent_dir):
+      os.makedirs(parent_dir)
+    if verbose:
+      print 'Move %s %s to %s' % ('dir' if fi.is_dir else 'file',
+                                 source_path, full_path)
+    os.rename(source_path, full_path)
+    if fi.is_dir:
+      moved_dir = full_path
+
+
+def _is_move_source_intact(moved_from, source_path):
+  if moved_from.is_dir:
+    return os.path.isdir(source_path)
+  fi = file_info.load_file_info(source_path)
+  return fi is not None and not fi.is_dir and not moved_from.is_modified(fi)
+
+
+# Whether the file of fi is moved to dest_path by _apply_moves
+def _is_moved_in_place(fi, dest_path):
+  return bool(fi.moved_from and not fi.tmp_file and os.path.isfile(dest_path))
+
+
+# on_applied, if given, is called with each change other than no change
+# once it is applied, after the changes under it.
 def apply_dir_changes_to_dir(dest_dir, dir_changes, force_conflict=None,
-                             verbose=False):
+                             verbose=False, on_applied=None):
+  if dir_changes.parent_dir_changes() is None:
+    _apply_moves(dest_dir, dir_changes, verbose=verbose)
   for c in dir_changes.changes():
     full_path = os.path.realpath(os.path.join(dest_dir, c.path))
     if c.content_status == CONTENT_STATUS_TO_FILE:
@@ -354,7 +631,7 @@ def apply_dir_changes_to_dir(dest_dir, dir_changes, force_conflict=None,
       elif os.path.isdir(full_path):
         apply_dir_changes_to_dir(dest_dir, c.dir_changes,
                                  force_conflict=force_conflict,
-                                 verbose=verbose)
+                                 verbose=verbose, on_applied=on_applied)
         if os.listdir(full_path):
           # Conflict, the directory still exists
           if verbose:
@@ -381,11 +658,11 @@ def apply_dir_changes_to_dir(dest_dir, dir_changes, force_conflict=None,
         os.mkdir(full_path)
         apply_dir_changes_to_dir(dest_dir, c.dir_changes,
                                  force_conflict=force_conflict,
-                                 verbose=verbose)
+                                 verbose=verbose, on_applied=on_applied)
       elif os.path.isdir(full_path):
         apply_dir_changes_to_dir(dest_dir, c.dir_changes,
                                  force_conflict=force_conflict,
-                                 verbose=verbose)
+                                 verbose=verbose, on_applied=on_applied)
       else:
         # full_path is still a file
         if c.old_info.is_modified(file_info.load_file_info(full_path)):
@@ -403,7 +680,7 @@ def apply_dir_changes_to_dir(dest_dir, dir_changes, force_conflict=None,
         os.mkdir(full_path)
         apply_dir_changes_to_dir(dest_dir, c.dir_changes,
                                  force_conflict=force_conflict,
-                                 verbose=verbose)
+                                 verbose=verbose, on_applied=on_applied)
 
     elif ((not c.cur_info or not c.cur_info.is_dir)
         and (not c.old_info or not c.old_info.is_dir)):
@@ -412,12 +689,16 @@ def apply_dir_changes_to_dir(dest_dir, dir_changes, force_conflict=None,
                               CONTENT_STATUS_MODIFIED]:
         conflict_state = _get_file_conflict_state(c, full_path, force_conflict)
         if conflict_state == CONFLICT_NO_CONFLICT:
-          if verbose:
-            if c.content_status == CONTENT_STATUS_NEW:
-              print 'Create file %s' % full_path
-            else:
-              print 'Update file %s' % full_path
-          c.cur_info.copy_tmp(full_path)
+          if _is_moved_in_place(c.cur_info, full_path):
+            # Reported by _apply_moves
+            pass
+          else:
+            if verbose:
+              if c.content_status == CONTENT_STATUS_NEW:
+                print 'Create file %s' % full_path
+              else:
+                print 'Update file %s' % full_path
+            c.cur_info.copy_tmp(full_path)
         elif conflict_state == CONFLICT_NEW:
           if verbose:
             print 'Create conflict file %s' % _get_conflict_copy_path(full_path)
@@ -454,13 +735,13 @@ def apply_dir_changes_to_dir(dest_dir, dir_changes, force_conflict=None,
           os.mkdir(full_path)
         apply_dir_changes_to_dir(dest_dir, c.dir_changes,
                                  force_conflict=force_conflict,
-                                 verbose=verbose)
+                                 verbose=verbose, on_applied=on_applied)
       elif c.content_status == CONTENT_STATUS_DELETED:
         conflict_state = _get_dir_conflict_state(c, full_path)
         if conflict_state == CONFLICT_NO_CONFLICT:
           apply_dir_changes_to_dir(dest_dir, c.dir_changes,
                                    force_conflict=force_conflict,
-                                   verbose=verbose)
+                                   verbose=verbose, on_applied=on_applied)
           if os.path.isdir(full_path) and not os.listdir(full_path):
             if verbose:
               print 'Delete dir %s' % full_path
@@ -469,6 +750,7 @@ def apply_dir_changes_to_dir(dest_dir, dir_changes, force_conflict=None,
         # No change
         apply_dir_changes_to_dir(dest_dir, c.dir_changes,
                                  force_conflict=force_conflict,
-                                 verbose=verbose)
-
+                                 verbose=verbose, on_applied=on_applied)
 
+    if on_applied and c.content_status != CONTENT_STATUS_NO_CHANGE:
+      on_applied(c)
@@ -0,0 +1,204 @@
+import array
+import os
+
+from sync import file_info
+from util import util
+
+
+# Columns of the file info of a whole dir tree, in the order of
+# flat_file_info_list, i.e. sorted by path_for_sorting since '\1' sorts
+# before any character of a file name. subtree_ends[i] is the index after the
+# last entry under entry i, so the entries directly in a dir are found by
+# jumping from subtree to subtree. Compressed file info, if any, is kept in
+# the c_* columns with None in c_paths if absent. The mtime is split into
+# whole seconds and nanoseconds, as array has no 64-bit integer type.
+class _Table:
+
+  def __init__(self):
+    self.paths = []
+    self.is_dirs = array.array('b')
+    self.modes = array.array('l')
+    # Sizes of up to 2^53 are exact in doubles, and -1 for None
+    self.sizes = array.array('d')
+    self.mtime_secs = array.array('d')
+    self.mtime_nsecs = array.array('l')
+    self.hashes = []
+    self.subtree_ends = array.array('l')
+    self.c_paths = []
+    self.c_modes = array.array('l')
+    self.c_sizes = array.array('d')
+    self.c_mtime_secs = array.array('d')
+    self.c_mtime_nsecs = array.array('l')
+    self.c_hashes = []
+
+  def __len__(self):
+    return len(self.paths)
+
+  def path(self, i):
+    return self.paths[i]
+
+  def is_dir(self, i):
+    return self.is_dirs[i] == 1
+
+  def subtree_end(self, i):
+    return self.subtree_ends[i]
+
+  def append(self, fi):
+    self.paths.append(fi.path)
+    self.is_dirs.append(1 if fi.is_dir else 0)
+    self.modes.append(fi.mode)
+    self.sizes.append(fi.size if fi.size is not None else -1)
+    secs, nsecs = divmod(fi.mtime_ns, 1000000000)
+    self.mtime_secs.append(secs)
+    self.mtime_nsecs.append(nsecs)
+    self.hashes.append(fi.file_hash)
+    self.subtree_ends.append(len(self.paths))
+    c = fi.compressed_file_info
+    self.c_paths.append(c.path if c else None)
+    self.c_modes.append(c.mode if c else 0)
+    self.c_sizes.append(c.size if c and c.size is not None else -1)
+    secs, nsecs = divmod(c.mtime_ns, 1000000000) if c else (0, 0)
+    self.c_mtime_secs.append(secs)
+    self.c_mtime_nsecs.append(nsecs)
+    self.c_hashes.append(c.file_hash if c else None)
+
+  def file_info(self, i):
+    is_dir = self.is_dirs[i] == 1
+    compressed_file_info = None
+    if self.c_paths[i] is not None:
+      compressed_file_info = file_info.FileInfo(
+          self.c_paths[i], is_dir, self.c_modes[i],
+          _size_or_none(self.c_sizes[i]), None, self.c_hashes[i],
+          mtime_ns=_mtime_ns(self.c_mtime_secs[i], self.c_mtime_nsecs[i]))
+    return file_info.FileInfo(
+        self.paths[i], is_dir, self.modes[i], _size_or_none(self.sizes[i]),
+        None, self.hashes[i], compressed_file_info=compressed_file_info,
+        mtime_ns=_mtime_ns(self.mtime_secs[i], self.mtime_nsecs[i]))
+
+  # Index of path in [start, end), or -1 if not found.
+  def find(self, path, start, end):
+    key = util.path_for_sorting(path)
+    lo = start
+    hi = end
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if util.path_for_sorting(self.paths[mid]) < key:
+        lo = mid + 1
+      else:
+        hi = mid
+    if lo < end and self.paths[lo] == path:
+      return lo
+    return -1
+
+
+def _size_or_none(size):
+  return int(size) if size >= 0 else None
+
+
+def _mtime_ns(secs, nsecs):
+  return int(secs) * 1000000000 + nsecs
+
+
+# DirInfo backed by a _Table, with the same API as file_info.DirInfo. It
+# stores a million file tree in a fraction of the memory of DirInfo, at the
+# cost of creating FileInfo on access. The file info returned is a copy, so
+# modifying it does not modify the table.
+#
+# Any table with len, path(i), is_dir(i), subtree_end(i), file_info(i) and
+# find(path, start, end) works, e.g. the mmap one of binary_state.
+class ColumnarDirInfo:
+
+  # The entries in [start, end) of table whose parent is base_dir
+  def __init__(self, table, base_dir, start, end):
+    self._table = table
+    self._base_dir = base_dir
+    self._start = start
+    self._end = end
+
+  def base_dir(self):
+    return self._base_dir
+
+  def _child_indexes(self):
+    i = self._start
+    table = self._table
+    while i < self._end:
+      yield i
+      i = table.subtree_end(i)
+
+  def _sub_dir_info(self, i):
+    return ColumnarDirInfo(self._table, self._table.path(i), i + 1,
+                           self._table.subtree_end(i))
+
+  def _find_child(self, path):
+    i = self._table.find(path, self._start, self._end)
+    if i >= 0 and os.path.dirname(path) != os.path.dirname(
+        self._table.path(self._start)):
+      return -1
+    return i
+
+  def file_info_list(self):
+    return [self._table.file_info(i) for i in self._child_indexes()]
+
+  def dir_info(self, dir_path):
+    i = self._find_child(dir_path)
+    if i < 0 or not self._table.is_dir(i):
+      raise KeyError(dir_path)
+    return self._sub_dir_info(i)
+
+  def child(self, path):
+    i = self._find_child(path)
+    return self._table.file_info(i) if i >= 0 else None
+
+  def child_dir_info(self, path):
+    i = self._find_child(path)
+    if i < 0 or not self._table.is_dir(i):
+      return None
+    return self._sub_dir_info(i)
+
+  # Number of the entries of flat_file_info_list, without decoding them
+  def __len__(self):
+    return self._end - self._start
+
+  def flat_file_info_list(self):
+    for i in xrange(self._start, self._end):
+      yield self._table.file_info(i)
+
+  def has_file(self, path):
+    return self._table.find(path, self._start, self._end) >= 0
+
+  def get(self, path):
+    i = self._table.find(path, self._start, self._end)
+    return self._table.file_info(i) if i >= 0 else None
+
+  def write_to_csv(self, f):
+    file_info.write_file_info_list_to_csv(f, self.flat_file_info_list(),
+                                          calculate_hash=False)
+
+  # Release the table if it holds a resource, e.g. the mmap of binary_state,
+  # after which this and the other dir infos of the table are unreadable.
+  def close(self):
+    if hasattr(self._table, 'close'):
+      self._table.close()
+
+
+# Build from file info in the order of flat_file_info_list, e.g. of a DirInfo
+# or from profile_dir.csv. The first entry is the base dir.
+def columnar_dir_info_from_file_info_list(base_dir, file_info_list):
+  table = _Table()
+  # Indexes of the dirs being filled, from the top
+  dir_stack = []
+  for fi in file_info_list:
+    parent = os.path.dirname(fi.path)
+    while dir_stack and table.paths[dir_stack[-1]] != parent:
+      table.subtree_ends[dir_stack.pop()] = len(table)
+    table.append(fi)
+    if fi.is_dir:
+      dir_stack.append(len(table) - 1)
+  for i in dir_stack:
+    table.subtree_ends[i] = len(table)
+  return ColumnarDirInfo(table, base_dir, 0, len(table))
+
+
+def load_columnar_dir_info_from_csv(f, base_dir):
+  return columnar_dir_info_from_file_info_list(
+      base_dir, file_info.load_file_info_list_from_csv(f))
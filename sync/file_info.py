@@ -1,52 +1,122 @@
+import collections
 import csv
 import glob
 import hashlib
+import itertools
+import mmap
+import multiprocessing
+import multiprocessing.pool
 import os
 import shutil
+import stat as stat_module
 import traceback
+import zlib
 
 import cStringIO
 
+from sync import path_trie
+from util import fastcopy
 from util import i18n
 from util import util
 
-
-class FileInfo:
-
+try:
+  from os import scandir as _scandir
+except ImportError:
+  try:
+    from scandir import scandir as _scandir
+  except ImportError:
+    _scandir = None
+
+
+# File info is shared rather than copied between the dir infos and changes of
+# a sync, e.g. compressed_file_info of the state is referred by the changes of
+# wrap_dir. Copy it before modifying if it may be shared.
+#
+# The path is kept in path_trie as the node of the parent dir and the name,
+# and materialized on access.
+class FileInfo(object):
+
+  __slots__ = ('_dir_node', '_name', 'is_dir', 'mode', 'size', 'mtime_ns',
+               'file_hash', 'tmp_file', 'compressed_file_info',
+               'original_file_info', 'moved_from')
+
+  # The mtime is kept as integer nanoseconds, which is compared exactly and
+  # stored without loss. mtime_ns, if given, is used instead of the float
+  # last_modified_time, e.g. from the stat of a scan.
   def __init__(
       self, path, is_dir, mode, size, last_modified_time, file_hash=None,
-      tmp_file=None, compressed_file_info=None, original_file_info=None):
+      tmp_file=None, compressed_file_info=None, original_file_info=None,
+      mtime_ns=None):
     self.path = path
     self.is_dir = is_dir
     self.mode = mode
     self.size = size
-    self.last_modified_time = last_modified_time
+    if mtime_ns is not None:
+      self.mtime_ns = mtime_ns
+    else:
+      self.last_modified_time = last_modified_time
     self.file_hash = file_hash
     self.tmp_file = tmp_file
     self.compressed_file_info = compressed_file_info
     self.original_file_info = original_file_info
+    # The file info of the same content in the old state, for a file or dir
+    # moved to this path, which is renamed rather than copied when applied.
+    # Only kept during a sync.
+    self.moved_from = None
+
+  def _get_path(self):
+    # path_trie.join inlined, as it is on the hot path of sync
+    if self._dir_node is None:
+      return self._name
+    return self._dir_node.prefix + self._name
+
+  def _set_path(self, path):
+    self._dir_node, self._name = path_trie.split(path)
+
+  path = property(_get_path, _set_path)
+
+  def _get_last_modified_time(self):
+    if self.mtime_ns is None:
+      return None
+    return self.mtime_ns / 1000000000.0
+
+  def _set_last_modified_time(self, last_modified_time):
+    if last_modified_time is None:
+      self.mtime_ns = None
+    else:
+      self.mtime_ns = int(round(last_modified_time * 1000000000))
+
+  last_modified_time = property(_get_last_modified_time,
+                                _set_last_modified_time)
 
   def copy(self, other):
-    self.path = other.path
+    self._dir_node = other._dir_node
+    self._name = other._name
     self.is_dir = other.is_dir
     self.mode = other.mode
     self.size = other.size
-    self.last_modified_time = other.last_modified_time
+    self.mtime_ns = other.mtime_ns
     self.file_hash = other.file_hash
     self.tmp_file = other.tmp_file
     self.compressed_file_info = other.compressed_file_info
     self.original_file_info = other.original_file_info
+    self.moved_from = other.moved_from
 
-  def calculate_hash(self, overwrite=False):
+  def calculate_hash(self, overwrite=False, hash_cache=None):
     if self.is_dir:
       return None
     if not overwrite and self.file_hash:
       return self.file_hash
-    self.file_hash = _calculate_hash(self.path)
+    if hash_cache is not None:
+      self.file_hash = _calculate_hash_with_cache(
+          self.path, os.stat(self.path), hash_cache)
+    else:
+      self.file_hash = _calculate_hash(self.path)
     return self.file_hash
 
+  # Cheap as the key of the parent dir is computed once in path_trie.
   def path_for_sorting(self):
-    return util.path_for_sorting(self.path)
+    return path_trie.path_for_sorting(self._dir_node, self._name)
 
   def to_array(self, show_compressed_level=0):
     data = [
@@ -54,7 +124,7 @@ class FileInfo:
         '1' if self.is_dir else '0',
         str(self.mode),
         str(self.size) if self.size is not None else '-1',
-        str(self.last_modified_time),
+        util.format_mtime_ns(self.mtime_ns),
         str(self.file_hash) if self.file_hash else '']
     if self.compressed_file_info and show_compressed_level > 0:
       data.extend(self.compressed_file_info.to_array(
@@ -72,20 +142,21 @@ class FileInfo:
       return True
     if self.is_dir:
       return False
-    if self.file_hash and other.file_hash:
+    if (self.file_hash and other.file_hash and
+        hash_algorithm(self.file_hash) == hash_algorithm(other.file_hash)):
       return self.file_hash != other.file_hash
     if (not force_check_content and self.size == other.size and
-        self.last_modified_time == other.last_modified_time):
+        self.mtime_ns == other.mtime_ns):
       return False
     elif (self.size != other.size or
-        self.calculate_hash() != other.calculate_hash()):
+        not _is_same_content(self, other)):
       return True
     return False
 
   def copy_tmp(self, dest_path):
     if not self.tmp_file:
       raise Exception("Error copy empty tmp file: %s" % self)
-    shutil.copy2(self.tmp_file, dest_path)
+    fastcopy.copy2(self.tmp_file, dest_path)
 
   def __str__(self):
     return (
@@ -104,19 +175,213 @@ class FileInfo:
                 if self.original_file_info else '')))
 
 
-def _calculate_hash(path):
-  sha1 = hashlib.sha1()
+# Non-cryptographic checksum with the interface of hashlib, only suitable to
+# detect changes of a file.
+class _ZlibChecksum:
+
+  def __init__(self, checksum_func):
+    self._checksum_func = checksum_func
+    self._value = checksum_func('')
+
+  def update(self, data):
+    self._value = self._checksum_func(data, self._value)
+
+  def hexdigest(self):
+    return '%08x' % (self._value & 0xffffffff)
+
+
+_HASH_FACTORIES = collections.OrderedDict([
+    ('sha1', hashlib.sha1),
+    ('md5', hashlib.md5),
+    ('sha256', hashlib.sha256)])
+if hasattr(hashlib, 'blake2b'):
+  _HASH_FACTORIES['blake2b'] = hashlib.blake2b
+  _HASH_FACTORIES['blake2s'] = hashlib.blake2s
+else:
+  try:
+    import pyblake2
+    _HASH_FACTORIES['blake2b'] = pyblake2.blake2b
+    _HASH_FACTORIES['blake2s'] = pyblake2.blake2s
+  except ImportError:
+    pass
+_HASH_FACTORIES['crc32'] = lambda: _ZlibChecksum(zlib.crc32)
+_HASH_FACTORIES['adler32'] = lambda: _ZlibChecksum(zlib.adler32)
+
+# Hash algorithms available on this platform
+HASH_ALGORITHMS = _HASH_FACTORIES.keys()
+
+# Hashes are stored as '<algorithm>:<hex digest>', except that SHA1 hashes
+# are stored as bare hex digests as in the states written before algorithms
+# were selectable.
+DEFAULT_HASH_ALGORITHM = 'sha1'
+_HASH_ALGORITHM_SEPARATOR = ':'
+
+
+def hash_algorithm(file_hash):
+  if _HASH_ALGORITHM_SEPARATOR in file_hash:
+    return file_hash.split(_HASH_ALGORITHM_SEPARATOR, 1)[0]
+  return DEFAULT_HASH_ALGORITHM
+
+
+# Checksums too weak to take files of the same size and hash for the same
+# content, e.g. to pair moved files without reading the archives
+_CHECKSUM_ALGORITHMS = frozenset(['crc32', 'adler32'])
+
+
+def is_cryptographic_hash(file_hash):
+  return hash_algorithm(file_hash) not in _CHECKSUM_ALGORITHMS
+
+
+def _tag_hash(algorithm, hex_digest):
+  if algorithm == DEFAULT_HASH_ALGORITHM:
+    return hex_digest
+  return algorithm + _HASH_ALGORITHM_SEPARATOR + hex_digest
+
+
+DEFAULT_HASH_CHUNK_SIZE = 1024 * 1024
+DEFAULT_HASH_MMAP_THRESHOLD = 64 * 1024 * 1024
+
+# Files are hashed in chunks of _hash_chunk_size bytes so that memory usage
+# is bounded regardless of the file size. Files of at least
+# _hash_mmap_threshold bytes are read via mmap, 0 to disable mmap.
+# New hashes are calculated in _hash_algorithm.
+_hash_chunk_size = DEFAULT_HASH_CHUNK_SIZE
+_hash_mmap_threshold = DEFAULT_HASH_MMAP_THRESHOLD
+_hash_algorithm = DEFAULT_HASH_ALGORITHM
+
+
+def configure_hashing(chunk_size=None, mmap_threshold=None, algorithm=None):
+  global _hash_chunk_size, _hash_mmap_threshold, _hash_algorithm
+  if chunk_size is not None:
+    if chunk_size <= 0:
+      raise ValueError('Invalid hash chunk size: %s' % chunk_size)
+    _hash_chunk_size = chunk_size
+  if mmap_threshold is not None:
+    _hash_mmap_threshold = mmap_threshold
+  if algorithm is not None:
+    if algorithm not in _HASH_FACTORIES:
+      raise ValueError('Unsupported hash algorithm: %s' % algorithm)
+    _hash_algorithm = algorithm
+
+
+def _update_hash_from_mmap(hash_obj, f):
+  m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  try:
+    for offset in xrange(0, len(m), _hash_chunk_size):
+      hash_obj.update(m[offset:offset + _hash_chunk_size])
+  finally:
+    m.close()
+
+
+def _update_hash_from_file(hash_obj, f):
+  while True:
+    chunk = f.read(_hash_chunk_size)
+    if not chunk:
+      break
+    hash_obj.update(chunk)
+
+
+def _calculate_hash(path, algorithm=None):
+  algorithm = algorithm or _hash_algorithm
+  hash_obj = _HASH_FACTORIES[algorithm]()
   f = open(path, 'rb')
   try:
-    sha1.update(f.read())
+    if (_hash_mmap_threshold and
+        os.fstat(f.fileno()).st_size >= _hash_mmap_threshold):
+      try:
+        _update_hash_from_mmap(hash_obj, f)
+        return _tag_hash(algorithm, hash_obj.hexdigest())
+      except (EnvironmentError, ValueError):
+        # Not mappable, e.g. the file is truncated, read it instead
+        hash_obj = _HASH_FACTORIES[algorithm]()
+        f.seek(0)
+    _update_hash_from_file(hash_obj, f)
   finally:
     f.close()
-  return sha1.hexdigest()
+  return _tag_hash(algorithm, hash_obj.hexdigest())
+
+
+# Hash of content fed by update, e.g. as it is copied or decompressed, in the
+# current algorithm and tagged as the hashes calculated from files.
+class ContentHash:
+
+  def __init__(self):
+    self._algorithm = _hash_algorithm
+    self._hash_obj = _HASH_FACTORIES[self._algorithm]()
+
+  def update(self, data):
+    self._hash_obj.update(data)
+
+  def file_hash(self):
+    return _tag_hash(self._algorithm, self._hash_obj.hexdigest())
+
+
+# Copy src to dest as shutil.copy2, and return the hash of the content, which
+# is hashed as it is copied rather than read again.
+def copy_file_with_hash(src, dest):
+  content_hash = ContentHash()
+  with open(src, 'rb') as f_src:
+    with open(dest, 'wb') as f_dest:
+      while True:
+        chunk = f_src.read(_hash_chunk_size)
+        if not chunk:
+          break
+        content_hash.update(chunk)
+        f_dest.write(chunk)
+  shutil.copystat(src, dest)
+  return content_hash.file_hash()
+
+
+def calculate_file_hash(path):
+  return _calculate_hash(path)
+
+
+# Compare the content of two files of the same size by hashes. If their
+# hashes are in different algorithms, e.g. one is loaded from a state
+# written in another algorithm, rehash the file hashed in the current
+# algorithm in the algorithm of the other one.
+def _is_same_content(file_info1, file_info2):
+  hash1 = file_info1.calculate_hash()
+  hash2 = file_info2.calculate_hash()
+  algorithm1 = hash_algorithm(hash1)
+  algorithm2 = hash_algorithm(hash2)
+  if algorithm1 == algorithm2:
+    return hash1 == hash2
+  if algorithm1 == _hash_algorithm:
+    fresh_file_info, stale_hash, stale_algorithm = (
+        file_info1, hash2, algorithm2)
+  else:
+    fresh_file_info, stale_hash, stale_algorithm = (
+        file_info2, hash1, algorithm1)
+  if stale_algorithm not in _HASH_FACTORIES:
+    return False
+  return _calculate_hash(fresh_file_info.path,
+                         algorithm=stale_algorithm) == stale_hash
 
 
-def copy_with_tmp_file(file_info, tmp_file, tmp_dir):
+def _get_cached_hash(hash_cache, path, stat):
+  file_hash = hash_cache.get(path, stat)
+  if file_hash and hash_algorithm(file_hash) != _hash_algorithm:
+    # Cached in another algorithm, rehash it
+    return None
+  return file_hash
+
+
+# Only hash the file if its stat signature is not in hash_cache.
+def _calculate_hash_with_cache(path, stat, hash_cache):
+  if hash_cache is None:
+    return _calculate_hash(path)
+  file_hash = _get_cached_hash(hash_cache, path, stat)
+  if file_hash is None:
+    file_hash = _calculate_hash(path)
+    hash_cache.put(path, stat, file_hash)
+  return file_hash
+
+
+# file_hash, if given, is the hash of tmp_file calculated as it is written.
+def copy_with_tmp_file(file_info, tmp_file, tmp_dir, file_hash=None):
   # When tmp_file is available, always calculate its hash
-  file_hash=file_info.file_hash
+  file_hash = file_info.file_hash or file_hash
   full_tmp_path = os.path.join(tmp_dir, tmp_file)
   if not file_hash and tmp_file:
     file_hash = _calculate_hash(full_tmp_path)
@@ -124,23 +389,30 @@ def copy_with_tmp_file(file_info, tmp_file, tmp_dir):
                   file_info.size, file_info.last_modified_time,
                   file_hash=file_hash, tmp_file=full_tmp_path,
                   original_file_info=file_info.original_file_info,
-                  compressed_file_info=file_info.compressed_file_info)
+                  compressed_file_info=file_info.compressed_file_info,
+                  mtime_ns=file_info.mtime_ns)
 
 
-def load_file_info(path, calculate_hash=False):
-  if not os.path.exists(path):
-    return None
+def _file_info_from_stat(path, stat, calculate_hash=False, hash_cache=None):
+  is_dir = stat_module.S_ISDIR(stat.st_mode)
+  file_hash = None
+  if calculate_hash and not is_dir:
+    file_hash = _calculate_hash_with_cache(path, stat, hash_cache)
+  return FileInfo(
+      path,
+      is_dir,
+      stat.st_mode,
+      stat.st_size if not is_dir else None,
+      stat.st_mtime,
+      file_hash=file_hash,
+      mtime_ns=util.stat_mtime_ns(stat))
+
+
+def load_file_info(path, calculate_hash=False, hash_cache=None):
   try:
-    stat = os.stat(path)
-    is_dir = os.path.isdir(path)
-    file_hash = _calculate_hash(path) if calculate_hash and not is_dir else None
-    return FileInfo(
-        path,
-        is_dir,
-        stat.st_mode,
-        stat.st_size if not is_dir else None,
-        stat.st_mtime,
-        file_hash=file_hash)
+    return _file_info_from_stat(path, os.stat(path),
+                                calculate_hash=calculate_hash,
+                                hash_cache=hash_cache)
   except:
     return None
 
@@ -153,19 +425,28 @@ def load_from_csv_row(row):
       row[1] == '1',
       int(row[2]),
       int(row[3]) if int(row[3]) >= 0 else None,
-      float(row[4]),
+      None,
       row[5] or None,
-      compressed_file_info=load_from_csv_row(row[6:]))
+      compressed_file_info=load_from_csv_row(row[6:]),
+      mtime_ns=util.parse_mtime_ns(row[4]))
 
 
 # A sorted list of file info in the directory
 class DirInfo:
 
-  def __init__(self, base_dir, file_info_list, dir_info_dict, key=None):
-    self._file_info_list = _sort_file_info_list(list(file_info_list), key=key)
-    self._fi_dict = dict([(x.path, x) for x in self._file_info_list])
+  # presorted means that file_info_list is already sorted by key.
+  def __init__(self, base_dir, file_info_list, dir_info_dict, key=None,
+               presorted=False):
+    if presorted:
+      self._file_info_list = list(file_info_list)
+    else:
+      self._file_info_list = _sort_file_info_list(list(file_info_list),
+                                                  key=key)
+    # By name, as all the entries are in the same dir
+    self._fi_dict = dict([(x._name, x) for x in self._file_info_list])
     self._dir_info_dict = dir_info_dict
     self._base_dir = base_dir
+    self._path_index_dict = None
 
   def base_dir(self):
     return self._base_dir
@@ -176,6 +457,17 @@ class DirInfo:
   def dir_info(self, dir_path):
     return self._dir_info_dict[dir_path]
 
+  # The file info of path directly in this dir, or None if not found.
+  def child(self, path):
+    fi = self._fi_dict.get(path_trie.name_of(path))
+    if fi is not None and fi.path == path:
+      return fi
+    return None
+
+  # The DirInfo of the dir path directly in this dir, or None if not found.
+  def child_dir_info(self, path):
+    return self._dir_info_dict.get(path)
+
   def flat_file_info_list(self):
     for fi in self._file_info_list:
       yield fi
@@ -184,77 +476,342 @@ class DirInfo:
         for sub_fi in self._dir_info_dict[fi.path].flat_file_info_list():
           yield sub_fi
 
+  # Flat index of the whole tree by path, built on first lookup so that the
+  # dir infos which are never looked up, e.g. the states, do not pay for it.
+  def _path_index(self):
+    if self._path_index_dict is None:
+      self._path_index_dict = dict(
+          [(x.path, x) for x in self.flat_file_info_list()])
+    return self._path_index_dict
+
   def has_file(self, path):
-    # Hack since '.' shows up twice in DirInfo tree
-    if '.' in self._dir_info_dict:
-      return self._dir_info_dict['.'].has_file(path)
-    relpath = os.path.relpath(path, self._base_dir)
-    if '..' in relpath:
-      return False
-    relpath_split = relpath.split(os.sep)
-    if len(relpath_split) == 1:
-      return path in self._fi_dict
-    else:
-      next_base = os.path.join(self._base_dir, relpath_split[0])
-      if next_base in self._dir_info_dict:
-        return self._dir_info_dict[next_base].has_file(path)
-      else:
-        return False
+    return path in self._path_index()
 
   def get(self, path):
-    # Hack since '.' shows up twice in DirInfo tree
-    if '.' in self._dir_info_dict:
-      return self._dir_info_dict['.'].get(path)
-    relpath = os.path.relpath(path, self._base_dir)
-    if '..' in relpath:
-      return None
-    relpath_split = relpath.split(os.sep)
-    if len(relpath_split) == 1:
-      return self._fi_dict.get(path)
-    else:
-      next_base = os.path.join(self._base_dir, relpath_split[0])
-      if next_base in self._dir_info_dict:
-        return self._dir_info_dict[next_base].get(path)
-      else:
-        return None
+    return self._path_index().get(path)
+
+  def _remove(self, file_info):
+    self._file_info_list.remove(file_info)
+    del self._fi_dict[file_info._name]
+    if self._path_index_dict is not None:
+      del self._path_index_dict[file_info.path]
 
   def write_to_csv(self, f):
-    for entry in self.flat_file_info_list():
-      entry.calculate_hash()
-      f.write(entry.to_csv())
-      f.write('\n')
+    write_file_info_list_to_csv(f, self.flat_file_info_list())
+
+
+def _path_for_sorting_key(file_info):
+  return file_info.path_for_sorting()
 
 
 def _sort_file_info_list(file_info_list, key=None):
-  if not key:
-    key=lambda file_info: file_info.path_for_sorting()
-  file_info_list.sort(key=key)
+  file_info_list.sort(key=key or _path_for_sorting_key)
   return file_info_list
 
 
+# The fields of the CSV rows of file info which are text, i.e. the paths and
+# hashes of the file info and its compressed file info. The others are
+# numbers, which are parsed from the UTF-8 bytes without decoding.
+_CSV_TEXT_FIELDS = (0, 5, 6, 11)
+
+
+# Write the rows of file_info_list with one writer, rather than one per row
+# as to_csv. Missing hashes are calculated if calculate_hash.
+def write_file_info_list_to_csv(f, file_info_list, calculate_hash=True):
+  writer = i18n.UTF8Writer(f, lineterminator='\n')
+  writer.writerows(_csv_rows(file_info_list, calculate_hash))
+
+
+def _csv_rows(file_info_list, calculate_hash):
+  for fi in file_info_list:
+    if calculate_hash:
+      fi.calculate_hash()
+    yield fi.to_array(show_compressed_level=1)
+
+
+def load_file_info_list_from_csv(f):
+  for row in i18n.UTF8Reader(f, unicode_fields=_CSV_TEXT_FIELDS):
+    if len(row) >= 6:
+      yield load_from_csv_row(row)
+
+
+# The rows are expected in the order written by DirInfo.write_to_csv, so the
+# dirs are built as the rows are read without sorting them again.
 def load_dir_info_from_csv(f, base_dir, key=None):
-  reader = i18n.UnicodeReader(f)
-  file_info_list = []
-  for row in reader:
-    if len(row) < 6:
-      continue
-    file_info_list.append(load_from_csv_row(row))
-  dir_info, unused = _sorted_file_info_list_to_dir_info(
-      base_dir, file_info_list, 0, key=key)
-  return dir_info
+  return _sorted_file_info_list_to_dir_info(
+      base_dir, load_file_info_list_from_csv(f), key=key)
+
+
+# Yield (name, stat) of the entries in dir_path, following symlinks like
+# os.stat. Symlinks to directories are skipped as os.walk does not descend
+# into them. Costs one listing plus one stat per entry.
+def _list_dir(dir_path):
+  if _scandir:
+    entries = _scandir(dir_path)
+    for entry in entries:
+      try:
+        if entry.is_symlink() and entry.is_dir():
+          continue
+        yield entry.name, entry.stat()
+      except OSError:
+        # The entry is removed or a broken symlink
+        pass
+  else:
+    for name in os.listdir(dir_path):
+      path = os.path.join(dir_path, name)
+      try:
+        stat = os.lstat(path)
+        if stat_module.S_ISLNK(stat.st_mode):
+          stat = os.stat(path)
+          if stat_module.S_ISDIR(stat.st_mode):
+            continue
+        yield name, stat
+      except OSError:
+        pass
+
+
+# Stat the given entries of dir_path the way _list_dir does, skipping the
+# entries which are removed since.
+def _stat_dir_entries(dir_path, names):
+  for name in names:
+    try:
+      yield name, os.stat(os.path.join(dir_path, name))
+    except OSError:
+      pass
+
+
+# A dir mtime moves whenever an entry is added, removed or renamed in it, so
+# an unchanged dir mtime means the names listed last time are still valid,
+# unless the dir changed again right after it was listed, within the
+# timestamp granularity of the file system, e.g. a jiffy on ext4 or 2 seconds
+# on FAT. So the listing is only taken if the dir mtime is older than the
+# scan of the old listing, at old_scan_time_ns, by more than
+# _RACY_DIR_MTIME_NS.
+_RACY_DIR_MTIME_NS = 2000000000
+
+
+def _is_same_dir_listing(dir_file_info, old_dir_file_info, old_scan_time_ns):
+  if (not old_dir_file_info or not old_dir_file_info.is_dir
+      or old_scan_time_ns is None):
+    return False
+  mtime_ns = dir_file_info.mtime_ns
+  return (mtime_ns == old_dir_file_info.mtime_ns
+          and mtime_ns < old_scan_time_ns - _RACY_DIR_MTIME_NS)
+
+
+# Threads suit hashing bound by disk I/O as hashlib releases the GIL, while
+# processes suit hashing bound by CPU.
+HASH_BACKEND_THREAD = 'thread'
+HASH_BACKEND_PROCESS = 'process'
+
+# Number of files sent to a hash worker at a time
+_HASH_POOL_CHUNKSIZE = 16
 
 
-# recursively
-def load_dir_info(dir_path, calculate_hash=False, key=None):
+def _calculate_hash_or_none(path):
+  try:
+    return _calculate_hash(path)
+  except EnvironmentError:
+    return None
+
+
+# Copy a DirInfo with only what a scan would fill in the file info, i.e.
+# without tmp files or compressed file info attached during a sync.
+def _copy_as_scanned(dir_info):
   file_info_list = []
-  for root, dirs, files in os.walk(dir_path):
-    file_info_list.append(load_file_info(root))
-    for f in files:
-      file_info_list.append(load_file_info(os.path.join(root, f),
-                            calculate_hash=calculate_hash))
-  dir_info, unused = _sorted_file_info_list_to_dir_info(
-      dir_path, file_info_list, 0, key=key)
-  return dir_info
+  dir_info_dict = {}
+  for fi in dir_info.file_info_list():
+    file_info_list.append(FileInfo(
+        fi.path, fi.is_dir, fi.mode, fi.size, fi.last_modified_time,
+        file_hash=fi.file_hash, mtime_ns=fi.mtime_ns))
+    sub_dir_info = dir_info.child_dir_info(fi.path)
+    if fi.is_dir and sub_dir_info is not None:
+      dir_info_dict[fi.path] = _copy_as_scanned(sub_dir_info)
+  return DirInfo(dir_info.base_dir(), file_info_list, dir_info_dict,
+                 presorted=True)
+
+
+# Whether the file of path and stat is new or of another size than in
+# old_dir_info, i.e. certainly modified.
+def _is_changed_size(path, stat, old_dir_info):
+  old_fi = old_dir_info.child(path) if old_dir_info is not None else None
+  return old_fi is None or old_fi.is_dir or old_fi.size != stat.st_size
+
+
+# Scan a dir tree into a DirInfo tree. With hash_workers > 1, the files which
+# are not in hash_cache are hashed in a worker pool once the whole tree is
+# listed, and the resulting DirInfo is the same as the one hashed serially.
+#
+# With defer_hash, the files certainly changed since old_dir_info, i.e. new
+# or of another size, are left unhashed, as get_dir_changes hashes them while
+# copying them into tmp files. They are deferred in hash_cache, if any, until
+# put_deferred with their hashes.
+class _DirScanner:
+
+  def __init__(self, calculate_hash=False, hash_cache=None, hash_workers=1,
+               hash_backend=HASH_BACKEND_THREAD, old_dir_info=None,
+               dirty_paths=None, defer_hash=False, old_scan_time_ns=None):
+    self._calculate_hash = calculate_hash
+    self._defer_hash = calculate_hash and defer_hash
+    self._hash_cache = hash_cache
+    self._hash_workers = hash_workers or 1
+    self._hash_backend = hash_backend
+    # List of (file_info, stat, dir_path) to hash in the worker pool
+    self._pending_hashes = []
+    self._dir_infos = {}
+    self._old_dir_info = old_dir_info
+    self._old_scan_time_ns = old_scan_time_ns
+    # Only the dirs on the way to dirty paths are scanned if dirty_paths is
+    # given, and all the other subtrees are taken from old_dir_info. A dirty
+    # path which is a dir is scanned in full.
+    self._dirty_paths = None
+    self._dirty_ancestors = None
+    if dirty_paths is not None and old_dir_info is not None:
+      self._dirty_paths = set(dirty_paths)
+      self._dirty_ancestors = set()
+      for path in self._dirty_paths:
+        path = os.path.dirname(path)
+        while path and path not in self._dirty_ancestors:
+          self._dirty_ancestors.add(path)
+          path = os.path.dirname(path)
+    # Number of dirs whose listing is reused from old_dir_info
+    self.reused_dirs = 0
+    # Number of subtrees taken from old_dir_info without any scan
+    self.reused_subtrees = 0
+
+  def scan(self, dir_path, key=None):
+    root_file_info = load_file_info(dir_path)
+    if not root_file_info or not root_file_info.is_dir:
+      return DirInfo(dir_path, [], {}, key=key)
+    old_root_file_info = None
+    old_root_dir_info = None
+    if self._old_dir_info:
+      old_root_file_info = self._old_dir_info.child(dir_path)
+      old_root_dir_info = self._old_dir_info.child_dir_info(dir_path)
+    restricted = (self._dirty_paths is not None
+                  and dir_path not in self._dirty_paths)
+    dir_info = DirInfo(
+        dir_path, [root_file_info],
+        {dir_path: self._scan_dir(root_file_info, old_root_file_info,
+                                  old_root_dir_info, restricted)},
+        key=key)
+    if self._pending_hashes:
+      self._calculate_pending_hashes()
+    if self._calculate_hash:
+      set_dir_digests(dir_info)
+    return dir_info
+
+  # Load the sorted DirInfo of the entries in the dir of dir_file_info.
+  # old_dir_file_info and old_dir_info are the same dir in old_dir_info, if
+  # any. The dir is always stat'ed before its entries are listed, so a change
+  # during the scan moves the dir mtime past the one recorded. If restricted,
+  # the subdirs which are not on the way to dirty paths are not scanned.
+  def _scan_dir(self, dir_file_info, old_dir_file_info=None,
+                old_dir_info=None, restricted=False):
+    file_info_list = []
+    dir_info_dict = {}
+    parallel = self._calculate_hash and self._hash_workers > 1
+    if (old_dir_info is not None
+        and _is_same_dir_listing(dir_file_info, old_dir_file_info,
+                                 self._old_scan_time_ns)):
+      self.reused_dirs += 1
+      names = [os.path.basename(x.path)
+               for x in old_dir_info.file_info_list()]
+      entries = sorted(_stat_dir_entries(dir_file_info.path, names))
+    else:
+      try:
+        entries = sorted(_list_dir(dir_file_info.path))
+      except OSError:
+        # Unreadable dir is treated as empty like os.walk
+        entries = []
+    for name, stat in entries:
+      path = os.path.join(dir_file_info.path, name)
+      deferred = (self._defer_hash and not stat_module.S_ISDIR(stat.st_mode)
+                  and _is_changed_size(path, stat, old_dir_info))
+      try:
+        fi = _file_info_from_stat(
+            path, stat,
+            calculate_hash=(self._calculate_hash and not parallel
+                            and not deferred),
+            hash_cache=self._hash_cache)
+      except EnvironmentError:
+        continue
+      file_info_list.append(fi)
+      if deferred:
+        if self._hash_cache is not None:
+          self._hash_cache.defer(path, stat)
+      elif fi.is_dir:
+        old_sub_file_info = None
+        old_sub_dir_info = None
+        if old_dir_info is not None:
+          old_sub_file_info = old_dir_info.child(path)
+          old_sub_dir_info = old_dir_info.child_dir_info(path)
+        if (restricted and old_sub_dir_info is not None
+            and path not in self._dirty_paths
+            and path not in self._dirty_ancestors):
+          self.reused_subtrees += 1
+          dir_info_dict[path] = _copy_as_scanned(old_sub_dir_info)
+        else:
+          dir_info_dict[path] = self._scan_dir(
+              fi, old_sub_file_info, old_sub_dir_info,
+              restricted and path not in self._dirty_paths)
+      elif parallel:
+        if self._hash_cache is not None:
+          fi.file_hash = _get_cached_hash(self._hash_cache, path, stat)
+        if fi.file_hash is None:
+          self._pending_hashes.append((fi, stat, dir_file_info.path))
+    # Sorting by name is sorting by path_for_sorting among siblings
+    dir_info = DirInfo(dir_file_info.path, file_info_list, dir_info_dict,
+                       presorted=True)
+    if parallel:
+      self._dir_infos[dir_file_info.path] = dir_info
+    return dir_info
+
+  def _calculate_pending_hashes(self):
+    if self._hash_backend == HASH_BACKEND_PROCESS:
+      pool = multiprocessing.Pool(
+          self._hash_workers, initializer=configure_hashing,
+          initargs=(_hash_chunk_size, _hash_mmap_threshold,
+                    _hash_algorithm))
+    else:
+      pool = multiprocessing.pool.ThreadPool(self._hash_workers)
+    try:
+      file_hashes = pool.imap(
+          _calculate_hash_or_none,
+          [fi.path for fi, stat, dir_path in self._pending_hashes],
+          _HASH_POOL_CHUNKSIZE)
+      for (fi, stat, dir_path), file_hash in itertools.izip(
+          self._pending_hashes, file_hashes):
+        if file_hash is None:
+          # Removed or unreadable since listed, drop it like the serial scan
+          self._dir_infos[dir_path]._remove(fi)
+          continue
+        fi.file_hash = file_hash
+        if self._hash_cache is not None:
+          self._hash_cache.put(fi.path, stat, file_hash)
+    finally:
+      pool.close()
+      pool.join()
+    self._pending_hashes = []
+
+
+# Load recursively. If old_dir_info is given, e.g. the state of the last
+# sync, with old_scan_time_ns, e.g. the mtime of the state file, the listing
+# of the dirs whose mtime is unchanged since is taken from it rather than read
+# again. See _is_same_dir_listing.
+# If dirty_paths is also given, e.g. by a watcher, only the dirs on the way to
+# them are scanned and the rest is taken from old_dir_info as is. See
+# _DirScanner for defer_hash.
+def load_dir_info(dir_path, calculate_hash=False, key=None, hash_cache=None,
+                  hash_workers=1, hash_backend=HASH_BACKEND_THREAD,
+                  old_dir_info=None, dirty_paths=None, defer_hash=False,
+                  old_scan_time_ns=None):
+  return _DirScanner(
+      calculate_hash=calculate_hash, hash_cache=hash_cache,
+      hash_workers=hash_workers, hash_backend=hash_backend,
+      old_dir_info=old_dir_info, dirty_paths=dirty_paths,
+      defer_hash=defer_hash, old_scan_time_ns=old_scan_time_ns).scan(
+          dir_path, key=key)
 
 
 # Load as relative path
@@ -267,35 +824,94 @@ def load_rel_dir_info(dir_path, key=None):
 
 
 def load_dir_info_from_file_info_list(base_dir, file_info_list, key=None):
-  dir_info, unused = _sorted_file_info_list_to_dir_info(
-      base_dir, _sort_file_info_list(file_info_list, key=key), 0)
-  return dir_info
+  return _sorted_file_info_list_to_dir_info(
+      base_dir, _sort_file_info_list(list(file_info_list), key=key), key=key)
+
+
+# A dir has the digest of its entries as its hash, like a tree of git: the
+# name, size, mtime and hash of the files and the name and digest of the
+# subdirs. So equal digests mean that get_dir_changes finds no change in the
+# whole subtree. It is tagged so that it is never taken for a file hash.
+DIR_DIGEST_ALGORITHM = 'tree'
+
+
+def _encode_name(name):
+  if isinstance(name, unicode):
+    return name.encode('utf-8')
+  return name
+
+
+def _dir_digest(dir_info):
+  digest = hashlib.sha1()
+  for fi in dir_info.file_info_list() if dir_info else []:
+    if fi.is_dir:
+      fi.file_hash = _dir_digest(dir_info.child_dir_info(fi.path))
+      digest.update('%s\0d\0%s\n' % (_encode_name(fi._name), fi.file_hash))
+    else:
+      digest.update('%s\0f\0%s\0%s\0%s\n' % (
+          _encode_name(fi._name), fi.size, fi.mtime_ns, fi.file_hash or ''))
+  return _tag_hash(DIR_DIGEST_ALGORITHM, digest.hexdigest())
+
+
+# Set the digests of all the dirs in dir_info bottom up. The file info of
+# the dirs is modified, so copy it first if it may be shared.
+def set_dir_digests(dir_info):
+  _dir_digest(dir_info)
 
 
 def empty_dir_info(dir_path):
   stat = os.stat(dir_path)
   return DirInfo(
       dir_path,
-      [FileInfo(dir_path, True, stat.st_mode, None, stat.st_mtime)],
+      [FileInfo(dir_path, True, stat.st_mode, None, stat.st_mtime,
+                mtime_ns=util.stat_mtime_ns(stat))],
       {dir_path: None})
 
 
-def _sorted_file_info_list_to_dir_info(
-    base, sorted_file_info_list, start_index, key=None):
-  i = start_index
-  base_file_info_list = []
-  base_dir_info_dict = {}
-  while i < len(sorted_file_info_list):
-    fi = sorted_file_info_list[i]
-    if '..' in os.path.relpath(fi.path, base):
-      break
+# Build the DirInfo tree in one pass over file info sorted by path, i.e. in
+# the order of flat_file_info_list, by keeping the dirs being filled in a
+# stack. An entry belongs to the innermost dir in the stack which is its
+# parent. Each dir is only sorted again if its entries are out of order,
+# e.g. if the list is sorted by a different key.
+def _sorted_file_info_list_to_dir_info(base_dir, sorted_file_info_list,
+                                       key=None):
+  top = _DirInfoBuilder(base_dir, key=key)
+  stack = []
+  for fi in sorted_file_info_list:
+    parent = os.path.dirname(fi.path)
+    while stack and stack[-1].base_dir != parent:
+      _pop_dir_info_builder(stack, top)
+    (stack[-1] if stack else top).add(fi)
     if fi.is_dir:
-      base_file_info_list.append(fi)
-      dir_info, i = _sorted_file_info_list_to_dir_info(
-          fi.path, sorted_file_info_list, i + 1)
-      base_dir_info_dict[fi.path] = dir_info
-    else:
-      base_file_info_list.append(fi)
-    i += 1
-  return DirInfo(base, base_file_info_list, base_dir_info_dict, key=key), i - 1
-
+      stack.append(_DirInfoBuilder(fi.path))
+  while stack:
+    _pop_dir_info_builder(stack, top)
+  return top.build()
+
+
+def _pop_dir_info_builder(stack, top):
+  builder = stack.pop()
+  (stack[-1] if stack else top).dir_info_dict[builder.base_dir] = (
+      builder.build())
+
+
+class _DirInfoBuilder:
+
+  def __init__(self, base_dir, key=None):
+    self.base_dir = base_dir
+    self.dir_info_dict = {}
+    self._key = key or _path_for_sorting_key
+    self._file_info_list = []
+    self._last_key = None
+    self._is_sorted = True
+
+  def add(self, fi):
+    k = self._key(fi)
+    if self._last_key is not None and k < self._last_key:
+      self._is_sorted = False
+    self._last_key = k
+    self._file_info_list.append(fi)
+
+  def build(self):
+    return DirInfo(self.base_dir, self._file_info_list, self.dir_info_dict,
+                   key=self._key, presorted=self._is_sorted)
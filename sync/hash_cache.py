@@ -0,0 +1,149 @@
+import hashlib
+import os
+import time
+
+from util import i18n
+from util import util
+
+DEFAULT_FINGERPRINT_BLOCK_SIZE = 64 * 1024
+DEFAULT_FINGERPRINT_VERIFY_DAYS = 30
+
+
+def stat_signature(stat):
+  return (stat.st_dev, stat.st_ino, stat.st_size,
+          util.stat_mtime_ns(stat), util.stat_ctime_ns(stat))
+
+
+# The size and SHA1 of the head, middle and tail blocks of a file, i.e. a
+# cheap check whether the content of a file is still the same when only its
+# stat changes, e.g. the mtime touched by a backup tool. Small files are
+# sampled as a whole.
+def sample_fingerprint(path, size, block_size=DEFAULT_FINGERPRINT_BLOCK_SIZE):
+  sha1 = hashlib.sha1()
+  sha1.update('%d\n' % size)
+  with open(path, 'rb') as f:
+    if size <= 3 * block_size:
+      sha1.update(f.read())
+    else:
+      for offset in [0, (size - block_size) // 2, size - block_size]:
+        f.seek(offset)
+        sha1.update(f.read(block_size))
+  return sha1.hexdigest()
+
+
+# Content hashes of the files in one directory tree, keyed by path and
+# validated by the stat signature (device, inode, size, mtime_ns, ctime_ns).
+# A file is only re-hashed when its stat signature changes, or when
+# force_verify is set.
+#
+# With fingerprint, the sample_fingerprint of a file is also kept, and a
+# file whose stat signature changes but not its size or fingerprint keeps
+# its hash. It is still re-hashed in full if it has not been for
+# fingerprint_verify_days, as the samples do not cover the whole file.
+class HashCache:
+
+  def __init__(self, force_verify=False, fingerprint=False,
+               fingerprint_verify_days=DEFAULT_FINGERPRINT_VERIFY_DAYS):
+    self.force_verify = force_verify
+    self.fingerprint = fingerprint
+    self.fingerprint_verify_days = fingerprint_verify_days
+    self.hits = 0
+    self.fingerprint_hits = 0
+    self.misses = 0
+    # path -> (signature, file_hash, fingerprint, time of the full hash)
+    self._entries = {}
+    self._seen = set()
+    # path -> (stat, fingerprint) of the deferred files
+    self._deferred = {}
+
+  def get(self, path, stat):
+    self._seen.add(path)
+    entry = self._entries.get(path)
+    if not self.force_verify and entry is not None:
+      signature = stat_signature(stat)
+      if entry[0] == signature:
+        self.hits += 1
+        return entry[1]
+      if self._is_same_fingerprint(path, stat, entry):
+        self.fingerprint_hits += 1
+        self._entries[path] = (signature,) + entry[1:]
+        return entry[1]
+    self.misses += 1
+    return None
+
+  def _is_same_fingerprint(self, path, stat, entry):
+    if (not self.fingerprint or not entry[2]
+        or entry[0][2] != stat.st_size
+        or time.time() - entry[3] > self.fingerprint_verify_days * 86400):
+      return False
+    try:
+      return sample_fingerprint(path, stat.st_size) == entry[2]
+    except EnvironmentError:
+      return False
+
+  # The fingerprint is sampled now unless given, and only kept if the file
+  # still has stat afterwards, so that it is of the content file_hash is of.
+  def put(self, path, stat, file_hash, fingerprint=None):
+    self._seen.add(path)
+    if fingerprint is None:
+      fingerprint = self._sample_fingerprint(path, stat)
+    self._entries[path] = (stat_signature(stat), file_hash, fingerprint or '',
+                           int(time.time()))
+
+  def _sample_fingerprint(self, path, stat):
+    if not self.fingerprint:
+      return ''
+    try:
+      fingerprint = sample_fingerprint(path, stat.st_size)
+      if stat_signature(os.stat(path)) != stat_signature(stat):
+        return ''
+      return fingerprint
+    except EnvironmentError:
+      return ''
+
+  # Keep the stat of a file left unhashed by a scan, to be put once it is
+  # hashed elsewhere, e.g. while copied. The fingerprint is sampled along
+  # with the stat, as the file may be rewritten by then.
+  def defer(self, path, stat):
+    self._seen.add(path)
+    self._deferred[path] = (stat, self._sample_fingerprint(path, stat))
+
+  def put_deferred(self, path, file_hash):
+    deferred = self._deferred.pop(path, None)
+    if deferred is not None and file_hash:
+      self.put(path, deferred[0], file_hash, fingerprint=deferred[1])
+
+  def __len__(self):
+    return len(self._entries)
+
+  # Drop the entries which are not looked up since loaded, i.e. the files
+  # which do not exist anymore after a full scan.
+  def prune(self):
+    for path in self._entries.keys():
+      if path not in self._seen:
+        del self._entries[path]
+
+  def write_to_csv(self, f):
+    i18n.UTF8Writer(f).writerows(self._csv_rows())
+
+  def _csv_rows(self):
+    for path in sorted(self._entries.keys()):
+      signature, file_hash, fingerprint, hash_time = self._entries[path]
+      yield ([path] + [str(x) for x in signature] +
+             [file_hash, fingerprint, str(hash_time)])
+
+
+# The fingerprint and the time of the full hash are absent in the rows
+# written before fingerprints.
+def load_hash_cache_from_csv(f, force_verify=False, fingerprint=False,
+                             fingerprint_verify_days=
+                                 DEFAULT_FINGERPRINT_VERIFY_DAYS):
+  hash_cache = HashCache(force_verify=force_verify, fingerprint=fingerprint,
+                         fingerprint_verify_days=fingerprint_verify_days)
+  for row in i18n.UTF8Reader(f, unicode_fields=(0, 6)):
+    if len(row) < 7:
+      continue
+    hash_cache._entries[row[0]] = (
+        tuple(int(x) for x in row[1:6]), row[6],
+        row[7] if len(row) >= 9 else '', int(row[8]) if len(row) >= 9 else 0)
+  return hash_cache
@@ -1,5 +1,4 @@
 import collections
-import copy
 import os
 import random
 import shutil
@@ -10,7 +9,7 @@ from util import util
 
 
 def _sync_conflict(change, dc_conflict, dir_changes=None):
-  cur_info = copy.deepcopy(change.cur_info) if change.cur_info else None
+  cur_info = change.cur_info
   content_status = change_entry.CONTENT_STATUS_NO_CHANGE
   if dir_changes and dir_changes.changes():
     if dir_changes.dir_status() == change_entry.CONTENT_STATUS_NEW:
@@ -30,8 +29,8 @@ def _sync_change(change, dc_new, dc_old, change_on_dc_new=True,
                  content_status_new=change_entry.CONTENT_STATUS_UNSPECIFIED,
                  content_status_old=change_entry.CONTENT_STATUS_UNSPECIFIED,
                  conflict_info=None):
-  cur_info = copy.deepcopy(change.cur_info) if change.cur_info else None
-  old_info = copy.deepcopy(change.old_info) if change.old_info else None
+  cur_info = change.cur_info
+  old_info = change.old_info
   if content_status_new == change_entry.CONTENT_STATUS_UNSPECIFIED:
     content_status_new = change.content_status
     if dir_changes_new and dir_changes_new.changes():
@@ -41,7 +40,7 @@ def _sync_change(change, dc_new, dc_old, change_on_dc_new=True,
           and dir_changes_new.dir_status() !=
               change_entry.CONTENT_STATUS_DELETED):
         # Need recover cur_info
-        cur_info = copy.deepcopy(change.old_info) if change.old_info else None
+        cur_info = change.old_info
         content_status_new = change_entry.CONTENT_STATUS_MODIFIED
       elif content_status_new == change_entry.CONTENT_STATUS_NEW:
         content_status_new = dir_changes_new.dir_status()
@@ -54,7 +53,7 @@ def _sync_change(change, dc_new, dc_old, change_on_dc_new=True,
           and dir_changes_old.dir_status() !=
               change_entry.CONTENT_STATUS_DELETED):
         # Need recover cur_info
-        cur_info = copy.deepcopy(change.old_info) if change.old_info else None
+        cur_info = change.old_info
         content_status_old = change_entry.CONTENT_STATUS_MODIFIED
       elif content_status_old == change_entry.CONTENT_STATUS_NEW:
         content_status_old = dir_changes_old.dir_status()
@@ -242,6 +241,25 @@ def _merge_both_dirs(c1, c2, dc1, dc2,
         _sync_conflict(c1, dc_conflict, results[4])
 
 
+# Both dirs are unchanged as a whole, so are the merged ones, which share the
+# dir changes of the subtree rather than merging it entry by entry. The
+# parents of the subtree are only walked up for deleted entries, which an
+# unchanged subtree has none of.
+def _merge_unchanged_dirs(c1, c2, dc_new1, dc_old1, dc_new2, dc_old2):
+  for c, dc_new, dc_old in [(c1, dc_new1, dc_old1), (c2, dc_new2, dc_old2)]:
+    for dc in [dc_new, dc_old]:
+      dc.add_change(change_entry.ChangeEntry(
+          c.path, c.cur_info, c.old_info,
+          change_entry.CONTENT_STATUS_NO_CHANGE, dir_changes=c.dir_changes,
+          parent_dir_changes=dc))
+
+
+def _is_unchanged_dir(change):
+  return (change is not None and change.dir_changes is not None
+          and change.dir_changes.unchanged
+          and change.content_status == change_entry.CONTENT_STATUS_NO_CHANGE)
+
+
 def _is_file_change(change):
   if not change:
     return True
@@ -284,10 +302,12 @@ def merge(dir_changes1, dir_changes2,
   for c1, c2 in util.merge_two_iterators(
       iter(dir_changes1.changes() if dir_changes1 else []),
       iter(dir_changes2.changes() if dir_changes2 else []),
-      key_func=lambda x: util.path_for_sorting(x.path)):
+      key_func=lambda x: x.path_for_sorting()):
     if _is_file_change(c1) and _is_file_change(c2):
       _merge_both_files(c1, c2, dc_new1, dc_old1, dc_new2, dc_old2,
                         dc_conflict)
+    elif _is_unchanged_dir(c1) and _is_unchanged_dir(c2):
+      _merge_unchanged_dirs(c1, c2, dc_new1, dc_old1, dc_new2, dc_old2)
     else:
       _merge_both_dirs(c1, c2,
                        dir_changes1.dir_changes(c1.path) if c1 else None,
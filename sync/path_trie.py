@@ -0,0 +1,83 @@
+import os
+import weakref
+
+from util import util
+
+
+# A dir of the path trie. The path of an entry is split into the DirNode of
+# its parent dir and its own name, so that the entries of a dir share one
+# copy of the dir path instead of each keeping the full path. The full path
+# is only materialized on access, e.g. to touch the file system.
+#
+# Nodes are interned by prefix, i.e. the dir path with the trailing os.sep,
+# and freed once no entry refers to them any more. str and unicode paths are
+# interned separately so that joining never mixes them.
+class DirNode(object):
+
+  __slots__ = ('parent', 'name', 'prefix', 'sort_prefix', '__weakref__')
+
+  def __init__(self, parent, name, prefix):
+    self.parent = parent
+    self.name = name
+    self.prefix = prefix
+    self.sort_prefix = util.path_for_sorting(prefix)
+
+
+_dir_nodes = {
+    str: weakref.WeakValueDictionary(),
+    unicode: weakref.WeakValueDictionary()}
+
+# Siblings are split one after another, so the last node is checked before
+# the weak dict.
+_last_dir_node = [None]
+
+
+def _dir_node(prefix):
+  nodes = _dir_nodes[type(prefix)]
+  node = nodes.get(prefix)
+  if node is None:
+    i = prefix.rfind(os.sep, 0, len(prefix) - 1)
+    if i < 0:
+      node = DirNode(None, prefix[:-1], prefix)
+    else:
+      node = DirNode(_dir_node(prefix[:i + 1]), prefix[i + 1:-1], prefix)
+    nodes[prefix] = node
+  _last_dir_node[0] = node
+  return node
+
+
+# Return (dir_node, name) of path, where dir_node is None if path has no
+# parent dir, e.g. '.'. join(*split(path)) == path for any path.
+def split(path):
+  i = path.rfind(os.sep)
+  if i < 0 or i == len(path) - 1:
+    # No parent, or a path like '/' which is kept as a whole
+    return None, path
+  prefix = path[:i + 1]
+  last = _last_dir_node[0]
+  if (last is not None and last.prefix == prefix
+      and type(last.prefix) is type(prefix)):
+    return last, path[i + 1:]
+  return _dir_node(prefix), path[i + 1:]
+
+
+def join(dir_node, name):
+  if dir_node is None:
+    return name
+  return dir_node.prefix + name
+
+
+# The name in split(path), without interning the parent dir.
+def name_of(path):
+  i = path.rfind(os.sep)
+  if i < 0 or i == len(path) - 1:
+    return path
+  return path[i + 1:]
+
+
+# util.path_for_sorting(join(dir_node, name)) without the replace over the
+# whole path, as name has no os.sep.
+def path_for_sorting(dir_node, name):
+  if dir_node is None:
+    return util.path_for_sorting(name)
+  return dir_node.sort_prefix + name
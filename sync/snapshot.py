@@ -0,0 +1,139 @@
+import errno
+import os
+import shutil
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+from sync import file_info
+from util import fastcopy
+from util import util
+
+# Snapshots of the changed files in the tmp dir, taken by the cheapest of:
+#   reflink: a copy-on-write clone by the FICLONE ioctl, e.g. on btrfs and
+#       xfs, which shares the blocks until either file is written.
+#   hardlink: a link to the same inode, which is only read and changes with
+#       the source, so it is verified by is_intact after being read, and
+#       detached into a copy if the source has changed meanwhile.
+#   copy: a byte copy by fastcopy, in the kernel where possible.
+STRATEGY_REFLINK = 'reflink'
+STRATEGY_HARDLINK = 'hardlink'
+STRATEGY_COPY = 'copy'
+STRATEGIES = [STRATEGY_REFLINK, STRATEGY_HARDLINK, STRATEGY_COPY]
+
+# _IOW(0x94, 9, int) of linux/fs.h
+_FICLONE = 0x40049409
+
+_use_reflink = fcntl is not None
+_use_hardlink = hasattr(os, 'link')
+
+# Number of snapshots taken by each strategy, and of hardlinks detached
+counts = dict((x, 0) for x in STRATEGIES)
+detached = [0]
+
+# (st_dev, st_ino) of the hardlinks taken -> (size, mtime_ns) at the time.
+# Keyed by inode, as the tmp files are renamed while compressed.
+_hardlinks = {}
+
+
+def configure(reflink=None, hardlink=None):
+  global _use_reflink, _use_hardlink
+  if reflink is not None:
+    _use_reflink = reflink and fcntl is not None
+  if hardlink is not None:
+    _use_hardlink = hardlink and hasattr(os, 'link')
+
+
+# Reset the counts, and forget the hardlinks once their snapshots are used,
+# e.g. at the start of a sync.
+def reset():
+  for strategy in STRATEGIES:
+    counts[strategy] = 0
+  detached[0] = 0
+  _hardlinks.clear()
+
+
+def _signature(stat):
+  return stat.st_size, util.stat_mtime_ns(stat)
+
+
+def _reflink(src, dest):
+  with open(src, 'rb') as f_src:
+    with open(dest, 'wb') as f_dest:
+      fcntl.ioctl(f_dest.fileno(), _FICLONE, f_src.fileno())
+  shutil.copystat(src, dest)
+
+
+def _is_unsupported(e):
+  return e.errno in (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY,
+                     errno.EINVAL, errno.EPERM, errno.EMLINK, errno.ENOSYS)
+
+
+# Snapshot src to dest by reflink or hardlink. Return the strategy used, or
+# None if neither is supported.
+def _link(src, dest):
+  if _use_reflink:
+    try:
+      _reflink(src, dest)
+      counts[STRATEGY_REFLINK] += 1
+      return STRATEGY_REFLINK
+    except EnvironmentError as e:
+      if os.path.exists(dest):
+        os.remove(dest)
+      if not _is_unsupported(e):
+        raise
+  if _use_hardlink:
+    try:
+      os.link(src, dest)
+      stat = os.stat(dest)
+      _hardlinks[(stat.st_dev, stat.st_ino)] = _signature(stat)
+      counts[STRATEGY_HARDLINK] += 1
+      return STRATEGY_HARDLINK
+    except OSError as e:
+      if not _is_unsupported(e):
+        raise
+  return None
+
+
+# Snapshot src to dest, which does not exist, as by shutil.copy2. Return the
+# strategy used.
+def take(src, dest):
+  strategy = _link(src, dest)
+  if strategy is None:
+    fastcopy.copy2(src, dest)
+    counts[STRATEGY_COPY] += 1
+    strategy = STRATEGY_COPY
+  return strategy
+
+
+# Snapshot src to dest as take, and return the hash of the snapshot. A byte
+# copy is hashed as it is written, and a link is hashed from the blocks it
+# shares, so the content is read once either way.
+def take_and_hash(src, dest):
+  if _link(src, dest) is not None:
+    return file_info.calculate_file_hash(dest)
+  file_hash = file_info.copy_file_with_hash(src, dest)
+  counts[STRATEGY_COPY] += 1
+  return file_hash
+
+
+# Whether the snapshot at path still has the content of the time it is
+# taken, which only a hardlink may not have.
+def is_intact(path):
+  stat = os.stat(path)
+  signature = _hardlinks.get((stat.st_dev, stat.st_ino))
+  return signature is None or signature == _signature(stat)
+
+
+# Replace the hardlink at path, if it is one, with a copy of its current
+# content, so that it does not change with the source anymore.
+def detach(path):
+  stat = os.stat(path)
+  if _hardlinks.pop((stat.st_dev, stat.st_ino), None) is None:
+    return
+  tmp_path = path + '.detach'
+  fastcopy.copy2(path, tmp_path)
+  os.rename(tmp_path, path)
+  detached[0] += 1
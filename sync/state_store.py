@@ -0,0 +1,421 @@
+import os
+import sqlite3
+import stat
+
+import cStringIO
+
+from sync import binary_state
+from sync import columnar_dir_info
+from sync import file_info
+from util import i18n
+from util import util
+
+STATE_FORMAT_CSV = 'csv'
+STATE_FORMAT_SQLITE = 'sqlite'
+STATE_FORMAT_BINARY = 'binary'
+STATE_FORMATS = [STATE_FORMAT_CSV, STATE_FORMAT_SQLITE, STATE_FORMAT_BINARY]
+
+
+# The dir info of the last sync in a CSV file, which is rewritten as a whole
+# on every save.
+class CsvStateStore:
+
+  def __init__(self, path):
+    self.path = path
+
+  def exists(self):
+    return os.path.isfile(self.path)
+
+  def load(self, base_dir, columnar=False):
+    with open(self.path, 'rb') as f:
+      if columnar:
+        return columnar_dir_info.load_columnar_dir_info_from_csv(f, base_dir)
+      return file_info.load_dir_info_from_csv(f, base_dir)
+
+  def save(self, dir_info):
+    with open(self.path, 'wb') as f:
+      dir_info.write_to_csv(f)
+
+  def remove(self):
+    os.remove(self.path)
+
+  def close(self):
+    pass
+
+
+# The dir info of the last sync in the mmap'ed file of binary_state, which
+# is loaded in constant time and decoded on access. The load is always
+# columnar. It is rewritten as a whole on every save, to a new file renamed
+# over the old one, so that the dir info loaded before stays readable. On
+# Windows, where a mapped file can be neither removed nor renamed over, the
+# dir infos loaded before are closed instead, once the new file is written.
+class BinaryStateStore:
+
+  def __init__(self, path):
+    self.path = path
+    # The dir infos loaded, to be closed on Windows
+    self._loaded_dir_infos = []
+
+  def exists(self):
+    return os.path.isfile(self.path)
+
+  def load(self, base_dir, columnar=False):
+    dir_info = binary_state.load_binary_dir_info(self.path, base_dir)
+    if os.name == 'nt':
+      self._loaded_dir_infos.append(dir_info)
+    return dir_info
+
+  def save(self, dir_info):
+    tmp_path = self.path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+      binary_state.write_binary_state(f, _hashed(dir_info))
+    if os.name == 'nt' and os.path.exists(self.path):
+      self._close_loaded_dir_infos()
+      os.remove(self.path)
+    os.rename(tmp_path, self.path)
+
+  def remove(self):
+    if os.name == 'nt':
+      self._close_loaded_dir_infos()
+    os.remove(self.path)
+
+  def _close_loaded_dir_infos(self):
+    for dir_info in self._loaded_dir_infos:
+      dir_info.close()
+    del self._loaded_dir_infos[:]
+
+  def close(self):
+    pass
+
+
+def _hashed(dir_info):
+  for fi in dir_info.flat_file_info_list():
+    fi.calculate_hash()
+    yield fi
+
+
+# The columns are the fields of FileInfo.to_array with the compressed file
+# info, so that the rows are parsed the same way as the CSV rows.
+_COLUMNS = ['path', 'is_dir', 'mode', 'size', 'mtime', 'hash',
+            'c_path', 'c_is_dir', 'c_mode', 'c_size', 'c_mtime', 'c_hash']
+
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS file_info (%s, sort_key TEXT NOT NULL)' % (
+        ', '.join(['path TEXT PRIMARY KEY'] +
+                  ['%s TEXT' % x for x in _COLUMNS[1:]])),
+    'CREATE INDEX IF NOT EXISTS file_info_sort_key ON file_info (sort_key)',
+    'CREATE INDEX IF NOT EXISTS file_info_hash ON file_info (hash)']
+
+_INSERT = 'INSERT OR REPLACE INTO file_info (%s, sort_key) VALUES (%s)' % (
+    ', '.join(_COLUMNS), ', '.join(['?'] * (len(_COLUMNS) + 1)))
+_DELETE = 'DELETE FROM file_info WHERE path = ?'
+_SELECT = 'SELECT %s FROM file_info ORDER BY sort_key' % ', '.join(_COLUMNS)
+
+
+def _to_unicode(s):
+  if isinstance(s, str):
+    return s.decode('utf-8')
+  return s
+
+
+# Return (sort_key, row) of the entries of dir_info in flat order.
+def _rows(dir_info):
+  for fi in dir_info.flat_file_info_list():
+    fi.calculate_hash()
+    row = [_to_unicode(x) for x in fi.to_array(show_compressed_level=1)]
+    row.extend([None] * (len(_COLUMNS) - len(row)))
+    yield util.path_for_sorting(row[0]), row
+
+
+# Return (sort_key, new_row, old_row) of the entries which differ between
+# dir_info and old_dir_info, where the row is None if absent.
+def _changed_rows(dir_info, old_dir_info):
+  for new, old in util.merge_two_iterators(
+      _rows(dir_info), _rows(old_dir_info), key_func=lambda x: x[0]):
+    if new is None:
+      yield old[0], None, old[1]
+    elif old is None or new[1] != old[1]:
+      yield new[0], new[1], old[1] if old else None
+
+
+# The dir info of the last sync in a SQLite database with a row per path.
+# Only the rows changed since the last load or save are written, in one
+# transaction, by comparing with the dir info of that time. The dir info
+# saved must not be modified afterwards, which holds as file info is copied
+# before being modified.
+class SqliteStateStore:
+
+  def __init__(self, path):
+    self.path = path
+    self._conn = None
+    self._saved_dir_info = None
+    self.written_rows = 0
+
+  def exists(self):
+    return os.path.isfile(self.path)
+
+  def _connect(self):
+    if self._conn is None:
+      self._conn = sqlite3.connect(self.path)
+      for statement in _SCHEMA:
+        self._conn.execute(statement)
+      self._conn.commit()
+    return self._conn
+
+  def _file_info_list(self):
+    for row in self._connect().execute(_SELECT):
+      yield file_info.load_from_csv_row(
+          [x for x in row if x is not None])
+
+  def load(self, base_dir, columnar=False):
+    if columnar:
+      dir_info = columnar_dir_info.columnar_dir_info_from_file_info_list(
+          base_dir, self._file_info_list())
+    else:
+      dir_info = file_info.load_dir_info_from_file_info_list(
+          base_dir, self._file_info_list())
+    self._saved_dir_info = dir_info
+    return dir_info
+
+  def save(self, dir_info):
+    conn = self._connect()
+    self.written_rows = 0
+    with conn:
+      if self._saved_dir_info is None:
+        conn.execute('DELETE FROM file_info')
+        conn.executemany(
+            _INSERT, (row + [sort_key] for sort_key, row in _rows(dir_info)))
+        self.written_rows = conn.execute(
+            'SELECT COUNT(*) FROM file_info').fetchone()[0]
+      else:
+        for sort_key, new_row, old_row in _changed_rows(
+            dir_info, self._saved_dir_info):
+          if new_row is None:
+            conn.execute(_DELETE, [old_row[0]])
+          else:
+            conn.execute(_INSERT, new_row + [sort_key])
+          self.written_rows += 1
+    self._saved_dir_info = dir_info
+
+  def remove(self):
+    self.close()
+    os.remove(self.path)
+
+  def close(self):
+    if self._conn is not None:
+      self._conn.close()
+      self._conn = None
+
+
+# Move the state in from_store to to_store if to_store has none yet, e.g.
+# when the state format of a profile is changed. from_store is only removed
+# once to_store is saved.
+def migrate_state(from_store, to_store, base_dir):
+  if to_store.exists() or not from_store.exists():
+    return False
+  to_store.save(from_store.load(base_dir))
+  from_store.remove()
+  return True
+
+
+# Journal records are appended until they are this many times the rows of
+# the state, and then compacted into the state.
+_DEFAULT_COMPACT_RATIO = 0.25
+_MIN_COMPACT_RECORDS = 1000
+
+_JOURNAL_PUT = '+'
+_JOURNAL_DELETE = '-'
+
+
+# Wrap a store with an append-only journal of the state of single paths, so
+# that a sync round only appends the entries changed since the last save,
+# and that the paths applied by an interrupted sync are not lost. On load,
+# the journal is replayed onto the state in store and compacted into it, and
+# None is returned if there is no state at all. The journal is also
+# compacted once it grows too large relative to the state.
+class JournaledStateStore:
+
+  def __init__(self, store, journal_path,
+               compact_ratio=_DEFAULT_COMPACT_RATIO,
+               min_compact_records=_MIN_COMPACT_RECORDS):
+    self.store = store
+    self.path = store.path
+    self.journal_path = journal_path
+    self.compact_ratio = compact_ratio
+    self.min_compact_records = min_compact_records
+    self.journal_records = 0
+    self._journal = None
+    self._writer = None
+    # The state with the journal applied, except the paths of on_applied
+    self._dir_info = None
+    self._state_rows = 0
+
+  def exists(self):
+    return self.store.exists() or os.path.isfile(self.journal_path)
+
+  # The time the state or its journal was last written in ns, None if never.
+  def saved_time_ns(self):
+    times = [util.stat_mtime_ns(os.stat(x))
+             for x in [self.store.path, self.journal_path]
+             if os.path.isfile(x)]
+    return max(times) if times else None
+
+  def load(self, base_dir, columnar=False):
+    records = []
+    if os.path.isfile(self.journal_path):
+      with open(self.journal_path, 'rb') as f:
+        records = _read_journal(f)
+    if not records:
+      if not self.store.exists():
+        return None
+      dir_info = self.store.load(base_dir, columnar=columnar)
+      self._set_state(dir_info)
+      return dir_info
+    dir_info = self.store.load(base_dir) if self.store.exists() else None
+    dir_info = _replay_journal(base_dir, dir_info, records)
+    if dir_info is None:
+      # No root entry of base_dir to apply the journal to
+      self._close_journal()
+      os.remove(self.journal_path)
+      return None
+    self._compact(dir_info)
+    if columnar:
+      return self.store.load(base_dir, columnar=True)
+    return dir_info
+
+  def save(self, dir_info):
+    if self._dir_info is None:
+      self._compact(dir_info)
+      return
+    writer = self._journal_writer()
+    state_rows = self._state_rows
+    for sort_key, new_row, old_row in _changed_rows(dir_info, self._dir_info):
+      if new_row is None:
+        writer.writerow([_JOURNAL_DELETE, old_row[0]])
+        state_rows -= 1
+      else:
+        writer.writerow([_JOURNAL_PUT] + [x for x in new_row if x is not None])
+        if old_row is None:
+          state_rows += 1
+      self.journal_records += 1
+    self._journal.flush()
+    self._set_state(dir_info, state_rows=state_rows)
+    if self.journal_records > max(self.min_compact_records,
+                                  self.compact_ratio * self._state_rows):
+      self._compact(dir_info)
+
+  # Record the state of path, or None if deleted, once a change of it is
+  # applied to both dirs.
+  def on_applied(self, path, fi):
+    writer = self._journal_writer()
+    if fi is None:
+      writer.writerow([_JOURNAL_DELETE, path])
+    else:
+      writer.writerow([_JOURNAL_PUT] + fi.to_array(show_compressed_level=1))
+    # Flushed to the OS so that it survives the process. Power failures may
+    # still lose the tail, which only loses the progress.
+    self._journal.flush()
+    self.journal_records += 1
+
+  # state_rows, if known, is the number of rows of dir_info, which is
+  # counted otherwise.
+  def _set_state(self, dir_info, state_rows=None):
+    self._dir_info = dir_info
+    if state_rows is None:
+      state_rows = _row_count(dir_info)
+    self._state_rows = state_rows
+
+  def _journal_writer(self):
+    if self._journal is None:
+      self._journal = open(self.journal_path, 'ab')
+      self._writer = i18n.UTF8Writer(self._journal, lineterminator='\n')
+    return self._writer
+
+  def _close_journal(self):
+    if self._journal is not None:
+      self._journal.close()
+      self._journal = None
+      self._writer = None
+
+  def _compact(self, dir_info):
+    self.store.save(dir_info)
+    self._close_journal()
+    if os.path.isfile(self.journal_path):
+      os.remove(self.journal_path)
+    self.journal_records = 0
+    self._set_state(dir_info)
+
+  def remove(self):
+    self._close_journal()
+    if os.path.isfile(self.journal_path):
+      os.remove(self.journal_path)
+    if self.store.exists():
+      self.store.remove()
+
+  def close(self):
+    self._close_journal()
+    self.store.close()
+
+
+# The number of entries of dir_info, counted without decoding them for a
+# ColumnarDirInfo, e.g. the mmap'ed binary state.
+def _row_count(dir_info):
+  if isinstance(dir_info, columnar_dir_info.ColumnarDirInfo):
+    return len(dir_info)
+  count = 0
+  for unused in dir_info.flat_file_info_list():
+    count += 1
+  return count
+
+
+# Return the records of the journal as (path, file_info or None). The last
+# line is ignored if incomplete, e.g. by a crash while appending it.
+def _read_journal(f):
+  data = f.read()
+  data = data[:data.rfind('\n') + 1]
+  records = []
+  for row in i18n.UTF8Reader(cStringIO.StringIO(data)):
+    if len(row) >= 2 and row[0] == _JOURNAL_DELETE:
+      records.append((row[1], None))
+    elif len(row) >= 7 and row[0] == _JOURNAL_PUT:
+      records.append((row[1], file_info.load_from_csv_row(row[1:])))
+  return records
+
+
+# Apply the journal records to dir_info, None if empty. The entries whose
+# parent dir is absent, e.g. under a dir deleted or turned to a file later,
+# are dropped. Without dir_info, i.e. the first sync is interrupted, the
+# records are applied to a root entry of base_dir, whose mtime matches no dir
+# so that its listing is read again. The dir digests are set again, as the
+# journal only has the entries applied.
+def _replay_journal(base_dir, dir_info, records):
+  file_infos = {}
+  if dir_info is not None:
+    for fi in dir_info.flat_file_info_list():
+      file_infos[fi.path] = fi
+  else:
+    file_infos[base_dir] = file_info.FileInfo(
+        base_dir, True, stat.S_IFDIR | 0755, None, 0)
+  for path, fi in records:
+    if fi is None:
+      file_infos.pop(path, None)
+    else:
+      file_infos[path] = fi
+  file_info_list = []
+  dirs = set()
+  for path in sorted(file_infos.keys(), key=util.path_for_sorting):
+    parent = os.path.dirname(path)
+    if not file_info_list and parent:
+      return None
+    if file_info_list and parent not in dirs:
+      continue
+    fi = file_infos[path]
+    file_info_list.append(fi)
+    if fi.is_dir:
+      dirs.add(path)
+  if not file_info_list:
+    return None
+  dir_info = file_info.load_dir_info_from_file_info_list(
+      base_dir, file_info_list)
+  file_info.set_dir_digests(dir_info)
+  return dir_info
@@ -1,3 +1,4 @@
+import copy
 import inspect
 import os
 import shutil
@@ -7,6 +8,7 @@ import cStringIO
 
 from sync import file_info
 from sync import change_entry
+from sync import merge
 
 _TEST_CASES_BASE_DIR = os.path.join(
     os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))),
@@ -112,6 +114,81 @@ class TestChangeEntry(unittest.TestCase):
     dc_final = change_entry.get_dir_changes(di_new, di_final)
     self._assertDirChanges(dc_final)
 
+  def _clear_dir_digests(self, dir_info):
+    for fi in dir_info.flat_file_info_list():
+      if fi.is_dir:
+        fi.file_hash = None
+
+  def _changes(self, dir_changes):
+    return [(c.path, c.content_status, c.cur_info and c.cur_info.path,
+             c.old_info and c.old_info.path)
+            for c in dir_changes.flat_changes()]
+
+  # Set the same mtime to everything under path, as git does not keep the
+  # mtimes of the test cases checked out.
+  def _pin_mtimes(self, path, mtime=1390032029):
+    for dirpath, dirnames, filenames in os.walk(path):
+      for name in dirnames + filenames:
+        os.utime(os.path.join(dirpath, name), (mtime, mtime))
+    os.utime(path, (mtime, mtime))
+
+  def test_dir_digests(self):
+    self._pin_mtimes(os.path.join(_TEST_DEST, 'dir1_unchanged'))
+    self._pin_mtimes(os.path.join(_TEST_SRC, 'dir1_unchanged'))
+    os.chdir(_TEST_DEST)
+    di_new = file_info.load_dir_info('.', calculate_hash=True)
+    os.chdir(_TEST_SRC)
+    di_old = file_info.load_dir_info('.', calculate_hash=True)
+    unchanged_dir = os.path.join('.', 'dir1_unchanged')
+    self.assertEqual(di_new.get(unchanged_dir).file_hash,
+                     di_old.get(unchanged_dir).file_hash)
+    self.assertNotEqual(di_new.get('.').file_hash, di_old.get('.').file_hash)
+    self.assertEqual(file_info.DIR_DIGEST_ALGORITHM,
+                     file_info.hash_algorithm(di_new.get('.').file_hash))
+
+    dc = change_entry.get_dir_changes(di_new, di_old)
+    self.assertTrue(dc.dir_changes('.').dir_changes(unchanged_dir).unchanged)
+    self.assertFalse(dc.dir_changes('.').unchanged)
+    # The same changes as comparing all the entries
+    di_new_compared = copy.deepcopy(di_new)
+    di_old_compared = copy.deepcopy(di_old)
+    self._clear_dir_digests(di_new_compared)
+    self._clear_dir_digests(di_old_compared)
+    dc_compared = change_entry.get_dir_changes(di_new_compared,
+                                               di_old_compared)
+    self.assertEqual(self._changes(dc_compared), self._changes(dc))
+
+    # Merged the same as comparing all the entries
+    self.assertEqual(
+        [self._changes(x)
+         for x in merge.merge(dc_compared,
+                              change_entry.get_dir_changes(di_old_compared,
+                                                           di_old_compared))],
+        [self._changes(x)
+         for x in merge.merge(dc, change_entry.get_dir_changes(di_old,
+                                                               di_old))])
+
+    # The state applied has the digests of the scan
+    di_final = change_entry.apply_dir_changes_to_dir_info('.', dc)
+    for fi in di_new.flat_file_info_list():
+      self.assertEqual(fi.file_hash, di_final.get(fi.path).file_hash)
+
+  def test_dir_digest_of_modified_file(self):
+    os.chdir(_TEST_SRC)
+    di_old = file_info.load_dir_info('.', calculate_hash=True)
+    path = os.path.join('dir1_unchanged', 'test1_1_unchanged.txt')
+    stat = os.stat(path)
+    with open(path, 'w') as f:
+      f.write('modified')
+    os.utime(path, (stat.st_atime, stat.st_mtime))
+    di_new = file_info.load_dir_info('.', calculate_hash=True)
+    for dir_path in ['.', os.path.join('.', 'dir1_unchanged')]:
+      self.assertNotEqual(di_new.get(dir_path).file_hash,
+                          di_old.get(dir_path).file_hash)
+    dir_path = os.path.join('.', 'dir2_modified')
+    self.assertEqual(di_new.get(dir_path).file_hash,
+                     di_old.get(dir_path).file_hash)
+
   def test_change_entry_applied_to_real_dirs(self):
     os.chdir(_TEST_DEST)
     di_new = file_info.load_dir_info('.', calculate_hash=True)
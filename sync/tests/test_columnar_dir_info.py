@@ -0,0 +1,78 @@
+import inspect
+import os
+import unittest
+
+import cStringIO
+
+from sync import change_entry
+from sync import columnar_dir_info
+from sync import file_info
+
+_TEST_CASES_BASE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))),
+    'test_cases')
+_TEST_CASES_SRC = 'src'
+_TEST_CASES_DEST = 'dest'
+
+
+class TestColumnarDirInfo(unittest.TestCase):
+
+  def setUp(self):
+    self._old_cwd = os.getcwd()
+    os.chdir(os.path.join(_TEST_CASES_BASE_DIR, _TEST_CASES_SRC))
+    self.dir_info = file_info.load_dir_info('.', calculate_hash=True)
+    # Attach some compressed file info to be kept in the table
+    for fi in self.dir_info.flat_file_info_list():
+      if not fi.is_dir:
+        fi.compressed_file_info = file_info.FileInfo(
+            fi.path + '.boxwrap.zip', False, fi.mode, fi.size + 1,
+            fi.last_modified_time, fi.file_hash)
+    output = cStringIO.StringIO()
+    self.dir_info.write_to_csv(output)
+    self.columnar = columnar_dir_info.load_columnar_dir_info_from_csv(
+        cStringIO.StringIO(output.getvalue()), '.')
+
+  def tearDown(self):
+    os.chdir(self._old_cwd)
+
+  def _assert_same(self, dir_info, columnar):
+    self.assertEqual(dir_info.base_dir(), columnar.base_dir())
+    self.assertEqual([x.to_csv() for x in dir_info.file_info_list()],
+                     [x.to_csv() for x in columnar.file_info_list()])
+    self.assertEqual([x.to_csv() for x in dir_info.flat_file_info_list()],
+                     [x.to_csv() for x in columnar.flat_file_info_list()])
+    for fi in dir_info.file_info_list():
+      self.assertEqual(fi.to_csv(), columnar.child(fi.path).to_csv())
+      if fi.is_dir:
+        self._assert_same(dir_info.dir_info(fi.path),
+                          columnar.dir_info(fi.path))
+      else:
+        self.assertIsNone(columnar.child_dir_info(fi.path))
+
+  def test_same_as_dir_info(self):
+    self._assert_same(self.dir_info, self.columnar)
+
+  def test_get_and_has_file(self):
+    for fi in self.dir_info.flat_file_info_list():
+      if fi.path == '.':
+        continue
+      self.assertTrue(self.columnar.has_file(fi.path))
+      self.assertEqual(fi.to_csv(), self.columnar.get(fi.path).to_csv())
+    missing = os.path.join('.', 'dir1_unchanged', 'missing.txt')
+    self.assertFalse(self.columnar.has_file(missing))
+    self.assertIsNone(self.columnar.get(missing))
+    self.assertIsNone(self.columnar.child(
+        os.path.join('.', 'dir1_unchanged', 'test1_1_unchanged.txt')))
+    self.assertRaises(KeyError, self.columnar.dir_info, missing)
+
+  def test_dir_changes(self):
+    os.chdir(os.path.join(_TEST_CASES_BASE_DIR, _TEST_CASES_DEST))
+    new_dir_info = file_info.load_dir_info('.', calculate_hash=True)
+    dc = change_entry.get_dir_changes(new_dir_info, self.dir_info)
+    new_dir_info = file_info.load_dir_info('.', calculate_hash=True)
+    columnar_dc = change_entry.get_dir_changes(new_dir_info, self.columnar)
+    self.assertEqual(
+        [(x.path, x.content_status, x.dir_status())
+         for x in dc.flat_changes()],
+        [(x.path, x.content_status, x.dir_status())
+         for x in columnar_dc.flat_changes()])
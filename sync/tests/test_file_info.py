@@ -1,10 +1,16 @@
+import copy
+import hashlib
 import inspect
 import os
+import random
+import shutil
+import time
 import unittest
 
 import cStringIO
 
 from sync import file_info
+from util import util
 
 _TEST_CASES_BASE_DIR = os.path.join(
     os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))),
@@ -12,6 +18,13 @@ _TEST_CASES_BASE_DIR = os.path.join(
 _TEST_CASES_SRC = 'src'
 _TEST_CASES_DEST = 'dest'
 
+_TEST_TMP_BASE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))),
+    'test_tmp')
+_TEST_LINKS = os.path.join(_TEST_TMP_BASE_DIR, 'links')
+_TEST_LISTING = os.path.join(_TEST_TMP_BASE_DIR, 'listing')
+_TEST_MTIME = os.path.join(_TEST_TMP_BASE_DIR, 'mtime')
+
 
 class TestFileInfo(unittest.TestCase):
 
@@ -37,6 +50,291 @@ class TestFileInfo(unittest.TestCase):
       self._assert_file_info_list_valid_and_equal(
           expected_file_info_list_from_csv[i], file_info_list[i])
 
+  def test_load_dir_info_same_as_walk(self):
+    walk_paths = []
+    for root, dirs, files in os.walk(_TEST_CASES_SRC):
+      walk_paths.append(root)
+      walk_paths.extend([os.path.join(root, f) for f in files])
+    walk_paths.sort(key=util.path_for_sorting)
+    dir_info = file_info.load_dir_info(_TEST_CASES_SRC)
+    self.assertEqual(walk_paths,
+                     [x.path for x in dir_info.flat_file_info_list()])
+
+  def test_load_dir_info_hash_in_parallel(self):
+    serial_di = file_info.load_dir_info(_TEST_CASES_SRC, calculate_hash=True)
+    for backend in [file_info.HASH_BACKEND_THREAD,
+                    file_info.HASH_BACKEND_PROCESS]:
+      parallel_di = file_info.load_dir_info(
+          _TEST_CASES_SRC, calculate_hash=True, hash_workers=4,
+          hash_backend=backend)
+      self.assertEqual(
+          [(x.path, x.file_hash) for x in serial_di.flat_file_info_list()],
+          [(x.path, x.file_hash) for x in parallel_di.flat_file_info_list()])
+
+  @unittest.skipUnless(hasattr(os, 'symlink'), 'Symlink is not supported')
+  def test_load_dir_info_with_symlinks(self):
+    try:
+      shutil.rmtree(_TEST_LINKS)
+    except:
+      pass
+    os.makedirs(os.path.join(_TEST_LINKS, 'dir'))
+    with open(os.path.join(_TEST_LINKS, 'dir', 'file.txt'), 'w') as f:
+      f.write('file')
+    os.symlink(os.path.join('dir', 'file.txt'),
+               os.path.join(_TEST_LINKS, 'link_to_file.txt'))
+    os.symlink('dir', os.path.join(_TEST_LINKS, 'link_to_dir'))
+    os.symlink('missing', os.path.join(_TEST_LINKS, 'broken_link'))
+    os.chdir(_TEST_LINKS)
+
+    # Like os.walk, symlinks to dirs are skipped and symlinks to files are
+    # followed.
+    dir_info = file_info.load_dir_info('.', calculate_hash=True)
+    self.assertEqual(
+        ['.', os.path.join('.', 'dir'), os.path.join('.', 'dir', 'file.txt'),
+         os.path.join('.', 'link_to_file.txt')],
+        [x.path for x in dir_info.flat_file_info_list()])
+    self.assertEqual(
+        dir_info.get(os.path.join('.', 'dir', 'file.txt')).file_hash,
+        dir_info.get(os.path.join('.', 'link_to_file.txt')).file_hash)
+
+  def test_load_dir_info_reuse_unchanged_dir_listing(self):
+    try:
+      shutil.rmtree(_TEST_LISTING)
+    except:
+      pass
+    for d in ['dir1', 'dir2', 'dir3']:
+      os.makedirs(os.path.join(_TEST_LISTING, d))
+      with open(os.path.join(_TEST_LISTING, d, 'file.txt'), 'w') as f:
+        f.write(d)
+    os.chdir(_TEST_LISTING)
+    for d in ['.', 'dir1', 'dir2']:
+      os.utime(d, (1000000000, 1000000000))
+    # The dir modified within the racy window before the old scan, which may
+    # have changed again since without a change of its mtime
+    racy_mtime = int(time.time()) - 0.5
+    os.utime('dir3', (racy_mtime, racy_mtime))
+    old_scan_time_ns = int(time.time() * 1000000000)
+    old_di = file_info.load_dir_info('.')
+
+    # Add files to all dirs, but restore the mtime of dir1 and dir3 so that
+    # the old listing of dir1 is taken
+    for d in ['dir1', 'dir2', 'dir3']:
+      with open(os.path.join(d, 'new.txt'), 'w') as f:
+        f.write(d)
+    os.utime('dir1', (1000000000, 1000000000))
+    os.utime('dir3', (racy_mtime, racy_mtime))
+
+    # Nothing is reused without the time of the old scan
+    scanner = file_info._DirScanner(old_dir_info=old_di)
+    scanner.scan('.')
+    self.assertEqual(0, scanner.reused_dirs)
+
+    scanner = file_info._DirScanner(old_dir_info=old_di,
+                                    old_scan_time_ns=old_scan_time_ns)
+    dir_info = scanner.scan('.')
+    self.assertEqual(2, scanner.reused_dirs)
+    self.assertEqual(
+        ['.',
+         os.path.join('.', 'dir1'), os.path.join('.', 'dir1', 'file.txt'),
+         os.path.join('.', 'dir2'), os.path.join('.', 'dir2', 'file.txt'),
+         os.path.join('.', 'dir2', 'new.txt'),
+         os.path.join('.', 'dir3'), os.path.join('.', 'dir3', 'file.txt'),
+         os.path.join('.', 'dir3', 'new.txt')],
+        [x.path for x in dir_info.flat_file_info_list()])
+    # Entries of the reused listing are stat'ed again
+    self.assertEqual(os.path.getsize(os.path.join('dir1', 'file.txt')),
+                     dir_info.get(os.path.join('.', 'dir1', 'file.txt')).size)
+
+  def test_load_dir_info_with_dirty_paths(self):
+    try:
+      shutil.rmtree(_TEST_LISTING)
+    except:
+      pass
+    for d in ['dir1', os.path.join('dir2', 'dir2_1'), 'dir3']:
+      os.makedirs(os.path.join(_TEST_LISTING, d))
+      with open(os.path.join(_TEST_LISTING, d, 'file.txt'), 'w') as f:
+        f.write(d)
+    os.chdir(_TEST_LISTING)
+    old_di = file_info.load_dir_info('.', calculate_hash=True)
+
+    for d in ['dir1', os.path.join('dir2', 'dir2_1'), 'dir3']:
+      with open(os.path.join(d, 'file.txt'), 'w') as f:
+        f.write('modified')
+      with open(os.path.join(d, 'new.txt'), 'w') as f:
+        f.write('new')
+    dir1_file = os.path.join('.', 'dir1', 'file.txt')
+    dir2_1_file = os.path.join('.', 'dir2', 'dir2_1', 'file.txt')
+    dir3_file = os.path.join('.', 'dir3', 'file.txt')
+
+    # The dirty dir2 is scanned in full, dir1 only for the dirty file, and
+    # dir3 is taken from old_di
+    scanner = file_info._DirScanner(
+        calculate_hash=True, old_dir_info=old_di,
+        dirty_paths=[dir1_file, os.path.join('.', 'dir2')])
+    dir_info = scanner.scan('.')
+    self.assertEqual(1, scanner.reused_subtrees)
+    self.assertEqual(file_info._calculate_hash(dir1_file),
+                     dir_info.get(dir1_file).file_hash)
+    self.assertEqual(file_info._calculate_hash(dir2_1_file),
+                     dir_info.get(dir2_1_file).file_hash)
+    self.assertEqual(old_di.get(dir3_file).file_hash,
+                     dir_info.get(dir3_file).file_hash)
+    self.assertTrue(dir_info.has_file(os.path.join('.', 'dir1', 'new.txt')))
+    self.assertTrue(
+        dir_info.has_file(os.path.join('.', 'dir2', 'dir2_1', 'new.txt')))
+    self.assertFalse(dir_info.has_file(os.path.join('.', 'dir3', 'new.txt')))
+
+  def test_calculate_hash_in_chunks(self):
+    if not os.path.exists(_TEST_TMP_BASE_DIR):
+      os.makedirs(_TEST_TMP_BASE_DIR)
+    path = os.path.join(_TEST_TMP_BASE_DIR, 'large.bin')
+    content = ''.join(chr(i % 251) for i in xrange(10000))
+    with open(path, 'wb') as f:
+      f.write(content)
+    expected_hash = hashlib.sha1(content).hexdigest()
+    try:
+      # Read in chunks, with the last chunk partially filled
+      file_info.configure_hashing(chunk_size=1024, mmap_threshold=0)
+      self.assertEqual(expected_hash, file_info._calculate_hash(path))
+      # Read via mmap
+      file_info.configure_hashing(mmap_threshold=1)
+      self.assertEqual(expected_hash, file_info._calculate_hash(path))
+      # Empty file cannot be mapped
+      with open(path, 'wb') as f:
+        pass
+      self.assertEqual(hashlib.sha1().hexdigest(),
+                       file_info._calculate_hash(path))
+    finally:
+      file_info.configure_hashing(
+          chunk_size=file_info.DEFAULT_HASH_CHUNK_SIZE,
+          mmap_threshold=file_info.DEFAULT_HASH_MMAP_THRESHOLD)
+
+  def test_hash_algorithms(self):
+    path = os.path.join(_TEST_CASES_SRC, 'test1_unchanged.txt')
+    with open(path, 'rb') as f:
+      content = f.read()
+    self.assertEqual(hashlib.sha1(content).hexdigest(),
+                     file_info._calculate_hash(path))
+    self.assertEqual('md5:' + hashlib.md5(content).hexdigest(),
+                     file_info._calculate_hash(path, algorithm='md5'))
+    for algorithm in file_info.HASH_ALGORITHMS:
+      self.assertEqual(
+          algorithm,
+          file_info.hash_algorithm(
+              file_info._calculate_hash(path, algorithm=algorithm)))
+
+  def test_hash_algorithm_migration(self):
+    old_dir_info = file_info.load_dir_info(_TEST_CASES_SRC,
+                                           calculate_hash=True)
+    try:
+      file_info.configure_hashing(algorithm='crc32')
+      new_dir_info = file_info.load_dir_info(_TEST_CASES_SRC,
+                                             calculate_hash=True)
+      for old_fi, new_fi in zip(old_dir_info.flat_file_info_list(),
+                                new_dir_info.flat_file_info_list()):
+        if new_fi.is_dir:
+          continue
+        self.assertEqual('crc32', file_info.hash_algorithm(new_fi.file_hash))
+        self.assertFalse(new_fi.is_modified(old_fi))
+        # Rehash in the old algorithm to compare the content
+        old_fi.last_modified_time += 1
+        self.assertFalse(new_fi.is_modified(old_fi))
+        old_fi.file_hash = hashlib.sha1('different').hexdigest()
+        self.assertTrue(new_fi.is_modified(old_fi))
+    finally:
+      file_info.configure_hashing(algorithm=file_info.DEFAULT_HASH_ALGORITHM)
+
+  def test_get_and_has_file(self):
+    dir_info = file_info.load_dir_info(_TEST_CASES_SRC)
+    for fi in dir_info.flat_file_info_list():
+      self.assertIs(fi, dir_info.get(fi.path))
+      self.assertTrue(dir_info.has_file(fi.path))
+    sub_dir = os.path.join(_TEST_CASES_SRC, 'dir1_unchanged')
+    nested_path = os.path.join(sub_dir, 'dir1_1_unchanged',
+                               'test1_1_1_unchanged.txt')
+    self.assertEqual(nested_path, dir_info.get(nested_path).path)
+    # Lookup in a sub dir info is limited to its subtree
+    sub_dir_info = dir_info.dir_info(_TEST_CASES_SRC).dir_info(sub_dir)
+    self.assertEqual(nested_path, sub_dir_info.get(nested_path).path)
+    self.assertIsNone(sub_dir_info.get(
+        os.path.join(_TEST_CASES_SRC, 'test1_unchanged.txt')))
+    self.assertFalse(dir_info.has_file(os.path.join(sub_dir, 'missing.txt')))
+
+  def test_load_dir_info_from_file_info_list(self):
+    dir_info = file_info.load_dir_info(_TEST_CASES_SRC)
+    file_info_list = list(dir_info.flat_file_info_list())
+    shuffled = list(file_info_list)
+    random.shuffle(shuffled)
+    dir_info2 = file_info.load_dir_info_from_file_info_list(_TEST_CASES_SRC,
+                                                            shuffled)
+    self._assert_same_dir_info_tree(dir_info, dir_info2)
+
+  def _assert_same_dir_info_tree(self, dir_info1, dir_info2):
+    self.assertEqual([x.path for x in dir_info1.file_info_list()],
+                     [x.path for x in dir_info2.file_info_list()])
+    for fi in dir_info1.file_info_list():
+      if fi.is_dir:
+        self._assert_same_dir_info_tree(dir_info1.dir_info(fi.path),
+                                        dir_info2.dir_info(fi.path))
+
+  def test_state_round_trip_not_rehashed(self):
+    try:
+      shutil.rmtree(_TEST_MTIME)
+    except:
+      pass
+    os.makedirs(os.path.join(_TEST_MTIME, 'dir1'))
+    for path in ['file1.txt', os.path.join('dir1', 'file2.txt')]:
+      full_path = os.path.join(_TEST_MTIME, path)
+      with open(full_path, 'w') as f:
+        f.write(path)
+      # More digits than str() of a float keeps
+      os.utime(full_path, (1400000000.123456, 1400000000.123456))
+    os.chdir(_TEST_MTIME)
+    output = cStringIO.StringIO()
+    file_info.load_dir_info('.', calculate_hash=True).write_to_csv(output)
+    old_di = file_info.load_dir_info_from_csv(
+        cStringIO.StringIO(output.getvalue()), '.')
+
+    hashed_paths = []
+    old_calculate_hash = file_info._calculate_hash
+    def _counting_calculate_hash(path, algorithm=None):
+      hashed_paths.append(path)
+      return old_calculate_hash(path, algorithm=algorithm)
+    file_info._calculate_hash = _counting_calculate_hash
+    try:
+      for fi in file_info.load_dir_info('.').flat_file_info_list():
+        old_fi = old_di.get(fi.path)
+        self.assertEqual(fi.mtime_ns, old_fi.mtime_ns)
+        self.assertFalse(fi.is_modified(old_fi))
+    finally:
+      file_info._calculate_hash = old_calculate_hash
+    self.assertEqual([], hashed_paths)
+
+  def test_mtime_ns_format(self):
+    for mtime_ns in [0, 1, 1400000000123456789, -1500000000, 999999999]:
+      self.assertEqual(
+          mtime_ns, util.parse_mtime_ns(util.format_mtime_ns(mtime_ns)))
+    self.assertEqual('1400000000.123456789',
+                     util.format_mtime_ns(1400000000123456789))
+    # Float seconds written before
+    self.assertEqual(1234567890120000000, util.parse_mtime_ns('1234567890.12'))
+    self.assertEqual(1234567890000000000, util.parse_mtime_ns('1234567890.0'))
+    self.assertEqual(1500000000, util.parse_mtime_ns('1.5'))
+    self.assertEqual(-1500000000, util.parse_mtime_ns('-1.5'))
+    self.assertEqual(1234567890500000000,
+                     util.parse_mtime_ns('1.2345678905e+09'))
+
+  def test_file_info_copy(self):
+    compressed = file_info.FileInfo('a.txt.boxwrap.zip', False, 0100644, 10,
+                                    1.5, file_hash='1234')
+    fi = file_info.FileInfo('a.txt', False, 0100644, 20, 1.5,
+                            file_hash='5678', compressed_file_info=compressed)
+    self.assertFalse(hasattr(fi, '__dict__'))
+    fi2 = copy.copy(fi)
+    self.assertEqual(fi.to_array(1), fi2.to_array(1))
+    # Compressed file info is shared rather than copied
+    self.assertIs(compressed, fi2.compressed_file_info)
+
   def test_csv_read_write(self):
     dir_info = file_info.load_dir_info(_TEST_CASES_SRC)
     output = cStringIO.StringIO()
@@ -75,6 +373,25 @@ class TestFileInfo(unittest.TestCase):
       self._assert_file_info_list_valid_and_equal(
           file_info_list[i], file_info_list_from_csv[i])
 
+  def test_csv_read_write_special_characters(self):
+    path = os.path.join(u'.', u'a, "quoted" \xe9.txt')
+    test_file_info = file_info.FileInfo(path, False, 0100664, 200, 1234567895,
+                                        file_hash='123kasdasd')
+    dir_info = file_info.DirInfo('.',
+        [file_info.FileInfo('.', True, 040775, None, 1234567890)],
+        {'.': file_info.DirInfo('.', [test_file_info], {})})
+    output = cStringIO.StringIO()
+    dir_info.write_to_csv(output)
+    # The same as the rows written one by one
+    self.assertEqual(
+        ''.join([x.to_csv() + '\n'
+                 for x in dir_info.flat_file_info_list()]),
+        output.getvalue())
+    dir_info_from_csv = file_info.load_dir_info_from_csv(
+        cStringIO.StringIO(output.getvalue()), '.')
+    self.assertEqual(path, dir_info_from_csv.get(path).path)
+    self.assertEqual(unicode, type(dir_info_from_csv.get(path).path))
+
   def _assert_file_info_list_valid_and_equal(self, e1, e2):
     self.assertEqual(e1.path.replace('/', os.sep),
                      e2.path.replace('/', os.sep))
@@ -0,0 +1,270 @@
+import inspect
+import os
+import shutil
+import unittest
+
+import cStringIO
+
+from sync import file_info
+from sync import hash_cache
+
+_TEST_CASES_BASE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))),
+    'test_cases')
+_TEST_CASES_SRC = 'src'
+
+_TEST_TMP_BASE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))),
+    'test_tmp')
+_TEST_SRC = os.path.join(_TEST_TMP_BASE_DIR, _TEST_CASES_SRC)
+
+
+class TestHashCache(unittest.TestCase):
+
+  def setUp(self):
+    try:
+      shutil.rmtree(_TEST_SRC)
+    except:
+      pass
+    shutil.copytree(os.path.join(_TEST_CASES_BASE_DIR, _TEST_CASES_SRC),
+                    _TEST_SRC)
+    self._old_cwd = os.getcwd()
+    os.chdir(_TEST_SRC)
+
+    # Count the files actually hashed
+    self._hashed_paths = []
+    self._old_calculate_hash = file_info._calculate_hash
+    def _counting_calculate_hash(path, algorithm=None):
+      self._hashed_paths.append(path)
+      return self._old_calculate_hash(path, algorithm=algorithm)
+    file_info._calculate_hash = _counting_calculate_hash
+
+  def tearDown(self):
+    file_info._calculate_hash = self._old_calculate_hash
+    os.chdir(self._old_cwd)
+
+  def _file_count(self, dir_info):
+    return len([x for x in dir_info.flat_file_info_list() if not x.is_dir])
+
+  def test_unchanged_files_not_rehashed(self):
+    cache = hash_cache.HashCache()
+    di1 = file_info.load_dir_info('.', calculate_hash=True, hash_cache=cache)
+    self.assertEqual(self._file_count(di1), len(self._hashed_paths))
+
+    self._hashed_paths = []
+    di2 = file_info.load_dir_info('.', calculate_hash=True, hash_cache=cache)
+    self.assertEqual([], self._hashed_paths)
+    self.assertEqual(
+        [x.file_hash for x in di1.flat_file_info_list()],
+        [x.file_hash for x in di2.flat_file_info_list()])
+
+  def test_modified_file_rehashed(self):
+    cache = hash_cache.HashCache()
+    file_info.load_dir_info('.', calculate_hash=True, hash_cache=cache)
+    path = os.path.join('.', 'test2_modified.txt')
+    with open(path, 'w') as f:
+      f.write('modified content')
+    # Make sure the mtime changes even on coarse timestamp file systems
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+    self._hashed_paths = []
+    di = file_info.load_dir_info('.', calculate_hash=True, hash_cache=cache)
+    self.assertEqual([path], self._hashed_paths)
+    self.assertEqual(file_info._calculate_hash(path),
+                     di.get(path).file_hash)
+
+  def test_deferred_hash(self):
+    cache = hash_cache.HashCache()
+    old_di = file_info.load_dir_info('.', calculate_hash=True,
+                                     hash_cache=cache)
+    path = os.path.join('.', 'test2_modified.txt')
+    with open(path, 'a') as f:
+      f.write(' appended')
+    new_path = os.path.join('.', 'new.txt')
+    with open(new_path, 'w') as f:
+      f.write('new')
+
+    # The new file and the one of another size are left to be hashed
+    self._hashed_paths = []
+    di = file_info.load_dir_info('.', calculate_hash=True, hash_cache=cache,
+                                 old_dir_info=old_di, defer_hash=True)
+    self.assertEqual([], self._hashed_paths)
+    self.assertIsNone(di.get(path).file_hash)
+    self.assertIsNone(di.get(new_path).file_hash)
+
+    # And are trusted once put with their hashes
+    for p in [path, new_path]:
+      cache.put_deferred(p, file_info.copy_file_with_hash(p, p + '.copy'))
+      os.remove(p + '.copy')
+    self._hashed_paths = []
+    di = file_info.load_dir_info('.', calculate_hash=True, hash_cache=cache)
+    self.assertEqual([], self._hashed_paths)
+    self.assertEqual(self._old_calculate_hash(path), di.get(path).file_hash)
+
+  def test_deferred_hash_of_file_rewritten(self):
+    cache = hash_cache.HashCache(fingerprint=True)
+    path = os.path.join(_TEST_SRC, 'rewritten.txt')
+    with open(path, 'wb') as f:
+      f.write('A' * 1000)
+    stat = os.stat(path)
+    cache.defer(path, stat)
+    old_hash = self._old_calculate_hash(path)
+    # Rewritten at the same size before the hash is put
+    with open(path, 'wb') as f:
+      f.write('B' * 1000)
+    self._touch(path)
+    cache.put_deferred(path, old_hash)
+    self.assertIsNone(cache.get(path, os.stat(path)))
+
+    # Nor is the fingerprint of a file changed since its stat kept by put
+    cache.put(path, stat, old_hash)
+    self.assertIsNone(cache.get(path, os.stat(path)))
+
+  def _touch(self, path):
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+  def test_fingerprint_keeps_hash_of_touched_file(self):
+    cache = hash_cache.HashCache(fingerprint=True)
+    di1 = file_info.load_dir_info('.', calculate_hash=True, hash_cache=cache)
+    path = os.path.join('.', 'test2_modified.txt')
+    self._touch(path)
+
+    self._hashed_paths = []
+    di2 = file_info.load_dir_info('.', calculate_hash=True, hash_cache=cache)
+    self.assertEqual([], self._hashed_paths)
+    self.assertEqual(1, cache.fingerprint_hits)
+    self.assertEqual(di1.get(path).file_hash, di2.get(path).file_hash)
+    # Trusted by the stat signature again
+    file_info.load_dir_info('.', calculate_hash=True, hash_cache=cache)
+    self.assertEqual(1, cache.fingerprint_hits)
+
+    # Without fingerprint, the touched file is rehashed
+    cache.fingerprint = False
+    self._touch(path)
+    file_info.load_dir_info('.', calculate_hash=True, hash_cache=cache)
+    self.assertEqual([path], self._hashed_paths)
+
+  def test_fingerprint_samples(self):
+    path = os.path.join('.', 'large.bin')
+    block_size = 16
+    data = 'a' * (block_size * 10)
+    with open(path, 'wb') as f:
+      f.write(data)
+    fingerprint = hash_cache.sample_fingerprint(path, len(data),
+                                                block_size=block_size)
+    # Changes in the head, middle or tail are sampled
+    for offset in [0, len(data) // 2, len(data) - 1]:
+      with open(path, 'wb') as f:
+        f.write(data[:offset] + 'b' + data[offset + 1:])
+      self.assertNotEqual(
+          fingerprint,
+          hash_cache.sample_fingerprint(path, len(data),
+                                        block_size=block_size))
+    # But not between them
+    with open(path, 'wb') as f:
+      f.write(data[:block_size * 2] + 'b' + data[block_size * 2 + 1:])
+    self.assertEqual(
+        fingerprint,
+        hash_cache.sample_fingerprint(path, len(data), block_size=block_size))
+
+  def test_fingerprint_rehashed_if_changed_or_due(self):
+    cache = hash_cache.HashCache(fingerprint=True)
+    file_info.load_dir_info('.', calculate_hash=True, hash_cache=cache)
+    path = os.path.join('.', 'test2_modified.txt')
+    with open(path, 'r') as f:
+      content = f.read()
+    with open(path, 'w') as f:
+      f.write(content[:-1] + chr(ord(content[-1]) ^ 1))
+    self._touch(path)
+    self._hashed_paths = []
+    file_info.load_dir_info('.', calculate_hash=True, hash_cache=cache)
+    self.assertEqual([path], self._hashed_paths)
+
+    # Hashed in full too long ago
+    cache.fingerprint_verify_days = 0
+    self._touch(path)
+    self._hashed_paths = []
+    file_info.load_dir_info('.', calculate_hash=True, hash_cache=cache)
+    self.assertEqual([path], self._hashed_paths)
+    self.assertEqual(0, cache.fingerprint_hits)
+
+  def test_force_verify(self):
+    cache = hash_cache.HashCache()
+    di = file_info.load_dir_info('.', calculate_hash=True, hash_cache=cache)
+    cache.force_verify = True
+
+    self._hashed_paths = []
+    file_info.load_dir_info('.', calculate_hash=True, hash_cache=cache)
+    self.assertEqual(self._file_count(di), len(self._hashed_paths))
+
+  def test_csv_read_write(self):
+    cache = hash_cache.HashCache()
+    di = file_info.load_dir_info('.', calculate_hash=True, hash_cache=cache)
+    output = cStringIO.StringIO()
+    cache.write_to_csv(output)
+    cache_from_csv = hash_cache.load_hash_cache_from_csv(
+        cStringIO.StringIO(output.getvalue()))
+    self.assertEqual(len(cache), len(cache_from_csv))
+
+    self._hashed_paths = []
+    di2 = file_info.load_dir_info('.', calculate_hash=True,
+                                  hash_cache=cache_from_csv)
+    self.assertEqual([], self._hashed_paths)
+    self.assertEqual(
+        [x.file_hash for x in di.flat_file_info_list()],
+        [x.file_hash for x in di2.flat_file_info_list()])
+
+  def test_csv_read_write_fingerprint(self):
+    cache = hash_cache.HashCache(fingerprint=True)
+    file_info.load_dir_info('.', calculate_hash=True, hash_cache=cache)
+    output = cStringIO.StringIO()
+    cache.write_to_csv(output)
+    cache_from_csv = hash_cache.load_hash_cache_from_csv(
+        cStringIO.StringIO(output.getvalue()), fingerprint=True)
+    self._touch(os.path.join('.', 'test2_modified.txt'))
+    self._hashed_paths = []
+    file_info.load_dir_info('.', calculate_hash=True,
+                            hash_cache=cache_from_csv)
+    self.assertEqual([], self._hashed_paths)
+    self.assertEqual(1, cache_from_csv.fingerprint_hits)
+
+    # The rows written before fingerprints
+    old_rows = ''.join([','.join(x.split(',')[:7]) + '\r\n'
+                        for x in output.getvalue().splitlines()])
+    cache_from_csv = hash_cache.load_hash_cache_from_csv(
+        cStringIO.StringIO(old_rows), fingerprint=True)
+    self.assertEqual(len(cache), len(cache_from_csv))
+    file_info.load_dir_info('.', calculate_hash=True,
+                            hash_cache=cache_from_csv)
+    self.assertEqual(0, cache_from_csv.fingerprint_hits)
+
+  def test_prune(self):
+    cache = hash_cache.HashCache()
+    file_info.load_dir_info('.', calculate_hash=True, hash_cache=cache)
+    count = len(cache)
+    os.remove(os.path.join('.', 'test3_deleted.txt'))
+
+    output = cStringIO.StringIO()
+    cache.write_to_csv(output)
+    cache = hash_cache.load_hash_cache_from_csv(
+        cStringIO.StringIO(output.getvalue()))
+    file_info.load_dir_info('.', calculate_hash=True, hash_cache=cache)
+    cache.prune()
+    self.assertEqual(count - 1, len(cache))
+
+  def test_parallel_hash_uses_cache(self):
+    cache = hash_cache.HashCache()
+    di1 = file_info.load_dir_info('.', calculate_hash=True, hash_cache=cache,
+                                  hash_workers=4)
+    self.assertEqual(self._file_count(di1), len(self._hashed_paths))
+    self.assertEqual(self._file_count(di1), len(cache))
+
+    self._hashed_paths = []
+    di2 = file_info.load_dir_info('.', calculate_hash=True, hash_cache=cache,
+                                  hash_workers=4)
+    self.assertEqual([], self._hashed_paths)
+    self.assertEqual(
+        [x.file_hash for x in di1.flat_file_info_list()],
+        [x.file_hash for x in di2.flat_file_info_list()])
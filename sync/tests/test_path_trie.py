@@ -0,0 +1,58 @@
+import gc
+import os
+import unittest
+
+from sync import file_info
+from sync import path_trie
+from util import util
+
+
+class TestPathTrie(unittest.TestCase):
+
+  def test_split_join(self):
+    for path in ['.', 'a', os.path.join('.', 'a'),
+                 os.path.join('.', 'a', 'b', 'c.txt'), os.sep,
+                 os.sep + 'a', 'a' + os.sep, 'a' + os.sep + os.sep + 'b',
+                 u'.' + os.sep + u'\xe9']:
+      dir_node, name = path_trie.split(path)
+      self.assertEqual(path, path_trie.join(dir_node, name))
+      self.assertEqual(type(path), type(path_trie.join(dir_node, name)))
+      self.assertEqual(name, path_trie.name_of(path))
+      self.assertEqual(util.path_for_sorting(path),
+                       path_trie.path_for_sorting(dir_node, name))
+
+  def test_dir_node_shared(self):
+    dir_node1, name1 = path_trie.split(os.path.join('.', 'a', 'b', '1.txt'))
+    path_trie.split(os.path.join('.', 'c', '2.txt'))
+    dir_node2, name2 = path_trie.split(os.path.join('.', 'a', 'b', '2.txt'))
+    self.assertTrue(dir_node1 is dir_node2)
+    self.assertEqual('b', dir_node1.name)
+    self.assertEqual('a', dir_node1.parent.name)
+    self.assertEqual('.', dir_node1.parent.parent.name)
+    self.assertTrue(dir_node1.parent.parent.parent is None)
+
+  def test_str_and_unicode_not_mixed(self):
+    dir_node1, name1 = path_trie.split(os.path.join('.', 'a', '1.txt'))
+    dir_node2, name2 = path_trie.split(os.path.join(u'.', u'a', u'1.txt'))
+    self.assertFalse(dir_node1 is dir_node2)
+    self.assertEqual(str, type(dir_node1.prefix))
+    self.assertEqual(unicode, type(dir_node2.prefix))
+
+  def test_dir_node_freed(self):
+    prefix = os.path.join('.', 'freed', '')
+    fi = file_info.FileInfo(prefix + 'a.txt', False, 0100644, 1, 1.0)
+    self.assertTrue(prefix in path_trie._dir_nodes[str])
+    # Split something else, as the last node is kept
+    path_trie.split(os.path.join('.', 'other', 'a.txt'))
+    del fi
+    gc.collect()
+    self.assertFalse(prefix in path_trie._dir_nodes[str])
+
+  def test_file_info_path(self):
+    path = os.path.join('.', 'a', 'b.txt')
+    fi = file_info.FileInfo(path, False, 0100644, 1, 1.0)
+    self.assertEqual(path, fi.path)
+    self.assertEqual(util.path_for_sorting(path), fi.path_for_sorting())
+    fi.path = os.path.join('.', 'c.txt')
+    self.assertEqual(os.path.join('.', 'c.txt'), fi.path)
+    self.assertEqual(util.path_for_sorting(fi.path), fi.path_for_sorting())
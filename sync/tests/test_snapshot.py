@@ -0,0 +1,82 @@
+import inspect
+import os
+import shutil
+import unittest
+
+from sync import snapshot
+
+_TEST_TMP_BASE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))),
+    'test_tmp', 'snapshot')
+_TEST_SRC = os.path.join(_TEST_TMP_BASE_DIR, 'src.txt')
+_TEST_DEST = os.path.join(_TEST_TMP_BASE_DIR, 'dest.txt')
+
+
+class TestSnapshot(unittest.TestCase):
+
+  def setUp(self):
+    try:
+      shutil.rmtree(_TEST_TMP_BASE_DIR)
+    except:
+      pass
+    os.makedirs(_TEST_TMP_BASE_DIR)
+    with open(_TEST_SRC, 'wb') as f:
+      f.write('test snapshot\n')
+    os.utime(_TEST_SRC, (1234567890, 1234567890))
+    snapshot.reset()
+
+  def tearDown(self):
+    snapshot.configure(reflink=True, hardlink=True)
+    snapshot.reset()
+
+  def _modify_src(self):
+    # Written in place, as an editor saving over the file
+    with open(_TEST_SRC, 'r+b') as f:
+      f.write('modified')
+    os.utime(_TEST_SRC, (1234567899, 1234567899))
+
+  def test_copy(self):
+    snapshot.configure(reflink=False, hardlink=False)
+    self.assertEqual(snapshot.STRATEGY_COPY,
+                     snapshot.take(_TEST_SRC, _TEST_DEST))
+    self.assertEqual(1, snapshot.counts[snapshot.STRATEGY_COPY])
+    self.assertEqual(open(_TEST_SRC, 'rb').read(),
+                     open(_TEST_DEST, 'rb').read())
+    self.assertEqual(os.stat(_TEST_SRC).st_mtime, os.stat(_TEST_DEST).st_mtime)
+    self._modify_src()
+    self.assertTrue(snapshot.is_intact(_TEST_DEST))
+    self.assertEqual('test snapshot\n', open(_TEST_DEST, 'rb').read())
+
+  def test_hardlink(self):
+    snapshot.configure(reflink=False)
+    self.assertEqual(snapshot.STRATEGY_HARDLINK,
+                     snapshot.take(_TEST_SRC, _TEST_DEST))
+    self.assertEqual(1, snapshot.counts[snapshot.STRATEGY_HARDLINK])
+    self.assertTrue(snapshot.is_intact(_TEST_DEST))
+    # A rename of the snapshot keeps it intact
+    os.rename(_TEST_DEST, _TEST_DEST + '.renamed')
+    os.rename(_TEST_DEST + '.renamed', _TEST_DEST)
+    self.assertTrue(snapshot.is_intact(_TEST_DEST))
+
+    self._modify_src()
+    self.assertFalse(snapshot.is_intact(_TEST_DEST))
+    snapshot.detach(_TEST_DEST)
+    self.assertEqual(1, snapshot.detached[0])
+    self.assertTrue(snapshot.is_intact(_TEST_DEST))
+    self.assertNotEqual(os.stat(_TEST_SRC).st_ino, os.stat(_TEST_DEST).st_ino)
+    self.assertEqual(open(_TEST_SRC, 'rb').read(),
+                     open(_TEST_DEST, 'rb').read())
+
+    # Not changed with the source anymore
+    with open(_TEST_SRC, 'wb') as f:
+      f.write('modified again')
+    self.assertEqual('modifiedpshot\n', open(_TEST_DEST, 'rb').read())
+
+  def test_default(self):
+    # Whichever strategy the file system supports
+    strategy = snapshot.take(_TEST_SRC, _TEST_DEST)
+    self.assertIn(strategy, snapshot.STRATEGIES)
+    self.assertEqual(1, sum(snapshot.counts.values()))
+    self.assertEqual(open(_TEST_SRC, 'rb').read(),
+                     open(_TEST_DEST, 'rb').read())
+    self.assertEqual(os.stat(_TEST_SRC).st_mtime, os.stat(_TEST_DEST).st_mtime)
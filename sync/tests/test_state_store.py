@@ -0,0 +1,304 @@
+import inspect
+import os
+import shutil
+import struct
+import unittest
+
+import cStringIO
+
+from sync import binary_state
+from sync import file_info
+from sync import state_store
+from util import util
+
+_TEST_CASES_BASE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))),
+    'test_cases')
+_TEST_CASES_SRC = 'src'
+_TEST_CASES_DEST = 'dest'
+
+_TEST_TMP_BASE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))),
+    'test_tmp', 'state_store')
+_TEST_CSV = os.path.join(_TEST_TMP_BASE_DIR, 'profile_dir.csv')
+_TEST_DB = os.path.join(_TEST_TMP_BASE_DIR, 'profile_dir.sqlite')
+_TEST_BINARY = os.path.join(_TEST_TMP_BASE_DIR, 'profile_dir.bin')
+_TEST_JOURNAL = os.path.join(_TEST_TMP_BASE_DIR, 'profile_dir.journal')
+
+
+class TestStateStore(unittest.TestCase):
+
+  def setUp(self):
+    try:
+      shutil.rmtree(_TEST_TMP_BASE_DIR)
+    except:
+      pass
+    os.makedirs(_TEST_TMP_BASE_DIR)
+    self._old_cwd = os.getcwd()
+    os.chdir(os.path.join(_TEST_CASES_BASE_DIR, _TEST_CASES_SRC))
+    self.dir_info = file_info.load_dir_info('.', calculate_hash=True)
+    # Attach some compressed file info to be kept in the state
+    for fi in self.dir_info.flat_file_info_list():
+      if not fi.is_dir:
+        fi.compressed_file_info = file_info.FileInfo(
+            fi.path + '.boxwrap.zip', False, fi.mode, fi.size + 1,
+            fi.last_modified_time, fi.file_hash)
+    os.chdir(os.path.join(_TEST_CASES_BASE_DIR, _TEST_CASES_DEST))
+    self.dest_dir_info = file_info.load_dir_info('.', calculate_hash=True)
+
+  def tearDown(self):
+    os.chdir(self._old_cwd)
+
+  def _to_csv(self, dir_info):
+    output = cStringIO.StringIO()
+    dir_info.write_to_csv(output)
+    return output.getvalue()
+
+  def test_csv(self):
+    store = state_store.CsvStateStore(_TEST_CSV)
+    self.assertFalse(store.exists())
+    store.save(self.dir_info)
+    self.assertTrue(store.exists())
+    self.assertEqual(self._to_csv(self.dir_info),
+                     self._to_csv(store.load('.')))
+    self.assertEqual(self._to_csv(self.dir_info),
+                     self._to_csv(store.load('.', columnar=True)))
+
+  def test_sqlite(self):
+    store = state_store.SqliteStateStore(_TEST_DB)
+    store.save(self.dir_info)
+    store.close()
+    self.assertTrue(store.exists())
+    store = state_store.SqliteStateStore(_TEST_DB)
+    self.assertEqual(self._to_csv(self.dir_info),
+                     self._to_csv(store.load('.')))
+    self.assertEqual(self._to_csv(self.dir_info),
+                     self._to_csv(store.load('.', columnar=True)))
+    store.close()
+
+  def test_sqlite_only_writes_changes(self):
+    store = state_store.SqliteStateStore(_TEST_DB)
+    store.save(self.dir_info)
+    self.assertEqual(len(list(self.dir_info.flat_file_info_list())),
+                     store.written_rows)
+    store.save(self.dir_info)
+    self.assertEqual(0, store.written_rows)
+
+    expected_rows = 0
+    old_rows = dict((x.path, x.to_csv())
+                    for x in self.dir_info.flat_file_info_list())
+    new_rows = dict((x.path, x.to_csv())
+                    for x in self.dest_dir_info.flat_file_info_list())
+    for path in set(old_rows.keys()) | set(new_rows.keys()):
+      if old_rows.get(path) != new_rows.get(path):
+        expected_rows += 1
+    store.save(self.dest_dir_info)
+    self.assertEqual(expected_rows, store.written_rows)
+    store.close()
+
+    store = state_store.SqliteStateStore(_TEST_DB)
+    self.assertEqual(self._to_csv(self.dest_dir_info),
+                     self._to_csv(store.load('.')))
+    store.close()
+
+  def test_binary(self):
+    store = state_store.BinaryStateStore(_TEST_BINARY)
+    self.assertFalse(store.exists())
+    store.save(self.dir_info)
+    self.assertTrue(store.exists())
+    dir_info = store.load('.')
+    self.assertEqual(self._to_csv(self.dir_info), self._to_csv(dir_info))
+
+    # Lookups by binary search
+    for fi in self.dir_info.flat_file_info_list():
+      self.assertEqual(fi.to_csv(), dir_info.get(fi.path).to_csv())
+      self.assertEqual(fi.to_csv(), dir_info.get(unicode(fi.path)).to_csv())
+    self.assertIsNone(dir_info.get(os.path.join('.', 'not_exist')))
+    dir1 = os.path.join('.', 'dir1_unchanged')
+    self.assertEqual(
+        [x.to_csv() for x in
+         self.dir_info.dir_info('.').dir_info(dir1).file_info_list()],
+        [x.to_csv() for x in
+         dir_info.dir_info('.').dir_info(dir1).file_info_list()])
+    self.assertIsNone(dir_info.child_dir_info(
+        os.path.join('.', 'test1_unchanged.txt')))
+
+    # The dir info loaded stays readable when saved over
+    store.save(self.dest_dir_info)
+    self.assertEqual(self._to_csv(self.dir_info), self._to_csv(dir_info))
+    self.assertEqual(self._to_csv(self.dest_dir_info),
+                     self._to_csv(store.load('.')))
+
+  def test_binary_other_version(self):
+    store = state_store.BinaryStateStore(_TEST_BINARY)
+    store.save(self.dir_info)
+    with open(_TEST_BINARY, 'r+b') as f:
+      f.seek(4)
+      f.write(struct.pack('<I', binary_state._VERSION - 1))
+    self.assertRaises(ValueError, store.load, '.')
+
+  def test_binary_on_windows(self):
+    store = state_store.BinaryStateStore(_TEST_BINARY)
+    store.save(self.dir_info)
+    old_os_name = os.name
+    # Only the check of the platform, as the file is removed either way
+    os.name = 'nt'
+    try:
+      dir_info = store.load('.')
+      store.save(self.dest_dir_info)
+    finally:
+      os.name = old_os_name
+    # Closed before the file is replaced
+    self.assertRaises(ValueError, dir_info.get, os.path.join('.', 'dir1'))
+    self.assertEqual(self._to_csv(self.dest_dir_info),
+                     self._to_csv(store.load('.')))
+
+  def test_migrate(self):
+    csv_store = state_store.CsvStateStore(_TEST_CSV)
+    sqlite_store = state_store.SqliteStateStore(_TEST_DB)
+    self.assertFalse(state_store.migrate_state(csv_store, sqlite_store, '.'))
+    csv_store.save(self.dir_info)
+    self.assertTrue(state_store.migrate_state(csv_store, sqlite_store, '.'))
+    self.assertFalse(csv_store.exists())
+    self.assertEqual(self._to_csv(self.dir_info),
+                     self._to_csv(sqlite_store.load('.')))
+    # Nothing to migrate once migrated
+    self.assertFalse(state_store.migrate_state(csv_store, sqlite_store, '.'))
+
+    self.assertTrue(state_store.migrate_state(sqlite_store, csv_store, '.'))
+    self.assertFalse(sqlite_store.exists())
+    self.assertEqual(self._to_csv(self.dir_info),
+                     self._to_csv(csv_store.load('.')))
+
+  def _journaled_store(self, **kwargs):
+    return state_store.JournaledStateStore(
+        state_store.CsvStateStore(_TEST_CSV), _TEST_JOURNAL, **kwargs)
+
+  def test_journal_save_and_replay(self):
+    store = self._journaled_store()
+    store.save(self.dir_info)
+    self.assertFalse(os.path.exists(_TEST_JOURNAL))
+    csv_data = open(_TEST_CSV, 'rb').read()
+
+    store.save(self.dest_dir_info)
+    store.close()
+    # Only the journal is written
+    self.assertEqual(csv_data, open(_TEST_CSV, 'rb').read())
+    self.assertTrue(store.journal_records > 0)
+
+    # Replayed and compacted on load
+    store = self._journaled_store()
+    self.assertEqual(self._to_csv(self.dest_dir_info),
+                     self._to_csv(store.load('.')))
+    self.assertFalse(os.path.exists(_TEST_JOURNAL))
+    self.assertEqual(self._to_csv(self.dest_dir_info),
+                     open(_TEST_CSV, 'rb').read())
+    store.close()
+
+  def test_journal_saved_time(self):
+    store = self._journaled_store()
+    self.assertIsNone(store.saved_time_ns())
+    store.save(self.dir_info)
+    os.utime(_TEST_CSV, (1000000000, 1000000000))
+    self.assertEqual(1000000000 * 1000000000, store.saved_time_ns())
+    # The journal written since counts
+    store.on_applied(os.path.join('.', 'test3_deleted.txt'), None)
+    store.close()
+    self.assertEqual(util.stat_mtime_ns(os.stat(_TEST_JOURNAL)),
+                     store.saved_time_ns())
+
+  def test_journal_compaction(self):
+    store = self._journaled_store(compact_ratio=0, min_compact_records=0)
+    store.save(self.dir_info)
+    store.save(self.dest_dir_info)
+    self.assertFalse(os.path.exists(_TEST_JOURNAL))
+    self.assertEqual(self._to_csv(self.dest_dir_info),
+                     open(_TEST_CSV, 'rb').read())
+    store.close()
+
+  def test_journal_on_applied(self):
+    store = self._journaled_store()
+    store.save(self.dir_info)
+    new_path = os.path.join('.', 'dir1_unchanged', 'new.txt')
+    store.on_applied(new_path, file_info.FileInfo(
+        new_path, False, 0100644, 3, 1234567890.5, 'abc'))
+    store.on_applied(os.path.join('.', 'test3_deleted.txt'), None)
+    # Dropped with its dir
+    store.on_applied(os.path.join('.', 'dir3_deleted', 'new.txt'),
+                     file_info.FileInfo(
+                         os.path.join('.', 'dir3_deleted', 'new.txt'), False,
+                         0100644, 3, 1234567890.5, 'abc'))
+    store.on_applied(os.path.join('.', 'dir3_deleted'), None)
+    # Interrupted while appending the last record
+    store.close()
+    with open(_TEST_JOURNAL, 'ab') as f:
+      f.write('-,./test1_unch')
+
+    store = self._journaled_store()
+    dir_info = store.load('.')
+    store.close()
+    self.assertEqual(1234567890.5, dir_info.get(new_path).last_modified_time)
+    # The dir digest covers the new file
+    dir1 = os.path.join('.', 'dir1_unchanged')
+    self.assertNotEqual(self.dir_info.get(dir1).file_hash,
+                        dir_info.get(dir1).file_hash)
+    self.assertIsNone(dir_info.get(os.path.join('.', 'test3_deleted.txt')))
+    self.assertIsNotNone(
+        dir_info.get(os.path.join('.', 'test1_unchanged.txt')))
+    for fi in dir_info.flat_file_info_list():
+      self.assertFalse(fi.path.startswith(os.path.join('.', 'dir3_deleted')))
+
+  def test_journal_binary_load(self):
+    store = state_store.JournaledStateStore(
+        state_store.BinaryStateStore(_TEST_BINARY), _TEST_JOURNAL)
+    store.save(self.dir_info)
+    store.close()
+    row_count = len(list(self.dir_info.flat_file_info_list()))
+
+    decoded = []
+    old_file_info = binary_state._MmapTable.file_info
+    def _recording_file_info(table, i):
+      decoded.append(i)
+      return old_file_info(table, i)
+    binary_state._MmapTable.file_info = _recording_file_info
+    try:
+      store = state_store.JournaledStateStore(
+          state_store.BinaryStateStore(_TEST_BINARY), _TEST_JOURNAL)
+      dir_info = store.load('.', columnar=True)
+    finally:
+      binary_state._MmapTable.file_info = old_file_info
+    # No record is decoded to count the rows
+    self.assertEqual([], decoded)
+    self.assertEqual(row_count, store._state_rows)
+
+    # The rows are counted by the changes on save
+    store.save(self.dest_dir_info)
+    self.assertEqual(len(list(self.dest_dir_info.flat_file_info_list())),
+                     store._state_rows)
+    store.close()
+
+  def test_journal_without_state(self):
+    store = self._journaled_store()
+    self.assertFalse(store.exists())
+    new_dir = os.path.join('.', 'new_dir')
+    store.on_applied(new_dir, file_info.FileInfo(
+        new_dir, True, 040755, None, 1234567890.5))
+    store.on_applied(os.path.join(new_dir, 'new.txt'), file_info.FileInfo(
+        os.path.join(new_dir, 'new.txt'), False, 0100644, 3, 1234567890.5,
+        'abc'))
+    store.on_applied(os.path.join('.', 'new.txt'), file_info.FileInfo(
+        os.path.join('.', 'new.txt'), False, 0100644, 3, 1234567890.5, 'abc'))
+    store.close()
+    # No root, i.e. the first sync is interrupted, whose progress is kept
+    store = self._journaled_store()
+    self.assertTrue(store.exists())
+    dir_info = store.load('.')
+    store.close()
+    self.assertEqual(
+        ['.', os.path.join('.', 'new.txt'), new_dir,
+         os.path.join(new_dir, 'new.txt')],
+        [x.path for x in dir_info.flat_file_info_list()])
+    self.assertFalse(os.path.exists(_TEST_JOURNAL))
+    self.assertTrue(os.path.exists(_TEST_CSV))
+    # The root listing is not taken for unchanged
+    self.assertEqual(0, dir_info.get('.').mtime_ns)
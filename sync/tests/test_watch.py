@@ -0,0 +1,69 @@
+import inspect
+import os
+import shutil
+import unittest
+
+from sync import watch
+
+_TEST_TMP_BASE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))),
+    'test_tmp')
+_TEST_WATCH = os.path.join(_TEST_TMP_BASE_DIR, 'watch')
+
+
+class TestWatch(unittest.TestCase):
+
+  def setUp(self):
+    try:
+      shutil.rmtree(_TEST_WATCH)
+    except:
+      pass
+    os.makedirs(os.path.join(_TEST_WATCH, 'dir1'))
+    with open(os.path.join(_TEST_WATCH, 'dir1', 'file.txt'), 'w') as f:
+      f.write('file')
+    with open(os.path.join(_TEST_WATCH, 'deleted.txt'), 'w') as f:
+      f.write('deleted')
+
+  def _make_changes(self):
+    with open(os.path.join(_TEST_WATCH, 'dir1', 'file.txt'), 'a') as f:
+      f.write('modified')
+    os.remove(os.path.join(_TEST_WATCH, 'deleted.txt'))
+    os.makedirs(os.path.join(_TEST_WATCH, 'dir2'))
+    with open(os.path.join(_TEST_WATCH, 'dir2', 'new.txt'), 'w') as f:
+      f.write('new')
+
+  def _assert_changes(self, watcher):
+    dirty_paths, overflow = watcher.pop_changes()
+    self.assertFalse(overflow)
+    for path in ['dir1/file.txt', 'deleted.txt', 'dir2']:
+      self.assertIn(os.path.join('.', *path.split('/')), dirty_paths)
+    self.assertEqual((set(), False), watcher.pop_changes())
+
+  @unittest.skipUnless(watch.is_inotify_supported(),
+                       'inotify is not supported')
+  def test_inotify_watcher(self):
+    watcher = watch.InotifyWatcher(_TEST_WATCH)
+    try:
+      self.assertFalse(watch.wait_for_changes([watcher], timeout=0.1))
+      self._make_changes()
+      self.assertTrue(
+          watch.wait_for_changes([watcher], debounce=0.1, timeout=5))
+      self._assert_changes(watcher)
+
+      # New dirs are watched too
+      with open(os.path.join(_TEST_WATCH, 'dir2', 'new.txt'), 'a') as f:
+        f.write('modified')
+      self.assertTrue(
+          watch.wait_for_changes([watcher], debounce=0.1, timeout=5))
+      self.assertEqual(
+          (set([os.path.join('.', 'dir2', 'new.txt')]), False),
+          watcher.pop_changes())
+    finally:
+      watcher.close()
+
+  def test_polling_watcher(self):
+    watcher = watch.PollingWatcher(_TEST_WATCH, poll_interval=0)
+    self.assertFalse(watch.wait_for_changes([watcher], timeout=0.1))
+    self._make_changes()
+    self.assertTrue(watch.wait_for_changes([watcher], debounce=0.1))
+    self._assert_changes(watcher)
@@ -0,0 +1,271 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+from sync import file_info
+
+
+# Seconds without any new event before the changes are reported, so that a
+# burst of events, e.g. from saving or copying many files, is coalesced into
+# one sync.
+DEFAULT_DEBOUNCE = 1.0
+
+# Seconds between two scans of PollingWatcher
+DEFAULT_POLL_INTERVAL = 5.0
+
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_DONT_FOLLOW = 0x02000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0x00000800
+_IN_CLOEXEC = 0x00080000
+
+_WATCH_MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM |
+               _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF |
+               _IN_MOVE_SELF | _IN_ONLYDIR | _IN_DONT_FOLLOW)
+
+# struct inotify_event without the trailing name
+_EVENT_HEADER = struct.Struct('iIII')
+_READ_SIZE = 64 * 1024
+
+
+class WatchException(Exception):
+  pass
+
+
+def _load_libc():
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+    libc.inotify_init1
+    libc.inotify_add_watch
+    return libc
+  except (OSError, AttributeError):
+    return None
+
+
+_libc = _load_libc()
+
+
+def is_inotify_supported():
+  return _libc is not None
+
+
+# Return the path under root_dir in the form of './a/b', as in DirInfo.
+def _to_rel_path(root_dir, path):
+  relpath = os.path.relpath(path, root_dir)
+  if relpath == '.':
+    return '.'
+  return os.path.join('.', relpath)
+
+
+# Watch a dir tree with Linux inotify. New dirs are watched as they appear.
+# The paths reported are relative to root_dir in the form of './a/b'. Once
+# the kernel event queue overflows or a dir cannot be watched, changes may be
+# lost and the watcher reports it until the caller does a full scan.
+class InotifyWatcher:
+
+  def __init__(self, root_dir):
+    if not _libc:
+      raise WatchException('inotify is not supported')
+    self.root_dir = os.path.abspath(root_dir)
+    self._fd = _libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+    if self._fd < 0:
+      raise WatchException('inotify_init1 failed: %s' %
+                           os.strerror(ctypes.get_errno()))
+    self._wd_paths = {}
+    self._dirty_paths = set()
+    self._overflow = False
+    self._add_watch_recursively(self.root_dir)
+
+  def fileno(self):
+    return self._fd
+
+  def close(self):
+    if self._fd >= 0:
+      os.close(self._fd)
+      self._fd = -1
+
+  def _add_watch(self, path):
+    wd = _libc.inotify_add_watch(self._fd, path, _WATCH_MASK)
+    if wd < 0:
+      err = ctypes.get_errno()
+      if err in (errno.ENOENT, errno.ENOTDIR):
+        # Removed already
+        return
+      if path == self.root_dir:
+        raise WatchException('Cannot watch %s: %s' % (path, os.strerror(err)))
+      # E.g. ENOSPC when the max_user_watches limit is reached
+      self._overflow = True
+      return
+    self._wd_paths[wd] = path
+
+  def _add_watch_recursively(self, path):
+    self._add_watch(path)
+    # Symlinks to dirs are not followed like in load_dir_info
+    for root, dirs, files in os.walk(path):
+      for d in dirs:
+        self._add_watch(os.path.join(root, d))
+
+  # Read all the pending events without blocking. Return whether there is
+  # any event. force is for the API of PollingWatcher.
+  def read_events(self, force=False):
+    has_events = False
+    while True:
+      try:
+        data = os.read(self._fd, _READ_SIZE)
+      except OSError as e:
+        if e.errno in (errno.EAGAIN, errno.EINTR):
+          break
+        raise
+      if not data:
+        break
+      has_events = True
+      self._parse_events(data)
+    return has_events
+
+  def _parse_events(self, data):
+    offset = 0
+    while offset + _EVENT_HEADER.size <= len(data):
+      wd, mask, cookie, name_len = _EVENT_HEADER.unpack_from(data, offset)
+      offset += _EVENT_HEADER.size
+      name = data[offset:offset + name_len].rstrip('\0')
+      offset += name_len
+      if mask & _IN_Q_OVERFLOW:
+        self._overflow = True
+        continue
+      dir_path = self._wd_paths.get(wd)
+      if mask & _IN_IGNORED:
+        self._wd_paths.pop(wd, None)
+        continue
+      if dir_path is None:
+        continue
+      path = os.path.join(dir_path, name) if name else dir_path
+      self._dirty_paths.add(_to_rel_path(self.root_dir, path))
+      if mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO):
+        # The watches of a dir moved within the tree are kept by the kernel,
+        # and watching it again updates their paths.
+        self._add_watch_recursively(path)
+
+  # Return (dirty_paths, overflow) collected since last call. dirty_paths is
+  # None if overflow and a full scan is needed.
+  def pop_changes(self):
+    dirty_paths = self._dirty_paths
+    overflow = self._overflow
+    self._dirty_paths = set()
+    self._overflow = False
+    if overflow:
+      return None, True
+    return dirty_paths, False
+
+
+# Fallback watcher which compares the stat of the whole tree at every poll
+# interval. It is much cheaper than a sync as nothing is read or hashed.
+class PollingWatcher:
+
+  def __init__(self, root_dir, poll_interval=DEFAULT_POLL_INTERVAL):
+    self.root_dir = os.path.abspath(root_dir)
+    self.poll_interval = poll_interval
+    self._snapshot = self._take_snapshot()
+    self._dirty_paths = set()
+    self._last_poll = time.time()
+
+  def fileno(self):
+    return None
+
+  def close(self):
+    pass
+
+  def _take_snapshot(self):
+    snapshot = {}
+    dir_info = file_info.load_dir_info(self.root_dir)
+    for fi in dir_info.flat_file_info_list():
+      snapshot[_to_rel_path(self.root_dir, fi.path)] = (
+          fi.is_dir, fi.mode, fi.size, fi.mtime_ns)
+    return snapshot
+
+  # Scan the tree if poll_interval has passed since last scan, or if force.
+  # Return whether there is any change.
+  def read_events(self, force=False):
+    if not force and time.time() - self._last_poll < self.poll_interval:
+      return False
+    self._last_poll = time.time()
+    snapshot = self._take_snapshot()
+    has_events = False
+    for path in set(snapshot.keys()) | set(self._snapshot.keys()):
+      if snapshot.get(path) != self._snapshot.get(path):
+        self._dirty_paths.add(path)
+        has_events = True
+    self._snapshot = snapshot
+    return has_events
+
+  def pop_changes(self):
+    dirty_paths = self._dirty_paths
+    self._dirty_paths = set()
+    return dirty_paths, False
+
+
+def create_watcher(root_dir, poll_interval=DEFAULT_POLL_INTERVAL,
+                   use_inotify=True):
+  if use_inotify and is_inotify_supported():
+    try:
+      return InotifyWatcher(root_dir)
+    except WatchException:
+      pass
+  return PollingWatcher(root_dir, poll_interval=poll_interval)
+
+
+def _wait(watchers, timeout):
+  fds = [w.fileno() for w in watchers if w.fileno() is not None]
+  if len(fds) < len(watchers):
+    # Some watcher polls, so wake up at least every second
+    timeout = 1.0 if timeout is None else min(timeout, 1.0)
+  if fds:
+    try:
+      select.select(fds, [], [], timeout)
+    except select.error as e:
+      if e.args[0] != errno.EINTR:
+        raise
+  elif timeout:
+    time.sleep(timeout)
+
+
+# Block until any of the watchers has changes, and then until there are no
+# more events for debounce seconds. Return whether there are any changes,
+# which is False only if timeout seconds have passed.
+def wait_for_changes(watchers, debounce=DEFAULT_DEBOUNCE, timeout=None):
+  start = time.time()
+  while True:
+    has_events = False
+    for w in watchers:
+      if w.read_events():
+        has_events = True
+    if has_events:
+      break
+    remaining = None
+    if timeout is not None:
+      remaining = timeout - (time.time() - start)
+      if remaining <= 0:
+        return False
+    _wait(watchers, remaining)
+  last_event = time.time()
+  while time.time() - last_event < debounce:
+    _wait(watchers, debounce - (time.time() - last_event))
+    for w in watchers:
+      if w.read_events():
+        last_event = time.time()
+  return True
@@ -1,5 +1,6 @@
 import compression
 import filecmp
+import hashlib
 import inspect
 import os
 import shutil
@@ -123,3 +124,32 @@ class TestCompressionCases(unittest.TestCase):
         _CASE_PATH, _CASE_SRC, _CASE_OUT, _CASE_TMP,
         password='1234567')
 
+
+  def test_decompression_with_hash(self):
+    compression.compress_recursively(
+        _CASE_PATH, _CASE_SRC, _CASE_DEST, password='123456',
+        encryption_method=compression.ENCRYPTION_AES_256)
+    archive = compression.get_compressed_filename(
+        os.path.join(_CASE_DEST, _CASE_PATH, 'test.txt'))
+    sha1 = hashlib.sha1()
+    out = os.path.join(_CASE_OUT, 'test.txt')
+    compression.decompress_file_with_hash(archive, out, _CASE_TMP, sha1,
+                                          password='123456')
+    self.assertEqual(hashlib.sha1('test123').hexdigest(), sha1.hexdigest())
+    self.assertEqual('test123', open(out, 'rb').read())
+    # The same mtime as extracted by 7za
+    extracted = os.path.join(_CASE_OUT, 'test_extracted.txt')
+    compression.decompress_file(archive, extracted, _CASE_TMP,
+                                password='123456')
+    self.assertEqual(os.stat(extracted).st_mtime, os.stat(out).st_mtime)
+
+    self.assertRaises(
+        compression.CompressionWrongPassword,
+        compression.decompress_file_with_hash,
+        archive, out, _CASE_TMP, hashlib.sha1(), password='1234567')
+    self.assertFalse(os.path.exists(out))
+    self.assertRaises(
+        compression.CompressionInvalidArchive,
+        compression.decompress_file_with_hash,
+        os.path.join(_CASE_SRC, _CASE_PATH, 'test.txt'), out, _CASE_TMP,
+        hashlib.sha1(), password='123456')
@@ -0,0 +1,81 @@
+import inspect
+import os
+import shutil
+import unittest
+
+from util import fastcopy
+
+_TEST_TMP_BASE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))),
+    'test_tmp', 'fastcopy')
+_TEST_SRC = os.path.join(_TEST_TMP_BASE_DIR, 'src.bin')
+_TEST_DEST = os.path.join(_TEST_TMP_BASE_DIR, 'dest.bin')
+
+
+class TestFastCopy(unittest.TestCase):
+
+  def setUp(self):
+    try:
+      shutil.rmtree(_TEST_TMP_BASE_DIR)
+    except:
+      pass
+    os.makedirs(_TEST_TMP_BASE_DIR)
+    self.data = os.urandom(3 * 1024 * 1024 + 17)
+    with open(_TEST_SRC, 'wb') as f:
+      f.write(self.data)
+    os.chmod(_TEST_SRC, 0640)
+    os.utime(_TEST_SRC, (1234567890, 1234567890))
+
+  def tearDown(self):
+    fastcopy.configure()
+
+  def test_methods(self):
+    for method in fastcopy.available_methods():
+      fastcopy.configure([method])
+      self.assertEqual(method, fastcopy.copyfile(_TEST_SRC, _TEST_DEST))
+      self.assertEqual(self.data, open(_TEST_DEST, 'rb').read())
+      os.remove(_TEST_DEST)
+
+  def test_copy2(self):
+    fastcopy.copy2(_TEST_SRC, _TEST_DEST)
+    self.assertEqual(self.data, open(_TEST_DEST, 'rb').read())
+    self.assertEqual(0640, os.stat(_TEST_DEST).st_mode & 0777)
+    self.assertEqual(1234567890, os.stat(_TEST_DEST).st_mtime)
+    # Into a dir as shutil.copy2
+    os.makedirs(os.path.join(_TEST_TMP_BASE_DIR, 'dir'))
+    fastcopy.copy2(_TEST_SRC, os.path.join(_TEST_TMP_BASE_DIR, 'dir'))
+    self.assertEqual(self.data, open(
+        os.path.join(_TEST_TMP_BASE_DIR, 'dir', 'src.bin'), 'rb').read())
+
+  def test_fall_back_if_unsupported(self):
+    old_kernel_copy = fastcopy._kernel_copy
+    fastcopy._kernel_copy = lambda method, fd_src, fd_dest: False
+    try:
+      self.assertEqual(fastcopy.METHOD_USERSPACE,
+                       fastcopy.copyfile(_TEST_SRC, _TEST_DEST))
+    finally:
+      fastcopy._kernel_copy = old_kernel_copy
+    self.assertEqual(self.data, open(_TEST_DEST, 'rb').read())
+
+  def test_fall_back_if_nothing_copied(self):
+    old_copy_file_range = fastcopy._copy_file_range
+    fastcopy._copy_file_range = lambda *args: 0
+    try:
+      with open(_TEST_SRC, 'rb') as f_src:
+        with open(_TEST_DEST, 'wb') as f_dest:
+          self.assertFalse(fastcopy._kernel_copy(
+              fastcopy.METHOD_COPY_FILE_RANGE, f_src.fileno(),
+              f_dest.fileno()))
+      fastcopy.configure([fastcopy.METHOD_COPY_FILE_RANGE])
+      self.assertEqual(fastcopy.METHOD_USERSPACE,
+                       fastcopy.copyfile(_TEST_SRC, _TEST_DEST))
+      self.assertEqual(self.data, open(_TEST_DEST, 'rb').read())
+      # Nothing to copy from an empty source
+      open(_TEST_SRC, 'wb').close()
+      with open(_TEST_SRC, 'rb') as f_src:
+        with open(_TEST_DEST, 'wb') as f_dest:
+          self.assertTrue(fastcopy._kernel_copy(
+              fastcopy.METHOD_COPY_FILE_RANGE, f_src.fileno(),
+              f_dest.fileno()))
+    finally:
+      fastcopy._copy_file_range = old_copy_file_range
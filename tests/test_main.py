@@ -4,8 +4,12 @@ import shutil
 import unittest
 
 from sync import change_entry
+from sync import columnar_dir_info
 import compression
 from sync import file_info
+from sync import snapshot
+from sync import state_store
+from util import fastcopy
 import main
 
 _TEST_CASES_BASE_DIR = os.path.join(
@@ -152,6 +156,397 @@ class TestMain(unittest.TestCase):
     dc = change_entry.get_dir_changes(self.cloud_di, self.working_di)
     self._assertDirChanges(dc, debug=True)
 
+  def _assertCloudFileContent(self, content, path):
+    dest = os.path.join(_TEST_TMP, 'decompressed')
+    compression.decompress_file(
+        compression.get_compressed_filename(os.path.join(_TEST_CLOUD, path)),
+        dest, _TEST_TMP, password='123456')
+    self._assertFileContent(content, dest)
+    os.remove(dest)
+
+  def testSyncSnapshotFree(self):
+    self.under_test.snapshot_free = True
+    f = open(os.path.join(_TEST_WORKING, 'test_new.txt'), 'w')
+    f.write('test_new')
+    f.close()
+    f = open(os.path.join(_TEST_WORKING, 'dir1', 'test1_1.txt'), 'w')
+    f.write('test_modified')
+    f.close()
+
+    has_changes, self.working_di, self.cloud_di = (
+        self.under_test.sync(self.working_di))
+    self.assertTrue(has_changes)
+    self.assertEqual(2, self.under_test.compressed_in_place)
+    self.assertEqual(0, self.under_test.snapshot_fallbacks)
+    # Only the archives are in tmp
+    self.assertEqual(2, len(os.listdir(_TEST_TMP)))
+    dc = change_entry.get_dir_changes(self.cloud_di, self.working_di)
+    self._assertDirChanges(dc, debug=True)
+    self._assertCloudFileContent('test_new', 'test_new.txt')
+    self._assertCloudFileContent('test_modified',
+                                 os.path.join('dir1', 'test1_1.txt'))
+
+  def testSyncSnapshotFreeModifiedWhileCompressed(self):
+    self.under_test.snapshot_free = True
+    path = os.path.join(_TEST_WORKING, 'test1.txt')
+    f = open(path, 'w')
+    f.write('test_modified')
+    f.close()
+
+    old_compress_file = compression.compress_file
+    def _modifying_compress_file(src_file, dest_file, **kwargs):
+      result = old_compress_file(src_file, dest_file, **kwargs)
+      if os.path.abspath(src_file) == os.path.abspath(path):
+        f = open(path, 'w')
+        f.write('test_modified_again')
+        f.close()
+      return result
+    compression.compress_file = _modifying_compress_file
+    try:
+      has_changes, self.working_di, self.cloud_di = (
+          self.under_test.sync(self.working_di))
+    finally:
+      compression.compress_file = old_compress_file
+    self.assertTrue(has_changes)
+    self.assertEqual(0, self.under_test.compressed_in_place)
+    self.assertEqual(1, self.under_test.snapshot_fallbacks)
+    # The content compressed is the one in the state
+    self._assertCloudFileContent('test_modified_again', 'test1.txt')
+    self.assertEqual(
+        file_info.load_file_info(path, calculate_hash=True).file_hash,
+        self.working_di.get(os.path.join('.', 'test1.txt')).file_hash)
+    has_changes, self.working_di, self.cloud_di = (
+        self.under_test.sync(self.working_di))
+    self.assertFalse(has_changes)
+
+  def testSyncHashesChangedFilesAsCopied(self):
+    hashed_paths = []
+    old_calculate_hash = file_info._calculate_hash
+    def _recording_calculate_hash(path, algorithm=None):
+      hashed_paths.append(os.path.abspath(path))
+      return old_calculate_hash(path, algorithm=algorithm)
+    file_info._calculate_hash = _recording_calculate_hash
+    snapshot.configure(reflink=False, hardlink=False)
+    try:
+      f = open(os.path.join(_TEST_WORKING, 'test_new.txt'), 'w')
+      f.write('test_new')
+      f.close()
+      has_changes, self.working_di, self.cloud_di = (
+          self.under_test.sync(self.working_di))
+      self.assertTrue(has_changes)
+      # Only the archive compressed is hashed once written
+      self.assertNotIn(os.path.join(_TEST_WORKING, 'test_new.txt'),
+                       hashed_paths)
+      self.assertEqual(
+          1, len([x for x in hashed_paths if x.startswith(_TEST_TMP)]))
+
+      del hashed_paths[:]
+      shutil.move(
+          compression.get_compressed_filename(
+              os.path.join(_TEST_CLOUD, 'test_new.txt')),
+          compression.get_compressed_filename(
+              os.path.join(_TEST_CLOUD, 'test_moved.txt')))
+      has_changes, self.working_di, self.cloud_di = (
+          self.under_test.sync(self.working_di))
+      self.assertTrue(has_changes)
+      # Neither the archive moved nor its original is read to be hashed
+      self.assertEqual(
+          [], [x for x in hashed_paths if x.startswith(_TEST_TMP) or
+               x.endswith(compression.get_compressed_filename(
+                   'test_moved.txt'))])
+    finally:
+      file_info._calculate_hash = old_calculate_hash
+      snapshot.configure(reflink=True, hardlink=True)
+    self._assertFileContent(
+        'test_new', os.path.join(_TEST_WORKING, 'test_moved.txt'))
+    fi = self.working_di.get(os.path.join('.', 'test_moved.txt'))
+    self.assertEqual(
+        file_info.load_file_info(
+            os.path.join(_TEST_WORKING, 'test_moved.txt'),
+            calculate_hash=True).file_hash,
+        fi.file_hash)
+    self.assertEqual(
+        file_info.load_file_info(
+            compression.get_compressed_filename(
+                os.path.join(_TEST_CLOUD, 'test_moved.txt')),
+            calculate_hash=True).file_hash,
+        fi.compressed_file_info.file_hash)
+
+  def _recordCompressedFiles(self):
+    compressed = []
+    old_compress_file = compression.compress_file
+    def _recording_compress_file(src_file, dest_file, **kwargs):
+      compressed.append(os.path.basename(src_file))
+      return old_compress_file(src_file, dest_file, **kwargs)
+    compression.compress_file = _recording_compress_file
+    self.addCleanup(setattr, compression, 'compress_file', old_compress_file)
+    return compressed
+
+  def testSyncMovedFileAndDir(self):
+    archive = compression.get_compressed_filename(
+        os.path.join(_TEST_CLOUD, 'test1.txt'))
+    dir_archive = compression.get_compressed_filename(
+        os.path.join(_TEST_CLOUD, 'dir1', 'test1_1.txt'))
+    inodes = [os.stat(archive).st_ino, os.stat(dir_archive).st_ino]
+    os.rename(os.path.join(_TEST_WORKING, 'test1.txt'),
+              os.path.join(_TEST_WORKING, 'test_moved.txt'))
+    os.rename(os.path.join(_TEST_WORKING, 'dir1'),
+              os.path.join(_TEST_WORKING, 'dir_moved'))
+
+    compressed = self._recordCompressedFiles()
+    has_changes, self.working_di, self.cloud_di = (
+        self.under_test.sync(self.working_di))
+    self.assertTrue(has_changes)
+    self.assertEqual([], compressed)
+    self.assertEqual([], os.listdir(_TEST_TMP))
+    # The archives are renamed in wrap_dir
+    self.assertFalse(os.path.exists(archive))
+    self.assertFalse(os.path.exists(os.path.join(_TEST_CLOUD, 'dir1')))
+    self.assertEqual(
+        inodes,
+        [os.stat(compression.get_compressed_filename(
+             os.path.join(_TEST_CLOUD, 'test_moved.txt'))).st_ino,
+         os.stat(compression.get_compressed_filename(
+             os.path.join(_TEST_CLOUD, 'dir_moved', 'test1_1.txt'))).st_ino])
+    self._assertCloudFileContent('test1\n', 'test_moved.txt')
+    self._assertCloudFileContent('test1_1\n',
+                                 os.path.join('dir_moved', 'test1_1.txt'))
+    dc = change_entry.get_dir_changes(self.cloud_di, self.working_di)
+    self._assertDirChanges(dc, debug=True)
+
+    has_changes, self.working_di, self.cloud_di = (
+        self.under_test.sync(self.working_di))
+    self.assertFalse(has_changes)
+
+  def testSyncMovedFileChangedInCloud(self):
+    os.rename(os.path.join(_TEST_WORKING, 'test1.txt'),
+              os.path.join(_TEST_WORKING, 'test_moved.txt'))
+    os.remove(compression.get_compressed_filename(
+        os.path.join(_TEST_CLOUD, 'test1.txt')))
+
+    compressed = self._recordCompressedFiles()
+    has_changes, self.working_di, self.cloud_di = (
+        self.under_test.sync(self.working_di))
+    self.assertTrue(has_changes)
+    # Compressed again as a new file, as the archive is gone
+    self.assertEqual(['test_moved.txt'], compressed)
+    self._assertCloudFileContent('test1\n', 'test_moved.txt')
+    dc = change_entry.get_dir_changes(self.cloud_di, self.working_di)
+    self._assertDirChanges(dc, debug=True)
+
+  def testSyncNotMovedFileOfSameSizeReadOnce(self):
+    os.remove(os.path.join(_TEST_WORKING, 'test1.txt'))
+    path = os.path.join(_TEST_WORKING, 'test2.txt')
+    f = open(path, 'w')
+    f.write('test2\n')
+    f.close()
+
+    read_paths = []
+    old_calculate_hash = file_info._calculate_hash
+    def _recording_calculate_hash(path, algorithm=None):
+      read_paths.append(os.path.abspath(path))
+      return old_calculate_hash(path, algorithm=algorithm)
+    old_copy_file_with_hash = file_info.copy_file_with_hash
+    def _recording_copy_file_with_hash(src, dest):
+      read_paths.append(os.path.abspath(src))
+      return old_copy_file_with_hash(src, dest)
+    old_copy2 = fastcopy.copy2
+    def _recording_copy2(src, dest):
+      read_paths.append(os.path.abspath(src))
+      return old_copy2(src, dest)
+    file_info._calculate_hash = _recording_calculate_hash
+    file_info.copy_file_with_hash = _recording_copy_file_with_hash
+    fastcopy.copy2 = _recording_copy2
+    snapshot.configure(reflink=False, hardlink=False)
+    try:
+      compressed = self._recordCompressedFiles()
+      has_changes, self.working_di, self.cloud_di = (
+          self.under_test.sync(self.working_di))
+    finally:
+      file_info._calculate_hash = old_calculate_hash
+      file_info.copy_file_with_hash = old_copy_file_with_hash
+      fastcopy.copy2 = old_copy2
+      snapshot.configure(reflink=True, hardlink=True)
+    self.assertTrue(has_changes)
+    # Hashed as copied, and compressed as a new file
+    self.assertEqual([path], [x for x in read_paths if x == path])
+    self.assertEqual(1, snapshot.counts[snapshot.STRATEGY_COPY])
+    self.assertEqual(['test2.txt'], compressed)
+    self._assertCloudFileContent('test2\n', 'test2.txt')
+
+  def testSyncMovedFileWithoutMoveDetection(self):
+    self.under_test.detect_moves = False
+    os.rename(os.path.join(_TEST_WORKING, 'test1.txt'),
+              os.path.join(_TEST_WORKING, 'test_moved.txt'))
+
+    compressed = self._recordCompressedFiles()
+    has_changes, self.working_di, self.cloud_di = (
+        self.under_test.sync(self.working_di))
+    self.assertTrue(has_changes)
+    self.assertEqual(['test_moved.txt'], compressed)
+    self._assertCloudFileContent('test1\n', 'test_moved.txt')
+
+  def testSyncMovedFileOfChecksumNotPaired(self):
+    file_info.configure_hashing(algorithm='crc32')
+    try:
+      with open(os.path.join(_TEST_WORKING, 'test1.txt'), 'w') as f:
+        f.write('test1_modified\n')
+      has_changes, self.working_di, self.cloud_di = (
+          self.under_test.sync(self.working_di))
+      os.rename(os.path.join(_TEST_WORKING, 'test1.txt'),
+                os.path.join(_TEST_WORKING, 'test_moved.txt'))
+
+      compressed = self._recordCompressedFiles()
+      has_changes, self.working_di, self.cloud_di = (
+          self.under_test.sync(self.working_di))
+    finally:
+      file_info.configure_hashing(
+          algorithm=file_info.DEFAULT_HASH_ALGORITHM)
+    self.assertTrue(has_changes)
+    self.assertEqual(['test_moved.txt'], compressed)
+    self._assertCloudFileContent('test1_modified\n', 'test_moved.txt')
+    self.assertFalse(os.path.exists(compression.get_compressed_filename(
+        os.path.join(_TEST_CLOUD, 'test1.txt'))))
+
+  def testSyncReportsAppliedState(self):
+    f = open(os.path.join(_TEST_WORKING, 'test_new.txt'), 'w')
+    f.write('test_new')
+    f.close()
+    os.remove(os.path.join(_TEST_WORKING, 'test1.txt'))
+    shutil.move(
+        compression.get_compressed_filename(
+            os.path.join(_TEST_CLOUD, 'dir1', 'test1_1.txt')),
+        compression.get_compressed_filename(
+            os.path.join(_TEST_CLOUD, 'dir1', 'test1_1_moved.txt')))
+
+    applied = {}
+    def on_applied(path, fi):
+      applied[path] = fi
+    has_changes, self.working_di, self.cloud_di = (
+        self.under_test.sync(self.working_di, on_applied=on_applied))
+    self.assertTrue(has_changes)
+
+    # Both the changes from working_dir and from wrap_dir are reported with
+    # the original paths
+    for path in ['test_new.txt', os.path.join('dir1', 'test1_1_moved.txt')]:
+      path = os.path.join('.', path)
+      self.assertEqual(self.working_di.get(path).to_csv(),
+                       applied[path].to_csv())
+      self.assertIsNotNone(applied[path].compressed_file_info)
+    for path in ['test1.txt', os.path.join('dir1', 'test1_1.txt')]:
+      path = os.path.join('.', path)
+      self.assertTrue(path in applied)
+      self.assertIsNone(applied[path])
+
+  def testSyncInterruptedOnFirstSync(self):
+    shutil.rmtree(_TEST_CLOUD)
+    os.makedirs(_TEST_CLOUD)
+    state_csv = os.path.join(_TEST_TMP_BASE_DIR, 'state.csv')
+    journal = os.path.join(_TEST_TMP_BASE_DIR, 'state.journal')
+    for path in [state_csv, journal]:
+      if os.path.exists(path):
+        os.remove(path)
+    store = state_store.JournaledStateStore(
+        state_store.CsvStateStore(state_csv), journal)
+
+    class Interrupted(Exception):
+      pass
+    applied = []
+    def on_applied(path, fi):
+      store.on_applied(path, fi)
+      applied.append(path)
+      if len(applied) == 2:
+        raise Interrupted()
+    cwd = os.getcwd()
+    self.assertRaises(Interrupted, self.under_test.sync,
+                      file_info.empty_dir_info('.'), on_applied=on_applied)
+    os.chdir(cwd)
+    store.close()
+
+    # The progress is kept without any state saved before
+    store = state_store.JournaledStateStore(
+        state_store.CsvStateStore(state_csv), journal)
+    dir_info = store.load('.')
+    store.close()
+    self.assertIsNotNone(dir_info)
+    for path in applied:
+      self.assertIsNotNone(dir_info.get(path))
+
+    compressed = self._recordCompressedFiles()
+    has_changes, self.working_di, self.cloud_di = (
+        self.under_test.sync(dir_info))
+    self.assertTrue(has_changes)
+    for path in applied:
+      self.assertFalse(os.path.basename(path) in compressed)
+    self.assertEqual(
+        [x.path for x in self.working_di.flat_file_info_list()
+         if not x.is_dir],
+        [compression.get_original_filename(x.path)
+         for x in self.cloud_di.flat_file_info_list() if not x.is_dir])
+
+  def testSyncWithColumnarState(self):
+    with open(_TEST_FI_CSV, 'wb') as f:
+      self.working_di.write_to_csv(f)
+    with open(_TEST_FI_CSV, 'rb') as f:
+      columnar_di = columnar_dir_info.load_columnar_dir_info_from_csv(f, '.')
+    f = open(os.path.join(_TEST_WORKING, 'dir1', 'test1_1.txt'), 'w')
+    f.write('test_modified')
+    f.close()
+
+    has_changes, self.working_di, self.cloud_di = (
+        self.under_test.sync(columnar_di))
+    self.assertTrue(has_changes)
+    dc = change_entry.get_dir_changes(self.cloud_di, self.working_di)
+    self._assertDirChanges(dc, debug=True)
+    # The modified file and the dirs up to the root, whose digests change
+    modified_paths = ['.', os.path.join('.', 'dir1'),
+                      os.path.join('.', 'dir1', 'test1_1.txt')]
+    self.assertEqual(
+        [x.to_csv() for x in self.working_di.flat_file_info_list()
+         if x.path not in modified_paths],
+        [x.to_csv() for x in columnar_di.flat_file_info_list()
+         if x.path not in modified_paths])
+
+  def testSyncWorkingDirtyPaths(self):
+    f = open(os.path.join(_TEST_WORKING, 'test1.txt'), 'w')
+    f.write('test_modified')
+    f.close()
+    f = open(os.path.join(_TEST_WORKING, 'dir1', 'test1_1.txt'), 'w')
+    f.write('test_modified')
+    f.close()
+
+    # Only the dirty path is synced
+    has_changes, self.working_di, self.cloud_di = (
+        self.under_test.sync(self.working_di,
+                             working_dirty_paths=[
+                                 os.path.join('.', 'test1.txt')],
+                             cloud_dirty_paths=[]))
+    self.assertTrue(has_changes)
+    self.assertEqual(
+        file_info.load_file_info(
+            os.path.join(_TEST_WORKING, 'test1.txt'), calculate_hash=True)
+            .file_hash,
+        self.working_di.get(os.path.join('.', 'test1.txt')).file_hash)
+    self.assertNotEqual(
+        file_info.load_file_info(
+            os.path.join(_TEST_WORKING, 'dir1', 'test1_1.txt'),
+            calculate_hash=True).file_hash,
+        self.working_di.get(os.path.join('.', 'dir1', 'test1_1.txt'))
+            .file_hash)
+
+    # And a full scan picks up the rest
+    has_changes, self.working_di, self.cloud_di = (
+        self.under_test.sync(self.working_di))
+    self.assertTrue(has_changes)
+    dc = change_entry.get_dir_changes(self.cloud_di, self.working_di)
+    self._assertDirChanges(dc, debug=True)
+    self.assertEqual(
+        file_info.load_file_info(
+            os.path.join(_TEST_WORKING, 'dir1', 'test1_1.txt'),
+            calculate_hash=True).file_hash,
+        self.working_di.get(os.path.join('.', 'dir1', 'test1_1.txt'))
+            .file_hash)
+
   def testSyncCloudFileNewModifyDelete(self):
     shutil.move(
         compression.get_compressed_filename(
@@ -0,0 +1,130 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import shutil
+import sys
+
+# Copies of whole files inside the kernel, without pumping the data through
+# Python buffers, by:
+#   copy_file_range: copy_file_range(2) of Linux 4.5+, which may also share
+#       the blocks or copy them on the server for network file systems.
+#   sendfile: sendfile(2) to a regular file, of Linux 2.6.33+.
+#   userspace: shutil.copyfileobj, where neither is available.
+# Both are called through libc, as neither is in the os module of Python 2.
+METHOD_COPY_FILE_RANGE = 'copy_file_range'
+METHOD_SENDFILE = 'sendfile'
+METHOD_USERSPACE = 'userspace'
+METHODS = [METHOD_COPY_FILE_RANGE, METHOD_SENDFILE, METHOD_USERSPACE]
+
+# Bytes asked for by each system call, as large as the kernel takes at once
+_KERNEL_CHUNK_SIZE = 1 << 30
+_USERSPACE_CHUNK_SIZE = 1024 * 1024
+
+# Errors of a method not supported for the files, e.g. across file systems
+# for copy_file_range before Linux 5.3, to fall back to the next method.
+_UNSUPPORTED_ERRNOS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                       errno.EOPNOTSUPP, errno.EBADF)
+
+
+def _load_libc():
+  if not sys.platform.startswith('linux'):
+    return None
+  try:
+    return ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+  except OSError:
+    return None
+
+
+def _libc_function(libc, names, argtypes):
+  for name in names:
+    func = getattr(libc, name, None) if libc else None
+    if func is not None:
+      func.argtypes = argtypes
+      func.restype = ctypes.c_ssize_t
+      return func
+  return None
+
+
+_libc = _load_libc()
+_copy_file_range = _libc_function(
+    _libc, ['copy_file_range'],
+    [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+     ctypes.c_size_t, ctypes.c_uint])
+_sendfile = _libc_function(
+    _libc, ['sendfile64', 'sendfile'],
+    [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+
+# Methods tried in order, with those missing in libc left out
+_available_methods = [
+    m for m, func in [(METHOD_COPY_FILE_RANGE, _copy_file_range),
+                      (METHOD_SENDFILE, _sendfile)] if func]
+_available_methods.append(METHOD_USERSPACE)
+_methods = _available_methods
+
+# Number of files copied by each method
+counts = dict((x, 0) for x in METHODS)
+
+
+# Restrict the methods to try, e.g. to compare them, or reset to all the
+# available ones if methods is None. The userspace copy is always the last
+# resort.
+def configure(methods=None):
+  global _methods
+  if methods is None:
+    _methods = _available_methods
+  else:
+    _methods = [m for m in _available_methods
+                if m in methods or m == METHOD_USERSPACE]
+
+
+def available_methods():
+  return list(_available_methods)
+
+
+# Copy from the current offsets of fd_src to fd_dest till the end of fd_src
+# by a kernel method. Return False if the method is not supported before any
+# byte is copied, and raise on other errors. Some file systems, e.g. procfs
+# or FUSE ones, make copy_file_range return 0 at once as if at the end of
+# the file, which is taken as not supported for a nonempty source.
+def _kernel_copy(method, fd_src, fd_dest):
+  copied = 0
+  while True:
+    if method == METHOD_COPY_FILE_RANGE:
+      n = _copy_file_range(fd_src, None, fd_dest, None, _KERNEL_CHUNK_SIZE, 0)
+    else:
+      n = _sendfile(fd_dest, fd_src, None, _KERNEL_CHUNK_SIZE)
+    if n < 0:
+      e = ctypes.get_errno()
+      if e == errno.EINTR:
+        continue
+      if copied == 0 and e in _UNSUPPORTED_ERRNOS:
+        return False
+      raise OSError(e, os.strerror(e))
+    if n == 0:
+      if copied == 0 and os.fstat(fd_src).st_size > 0:
+        return False
+      return True
+    copied += n
+
+
+# Copy the content of src to dest as shutil.copyfile. Return the method used.
+def copyfile(src, dest):
+  with open(src, 'rb') as f_src:
+    with open(dest, 'wb') as f_dest:
+      for method in _methods:
+        if method == METHOD_USERSPACE:
+          shutil.copyfileobj(f_src, f_dest, _USERSPACE_CHUNK_SIZE)
+        elif not _kernel_copy(method, f_src.fileno(), f_dest.fileno()):
+          continue
+        counts[method] += 1
+        return method
+
+
+# Copy src to dest with its mode and times, as shutil.copy2.
+def copy2(src, dest):
+  if os.path.isdir(dest):
+    dest = os.path.join(dest, os.path.basename(src))
+  copyfile(src, dest)
+  shutil.copystat(src, dest)
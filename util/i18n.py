@@ -64,3 +64,50 @@ class UnicodeWriter:
     for row in rows:
       self.writerow(row)
 
+
+
+def _encode_utf8(s):
+  if isinstance(s, unicode):
+    return s.encode('utf-8')
+  return s
+
+
+class UTF8Reader:
+  """
+  A faster UnicodeReader for UTF-8 files. The csv module reads the UTF-8
+  bytes as is, so only the fields in unicode_fields, or all if None, are
+  decoded, and the others are left as str, e.g. numbers to be parsed.
+  """
+
+  def __init__(self, f, unicode_fields=None, dialect=csv.excel, **kwds):
+    self.reader = csv.reader(f, dialect=dialect, **kwds)
+    self.unicode_fields = unicode_fields
+
+  def next(self):
+    row = self.reader.next()
+    if self.unicode_fields is None:
+      return [unicode(s, "utf-8") for s in row]
+    n = len(row)
+    for i in self.unicode_fields:
+      if i < n:
+        row[i] = row[i].decode("utf-8")
+    return row
+
+  def __iter__(self):
+    return self
+
+
+class UTF8Writer:
+  """
+  A faster UnicodeWriter for UTF-8 files, which writes the encoded rows to
+  "f" directly instead of through a queue.
+  """
+
+  def __init__(self, f, dialect=csv.excel, **kwds):
+    self.writer = csv.writer(f, dialect=dialect, **kwds)
+
+  def writerow(self, row):
+    self.writer.writerow([_encode_utf8(s) for s in row])
+
+  def writerows(self, rows):
+    self.writer.writerows([_encode_utf8(s) for s in row] for row in rows)
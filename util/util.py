@@ -8,27 +8,69 @@ def get_next(iterator):
     return None
 
 
+# Nanosecond timestamps of a stat result. Use the integer fields when the
+# platform provides them, or derive them from the float timestamps otherwise.
+def stat_mtime_ns(stat):
+  mtime_ns = getattr(stat, 'st_mtime_ns', None)
+  if mtime_ns is None:
+    mtime_ns = int(round(stat.st_mtime * 1000000000))
+  return mtime_ns
+
+
+def stat_ctime_ns(stat):
+  ctime_ns = getattr(stat, 'st_ctime_ns', None)
+  if ctime_ns is None:
+    ctime_ns = int(round(stat.st_ctime * 1000000000))
+  return ctime_ns
+
+
+# Format nanoseconds as seconds with all nine decimals, so that it is parsed
+# back exactly by parse_mtime_ns and still read as seconds by float().
+def format_mtime_ns(mtime_ns):
+  sign = '-' if mtime_ns < 0 else ''
+  return '%s%d.%09d' % ((sign,) + divmod(abs(mtime_ns), 1000000000))
+
+
+# Parse seconds into exact nanoseconds, including the float seconds written
+# by str() before format_mtime_ns.
+def parse_mtime_ns(s):
+  if 'e' in s or 'E' in s:
+    return int(round(float(s) * 1000000000))
+  sign = 1
+  if s.startswith('-'):
+    sign = -1
+    s = s[1:]
+  seconds, unused, fraction = s.partition('.')
+  return sign * (int(seconds or '0') * 1000000000 +
+                 int((fraction + '000000000')[:9]))
+
+
 def path_for_sorting(path):
   return path.replace(os.sep, '\1')
 
 
+# The key of an item is only computed once, when the item is taken.
 def merge_two_iterators(iter1, iter2, key_func):
   item1 = get_next(iter1)
   item2 = get_next(iter2)
+  key1 = key_func(item1) if item1 else None
+  key2 = key_func(item2) if item2 else None
   while True:
-    key1 = key_func(item1) if item1 else None
-    key2 = key_func(item2) if item2 else None
     if key1 == key2:
       if key1 is None:
         break
       yield item1, item2
       item1 = get_next(iter1)
       item2 = get_next(iter2)
+      key1 = key_func(item1) if item1 else None
+      key2 = key_func(item2) if item2 else None
     elif key1 is not None and (key1 < key2 or key2 is None):
       yield item1, None
       item1 = get_next(iter1)
+      key1 = key_func(item1) if item1 else None
     elif key2 is not None and (key1 > key2 or key1 is None):
       yield None, item2
       item2 = get_next(iter2)
+      key2 = key_func(item2) if item2 else None
 
 